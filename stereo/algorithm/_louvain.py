@@ -17,7 +17,6 @@ from typing import (
 
 import numpy as np
 import pandas as pd
-from natsort import natsorted
 from numpy import random
 from packaging import version
 from scipy import sparse
@@ -48,6 +47,7 @@ def louvain(
         use_weights: bool = False,
         partition_type: Optional[Type[MutableVertexPartition]] = None,
         partition_kwargs: Mapping[str, Any] = MappingProxyType({}),
+        graph=None,
 ):
     """
     :param neighbor:
@@ -75,6 +75,9 @@ def louvain(
     :param partition_kwargs:
         Key word arguments to pass to partitioning,
         if ``vtraag`` method is being used.
+    :param graph:
+        The igraph graph already built from `adjacency` with the same `directed`, built here if `None`,
+        only used by the ``'vtraag'`` and ``'igraph'`` flavors.
     :return: cluster: pandas.Categorical
     """
 
@@ -88,8 +91,10 @@ def louvain(
     if flavor in {'vtraag', 'igraph'}:
         if directed and flavor == 'igraph':
             directed = False
-        from .neighbors import Neighbors
-        g = Neighbors.get_igraph_from_adjacency(adjacency, directed=directed)
+        g = graph
+        if g is None:
+            from .neighbors import Neighbors
+            g = Neighbors.get_igraph_from_adjacency(adjacency, directed=directed)
         if use_weights:
             weights = np.array(g.es["weight"]).astype(np.float64)
         else:
@@ -174,9 +179,8 @@ def louvain(
         raise ValueError('`flavor` needs to be "vtraag" or "igraph" or "taynaud".')
 
     groups = groups + 1
-    cluster = pd.Categorical(
-        values=groups.astype('U'),
-        categories=natsorted(map(str, np.unique(groups))),
-    )
+    # the labels are non-negative integers, so their numeric order is the natural order of their strings
+    labels, codes = np.unique(groups, return_inverse=True)
+    cluster = pd.Categorical.from_codes(codes.reshape(-1), categories=labels.astype('U'))
 
     return cluster
@@ -29,8 +29,13 @@ class AlgorithmBase(metaclass=ABCMeta):
 
     _steps_order_by_name = list()
 
+    # direct subclasses by snake case name, filled in when they are defined
+    _algorithms_by_name = dict()
+
     @classmethod
     def __init_subclass__(cls, **kwargs):
+        if AlgorithmBase in cls.__bases__:
+            AlgorithmBase._algorithms_by_name.setdefault(_camel_to_snake(cls.__name__.split(".")[-1]), cls)
         # sorted by the starting word, just like 'step1' ... 'step{N}' , before first '_' char
         cls._steps_order_by_name = sorted(
             [
@@ -90,14 +95,11 @@ class AlgorithmBase(metaclass=ABCMeta):
         except Exception:
             raise AttributeError(f"No attribute named 'StPipeline.{item}'")
 
-        # TODO: this may be not the best way to get sub-class
-        # num of subclasses may be like 100-200 at most
-        for sub_cls in AlgorithmBase.__subclasses__():
-            sub_cls_name = _camel_to_snake(sub_cls.__name__.split(".")[-1])
-            if sub_cls_name == item and sub_cls.__name__ != 'ms_data_algorithm_base':
-                # snake_cls_name as method name in pipeline
-                sub_obj = sub_cls(stereo_exp_data=stereo_exp_data, pipeline_res=res)
-                return sub_obj.main
+        # snake_cls_name as method name in pipeline
+        sub_cls = AlgorithmBase._algorithms_by_name.get(item, None)
+        if sub_cls is not None and sub_cls.__name__ != 'ms_data_algorithm_base':
+            sub_obj = sub_cls(stereo_exp_data=stereo_exp_data, pipeline_res=res)
+            return sub_obj.main
         return None
 
 
@@ -1,4 +1,5 @@
 # python core module
+from itertools import chain
 from multiprocessing import cpu_count
 from typing import Union
 
@@ -6,6 +7,11 @@ from typing import Union
 import numba as nb
 import numpy as np
 import pandas as pd
+from scipy import sparse
+from scipy.spatial import ConvexHull
+from scipy.spatial import QhullError
+from scipy.spatial import cKDTree
+from sklearn.neighbors import BallTree
 
 from stereo.algorithm.algorithm_base import AlgorithmBase
 from stereo.core.stereo_exp_data import AnnBasedStereoExpData
@@ -18,65 +24,114 @@ from stereo.core.ms_data import MSData
 # please try the notebook demo in pull requese #
 # ----------------------------------------------#
 
-@nb.njit(cache=True, nogil=True)
-def _cal_distance(point: np.ndarray, points: np.ndarray):
-    return np.sqrt(np.sum((points - point) ** 2, axis=1))
-
+@nb.njit(cache=True, nogil=True, fastmath=True, boundscheck=False)
+def _cal_distance_sq(point: np.ndarray, points: np.ndarray):
+    """
+    Calculate the squared distances, callers compare them with squared thresholds to save the `sqrt` of each point,
+    they are accumulated in double precision since the squares exceed the exact integer range of float32 quickly.
+    """
+    points_count, dims = points.shape
+    distance_sq = np.zeros(points_count, dtype=np.float64)
+    # accumulate dimension by dimension, so that the inner loop over points can be vectorized
+    for d in range(dims):
+        p = point[d]
+        for i in range(points_count):
+            diff = np.float64(points[i, d] - p)
+            distance_sq[i] += diff * diff
+    return distance_sq
+
+
+def _iter_pairwise_distances(points_a: np.ndarray, points_b: np.ndarray, block_size: int = 4096):
+    """
+    Calculate the pairwise distances block by block on the rows of `points_a`, the squared distances are
+    expanded as `||a||^2 + ||b||^2 - 2 * a.b` so that the dot products are dispatched to BLAS.
 
-@nb.njit(cache=True, nogil=True, parallel=True)
-def _cal_pairwise_distances(points_a: np.ndarray, points_b: np.ndarray):
-    points_count_a = points_a.shape[0]
-    points_count_b = points_b.shape[0]
-    distance = np.zeros((points_count_a, points_count_b), dtype=np.float64)
-    for i in nb.prange(points_count_a):
-        distance[i] = _cal_distance(points_a[i], points_b)
+    :return: a generator yields the start row and the distances of each block.
+    """
+    points_a = np.asarray(points_a, dtype=np.float64)
+    points_b = np.asarray(points_b, dtype=np.float64)
+    sq_norm_b = np.einsum('ij,ij->i', points_b, points_b)
+    for start in range(0, points_a.shape[0], block_size):
+        block_a = points_a[start:start + block_size]
+        block = block_a @ points_b.T
+        block *= -2
+        block += np.einsum('ij,ij->i', block_a, block_a)[:, None]
+        block += sq_norm_b[None, :]
+        np.maximum(block, 0, out=block)
+        np.sqrt(block, out=block)
+        yield start, block
+
+
+def _cal_pairwise_distances(points_a: np.ndarray, points_b: np.ndarray, block_size: int = 4096):
+    distance = np.empty((points_a.shape[0], points_b.shape[0]), dtype=np.float64)
+    for start, block in _iter_pairwise_distances(points_a, points_b, block_size):
+        distance[start:start + block.shape[0]] = block
     return distance
 
 
+def _radius_neighbors(points: np.ndarray, radius: float):
+    """
+    Find the neighbors within `radius` of every point by a KD-tree, each point is a neighbor of itself.
+
+    :return: neighbors in CSR layout, the neighbors of point `i` are `indices[indptr[i]:indptr[i + 1]]`.
+    """
+    tree = cKDTree(points)
+    neighbors = tree.query_ball_point(points, r=radius, return_sorted=False)
+    indptr = np.zeros(neighbors.size + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, neighbors), dtype=np.int64, count=neighbors.size), out=indptr[1:])
+    indices = np.fromiter(chain.from_iterable(neighbors), dtype=np.int64, count=indptr[-1])
+    return indptr, indices
+
+
 @nb.njit(cache=True, nogil=True, parallel=True)
 def _coo_stereopy_calculator(
         data_position: np.ndarray,
-        group_codes: np.ndarray,
-        groups: np.ndarray,
+        neighbors_indptr: np.ndarray,
+        neighbors_indices: np.ndarray,
         groups_idx: np.ndarray,
-        thresh: np.ndarray,
-        genelist: np.ndarray = None,
-        gene_exp_matrix: np.ndarray = None,
-        gene_thresh: float = 0
+        groups_count: int,
+        features_indptr: np.ndarray,
+        features_indices: np.ndarray,
+        features_count: int,
+        thresh: np.ndarray
 ):
-    count_list = np.zeros((thresh.size - 1, group_codes.size), dtype=np.uint64)
-    if genelist is None:
-        ret_list = np.zeros((thresh.size - 1, group_codes.size, group_codes.size), dtype=np.uint64)
-        out = np.zeros((thresh.size - 1, group_codes.size, group_codes.size), dtype=np.float64)
-    else:
-        ret_list = np.zeros((thresh.size - 1, group_codes.size, genelist.size), dtype=np.uint64)
-        out = np.zeros((thresh.size - 1, genelist.size, group_codes.size), dtype=np.float64)
-
-    for ep in nb.prange(thresh.size - 1):
-        thresh_l, thresh_r = thresh[ep], thresh[ep + 1]
-        count = count_list[ep]
-        ret = ret_list[ep]
-        if genelist is None:
-            for i, gidx1 in enumerate(groups_idx):
-                dist = _cal_distance(data_position[i], data_position)
-                gidx2 = np.unique(groups_idx[(dist >= thresh_l) & (dist < thresh_r)])
-                ret[gidx1][gidx2] += np.uint64(1)
-                count[gidx1] += np.uint64(1)
-            ret = ret.T / count
-            out[ep, :, :] = ret
-        else:
-            for i, gidx in enumerate(groups_idx):
-                dist = _cal_distance(data_position[i], data_position)
-                flag = np.where((dist >= thresh_l) & (dist < thresh_r), 1, 0)
-                gene_exp_flag = np.where(gene_exp_matrix >= gene_thresh, 1, 0).astype(gene_exp_matrix.dtype)
-                gene_exp_flag = gene_exp_matrix * flag
-                gene_exp_flag = np.sum(gene_exp_flag, axis=1)
-                gene_exp_flag = np.where(gene_exp_flag > 0, 1, 0)
-                ret[gidx] += gene_exp_flag.astype(np.uint64)
-                count[gidx] += np.uint64(1)
-            ret = ret.T / count
-            out[ep, :, :] = ret
-    return out
+    """
+    Count the cells of each group around which each feature occurs in each shell, `ret[ep, i, j]` is the number
+    of cells in group `i` having at least one cell with feature `j` at a distance in `[thresh[ep], thresh[ep + 1])`.
+
+    The features of cell `k` are `features_indices[features_indptr[k]:features_indptr[k + 1]]`, they are the group
+    of each cell to calculate between groups or the expressed genes of each cell to calculate between groups and genes.
+    """
+    shells_count = thresh.size - 1
+    thresh_sq = thresh ** 2
+    cells_count = groups_idx.size
+    # every thread accumulates a contiguous chunk of cells into its own counts, which are reduced at the end
+    chunks_count = max(1, min(nb.get_num_threads(), cells_count))
+    chunks_bounds = np.linspace(0, cells_count, chunks_count + 1).astype(np.int64)
+    ret_local = np.zeros((chunks_count, shells_count, groups_count, features_count), dtype=np.uint64)
+    for c in nb.prange(chunks_count):
+        ret = ret_local[c]
+        # the last cell around which the feature has been counted in each shell, to count each feature only once
+        counted = np.full((shells_count, features_count), -1, dtype=np.int64)
+        for x in range(chunks_bounds[c], chunks_bounds[c + 1]):
+            i = groups_idx[x]
+            if i < 0:
+                continue
+            neighbors = neighbors_indices[neighbors_indptr[x]:neighbors_indptr[x + 1]]
+            dist_sq = _cal_distance_sq(data_position[x], data_position[neighbors])
+            # the shell `ep` of a distance satisfies `thresh[ep] <= dist < thresh[ep + 1]`
+            shells = np.searchsorted(thresh_sq, dist_sq, side='right') - 1
+            for k in range(neighbors.size):
+                ep = shells[k]
+                if ep >= shells_count:
+                    continue
+                y = neighbors[k]
+                for j in features_indices[features_indptr[y]:features_indptr[y + 1]]:
+                    if counted[ep, j] != x:
+                        counted[ep, j] = x
+                        ret[ep, i, j] += 1
+    ret = ret_local.sum(axis=0)
+    return ret
 
 
 @nb.njit(cache=True, nogil=True, parallel=True)
@@ -87,17 +142,30 @@ def _coo_squidpy_calculator(
         thresh: np.ndarray,
 ):
     num = group_codes.size
-    out = np.zeros((num, num, thresh.shape[0] - 1))
-    for ep in nb.prange(thresh.shape[0] - 1):
-        co_occur = np.zeros((num, num))
-        thresh_l, thresh_r = thresh[ep], thresh[ep + 1]
-        for x in range(data_position.shape[0]):
-            dist = _cal_distance(data_position[x], data_position)
+    shells_count = thresh.shape[0] - 1
+    thresh_sq = thresh ** 2
+    cells_count = groups_idx.size
+    # calculate the distances of each cell only once for all shells, every thread accumulates a contiguous chunk
+    # of cells into its own counts, which are reduced at the end, so there is no contention between threads
+    chunks_count = max(1, min(nb.get_num_threads(), cells_count))
+    chunks_bounds = np.linspace(0, cells_count, chunks_count + 1).astype(np.int64)
+    co_occur_local = np.zeros((chunks_count, shells_count, num, num), dtype=np.int64)
+    for c in nb.prange(chunks_count):
+        co_occur_chunk = co_occur_local[c]
+        for x in range(chunks_bounds[c], chunks_bounds[c + 1]):
             i = groups_idx[x]
-            y = groups_idx[(dist > thresh_l) & (dist <= thresh_r)]
-            for j in y:
-                co_occur[i, j] += 1
-
+            dist_sq = _cal_distance_sq(data_position[x], data_position)
+            # the shell `ep` of a distance satisfies `thresh[ep] < dist <= thresh[ep + 1]`
+            shells = np.searchsorted(thresh_sq, dist_sq) - 1
+            for k in range(dist_sq.size):
+                ep = shells[k]
+                if ep >= 0 and ep < shells_count:
+                    co_occur_chunk[ep, i, groups_idx[k]] += 1
+    co_occur_all = co_occur_local.sum(axis=0)
+
+    out = np.zeros((num, num, shells_count))
+    for ep in range(shells_count):
+        co_occur = co_occur_all[ep]
         probs_matrix = co_occur / np.sum(co_occur)
         probs = np.sum(probs_matrix, axis=1)
 
@@ -171,7 +239,7 @@ class CoOccurrence(AlgorithmBase):
             use_col: str
     ):
         """
-        Squidpy mode to calculate co-occurence, result same as squidpy
+        Squidpy mode to calculate co-occurence, the same metric as squidpy
         :param data: An instance of StereoExpData, data.position & data.tl.result[use_col] will be used.
         :param use_col: The key of the cluster or annotation result of cells stored in data.tl.result which ought to
                         be equal to cells in length.
@@ -186,34 +254,35 @@ class CoOccurrence(AlgorithmBase):
             groups: pd.Series = self.pipeline_res[use_col]['group'].astype('category')
         group_codes = groups.cat.categories.to_numpy().astype('U')
         out = _coo_squidpy_calculator(
-            data.position,
+            np.asarray(data.position, dtype=np.float32),
             group_codes,
             groups.cat.codes.to_numpy(),
             thresh,
         )
-        ret = {}
-        for i, j in enumerate(group_codes):
-            tmp = pd.DataFrame(out[i]).T
-            tmp.columns = group_codes
-            tmp.index = thresh[1:]
-            ret[j] = tmp
-        return ret
+        return {
+            j: pd.DataFrame(out[i].T, index=thresh[1:], columns=group_codes)
+            for i, j in enumerate(group_codes)
+        }
 
     def _find_min_max(self, spatial):
         '''
         Helper to calculate distance threshold in squidpy mode
         param: spatial: the cell position of data
-        return: thres_min, thres_max for minimum & maximum of threshold
+        return: thres_min, thres_max for minimum & maximum of threshold, the minimum is the smallest distance
+                between two different positions and the maximum is a half of the diameter of all positions.
         '''
-        coord_sum = np.sum(spatial, axis=1)
-        min_idx, min_idx2 = np.argpartition(coord_sum, 2)[:2]
-        max_idx = np.argmax(coord_sum)
-        # fmt: off
-        thres_max = _cal_pairwise_distances(spatial[min_idx, :].reshape(1, -1), spatial[max_idx, :].reshape(1, -1))[
-                        0, 0] / 2.0
-        thres_min = _cal_pairwise_distances(spatial[min_idx, :].reshape(1, -1), spatial[min_idx2, :].reshape(1, -1))[
-            0, 0]
-        # fmt: on
+        spatial = np.unique(spatial, axis=0)
+        if spatial.shape[0] < 2:
+            raise ValueError('co-occurrence needs cells at two different positions at least to find the thresholds.')
+        nearest_dist, _ = BallTree(spatial).query(spatial, k=2)
+        thres_min = nearest_dist[:, 1].min()
+        # the farthest two positions must be the vertices of the convex hull
+        try:
+            boundary = spatial[ConvexHull(spatial).vertices]
+        except QhullError:
+            # all positions are collinear, the farthest two positions are the extremes along each axis
+            boundary = spatial[np.unique(np.concatenate([spatial.argmin(axis=0), spatial.argmax(axis=0)]))]
+        thres_max = _cal_pairwise_distances(boundary, boundary).max() / 2.0
         return thres_min, thres_max
 
     def co_occurrence(
@@ -241,10 +310,6 @@ class CoOccurrence(AlgorithmBase):
         :param gene_thresh: Threshold to determine whether a cell express the gene.
         :return: co_occurrence result, also written in data.tl.result['co-occur']
         '''  # noqa
-        # from collections import defaultdict
-        # from scipy import sparse
-        # dist_ori = pairwise_distances(data.position, data.position, metric='euclidean')
-        # distance = _cal_pairwise_distances(data.position, data.position)
         if isinstance(genelist, np.ndarray):
             genelist = list(genelist)
         elif isinstance(genelist, list):
@@ -260,35 +325,88 @@ class CoOccurrence(AlgorithmBase):
         else:
             groups: pd.Series = self.pipeline_res[use_col]['group'].astype('category')
         group_codes = groups.cat.categories.to_numpy().astype('U')
-        gene_exp_matrix = None
         if genelist is not None:
             genelist = np.array(genelist, dtype='U')
-            gene_idx = [np.argwhere(data.gene_names == gene_name)[0][0] for gene_name in genelist]
-            gene_exp_matrix = data.exp_matrix[:, gene_idx].toarray() if data.issparse() else \
-                data.exp_matrix[:, gene_idx]
-            gene_exp_matrix = gene_exp_matrix.T
-        out = _coo_stereopy_calculator(
-            data.position,
-            group_codes,
-            groups.to_numpy().astype('U'),
-            groups.cat.codes.to_numpy(),
-            thresh,
-            genelist,
-            gene_exp_matrix,
-            gene_thresh
+            gene_idx = pd.Index(data.gene_names).get_indexer(genelist)
+            if np.any(gene_idx < 0):
+                raise ValueError(f"genes {list(genelist[gene_idx < 0])} are not in data.")
+            gene_exp_matrix = data.exp_matrix[:, gene_idx]
+            # a cell expresses a gene only if the expression is positive and reaches `gene_thresh`
+            if data.issparse():
+                gene_exp_matrix = sparse.csr_matrix(gene_exp_matrix)
+                gene_exp_flag = sparse.csr_matrix(
+                    (
+                        (gene_exp_matrix.data > 0) & (gene_exp_matrix.data >= gene_thresh),
+                        gene_exp_matrix.indices,
+                        gene_exp_matrix.indptr
+                    ),
+                    shape=gene_exp_matrix.shape,
+                    dtype=np.uint8
+                )
+                gene_exp_flag.eliminate_zeros()
+            else:
+                gene_exp_flag = sparse.csr_matrix(
+                    (gene_exp_matrix > 0) & (gene_exp_matrix >= gene_thresh), dtype=np.uint8
+                )
+        groups_idx = groups.cat.codes.to_numpy()
+        # only the cells within the max threshold can co-occur, no need to calculate the whole distance matrix
+        neighbors_indptr, neighbors_indices = _radius_neighbors(data.position, dist_thres)
+        # single precision is enough for the spatial coordinates and halves the memory traffic of distances
+        data_position = np.asarray(data.position, dtype=np.float32)
+        if genelist is None:
+            cells_flag = groups_idx >= 0
+            features_indptr = np.zeros(groups_idx.size + 1, dtype=np.int64)
+            np.cumsum(cells_flag, out=features_indptr[1:])
+            features_indices = groups_idx[cells_flag]
+            features_count = group_codes.size
+        else:
+            features_indptr, features_indices = gene_exp_flag.indptr, gene_exp_flag.indices
+            features_count = genelist.size
+        ret = _coo_stereopy_calculator(
+            data_position,
+            neighbors_indptr,
+            neighbors_indices,
+            groups_idx,
+            group_codes.size,
+            features_indptr,
+            features_indices,
+            features_count,
+            thresh
         )
-        ret = {}
+        # cells without a group have the code -1, they are skipped by the calculator and are not counted here
+        count = np.bincount(groups_idx[groups_idx >= 0], minlength=group_codes.size)
+        out = ret.transpose(0, 2, 1) / count
         ret_key_list = group_codes if genelist is None else genelist
-        for i, ret_key in enumerate(ret_key_list):
-            tmp = {}
-            for j, th in enumerate(thresh[1:]):
-                tmp[th] = out[j][i]
-            ret[ret_key] = pd.DataFrame(tmp, index=group_codes).T
-        return ret
+        return {
+            ret_key: pd.DataFrame(out[:, i, :], index=thresh[1:], columns=group_codes)
+            for i, ret_key in enumerate(ret_key_list)
+        }
 
     @staticmethod
-    def ms_co_occur_integrate(ms_data: MSData, scope, use_col, res_key='co_occurrence'):
+    def _ms_co_occur_merge(ms_data: MSData, slices, use_col, res_key):
         from collections import Counter
+        categories = ms_data.obs[use_col].cat.categories
+        ct_count = pd.DataFrame({x: dict(Counter(ms_data[x].cells[use_col])) for x in slices})
+        ct_ratio = ct_count.div(ct_count.sum(axis=1), axis=0)
+        ct_ratio = ct_ratio.loc[categories]
+        first_ret = ms_data[slices[0]].tl.result[res_key]
+        # co_occur[k, c] is the result of key `c` in slice `k`, aligned to the shells and groups of the first slice
+        co_occur = np.stack([
+            np.stack([
+                ms_data[x].tl.result[res_key][c].reindex(index=y.index, columns=categories).to_numpy()
+                for c, y in first_ret.items()
+            ])
+            for x in slices
+        ])
+        # the column of each group is weighted by the ratio of the group in each slice
+        merged = np.einsum('kcst,tk->cst', co_occur, ct_ratio[slices].to_numpy())
+        return {
+            c: pd.DataFrame(merged[i], index=y.index, columns=categories)
+            for i, (c, y) in enumerate(first_ret.items())
+        }
+
+    @staticmethod
+    def ms_co_occur_integrate(ms_data: MSData, scope, use_col, res_key='co_occurrence'):
         if use_col not in ms_data.obs:
             tmp_list = []
             for data in ms_data:
@@ -300,41 +418,17 @@ class CoOccurrence(AlgorithmBase):
         slice_index = []
         if len(slice_groups) == 1:
             slices = slice_groups[0].split(",")
-            ct_count = {}
-            for x in slices:
-                ct_count[x] = dict(Counter(ms_data[x].cells[use_col]))
-                slice_index.append(ms_data.names.index(x))
-
-            ct_count = pd.DataFrame(ct_count)
-            ct_ratio = ct_count.div(ct_count.sum(axis=1), axis=0)
-            ct_ratio = ct_ratio.loc[ms_data.obs[use_col].cat.categories]
-            merge_co_occur_ret = ms_data[slices[0]].tl.result[res_key].copy()
-            merge_co_occur_ret = {x: y[ms_data.obs[use_col].cat.categories] * 0 for x, y in merge_co_occur_ret.items()}
-            for ct in merge_co_occur_ret:
-                for x in slices:
-                    merge_co_occur_ret[ct] += ms_data[x].tl.result[res_key][ct] * ct_ratio[x]
+            slice_index.extend(ms_data.names.index(x) for x in slices)
+            merge_co_occur_ret = CoOccurrence._ms_co_occur_merge(ms_data, slices, use_col, res_key)
 
         elif len(slice_groups) == 2:
             ret = []
             for tmp_slice_groups in slice_groups:
                 slices = tmp_slice_groups.split(",")
-                ct_count = {}
-                for x in slices:
-                    ct_count[x] = dict(Counter(ms_data[x].cells[use_col]))
-                    slice_index.append(ms_data.names.index(x))
-
-                ct_count = pd.DataFrame(ct_count)
-                ct_ratio = ct_count.div(ct_count.sum(axis=1), axis=0)
-                ct_ratio = ct_ratio.loc[ms_data.obs[use_col].cat.categories]
-                merge_co_occur_ret = ms_data[slices[0]].tl.result[res_key].copy()
-                merge_co_occur_ret = {x: y[ms_data.obs[use_col].cat.categories] * 0 for x, y in
-                                      merge_co_occur_ret.items()}
-                for ct in merge_co_occur_ret:
-                    for x in slices:
-                        merge_co_occur_ret[ct] += ms_data[x].tl.result[res_key][ct] * ct_ratio[x]
-                ret.append(merge_co_occur_ret)
-
-            merge_co_occur_ret = {ct: ret[0][ct] - ret[1][ct] for ct in merge_co_occur_ret}
+                slice_index.extend(ms_data.names.index(x) for x in slices)
+                ret.append(CoOccurrence._ms_co_occur_merge(ms_data, slices, use_col, res_key))
+
+            merge_co_occur_ret = {ct: ret[0][ct] - ret[1][ct] for ct in ret[1]}
 
         else:
             raise Exception('co-occurrence only compare case and control on two groups')
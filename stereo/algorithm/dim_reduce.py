@@ -107,9 +107,12 @@ def _pca_with_sparse(X, n_pcs, solver='arpack', mu=None, random_state=None):
     np.random.set_state(random_state.get_state())
     random_init = np.random.rand(np.min(X.shape))
     X = check_array(X, accept_sparse=['csr', 'csc'])
+    # keep every operand in the dtype of X, so a float32 matrix is not promoted by the centering terms
+    random_init = random_init.astype(X.dtype, copy=False)
 
     if mu is None:
         mu = X.mean(0).A.flatten()[None, :]
+    mu = mu.astype(X.dtype, copy=False)
     mdot = mu.dot
     mmat = mdot
     mhdot = mu.T.dot
@@ -118,7 +121,7 @@ def _pca_with_sparse(X, n_pcs, solver='arpack', mu=None, random_state=None):
     Xmat = Xdot
     XHdot = X.T.conj().dot
     XHmat = XHdot
-    ones = np.ones(X.shape[0])[None, :].dot
+    ones = np.ones(X.shape[0], dtype=X.dtype)[None, :].dot
 
     def matvec(x):
         return Xdot(x) - mdot(x)
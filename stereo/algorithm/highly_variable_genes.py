@@ -16,12 +16,13 @@ from ..utils.hvg_utils import (
 def highly_variable_genes_single_batch(
         data: Optional[sp_sparse.spmatrix],
         min_disp: Optional[float] = 0.5,
-        max_disp: Optional[float] = np.inf,
+        max_disp: Optional[float] = None,
         min_mean: Optional[float] = 0.0125,
         max_mean: Optional[float] = 3,
         n_top_genes: Optional[int] = None,
         n_bins: int = 20,
         method: Optional[str] = 'seurat',
+        mean_var: Optional[tuple] = None,
 ) -> pd.DataFrame:
     """\
     See `highly_variable_genes`.
@@ -37,10 +38,12 @@ def highly_variable_genes_single_batch(
     #     X *= np.log(adata.uns['log1p']['base'])
     # data = np.expm1(data)
 
-    if method == 'seurat':
-        data = np.expm1(data)
-
-    mean, var = materialize_as_ndarray(get_mean_var(data))
+    if mean_var is not None:
+        mean, var = mean_var
+    else:
+        if method == 'seurat':
+            data = np.expm1(data)
+        mean, var = materialize_as_ndarray(get_mean_var(data))
     # now actually compute the dispersion
     mean[mean == 0] = 1e-12  # set entries equal to zero to small value
     dispersion = var / mean
@@ -116,9 +119,10 @@ def highly_variable_genes_single_batch(
                 mean > min_mean,
                 mean < max_mean,
                 dispersion_norm > min_disp,
-                dispersion_norm < max_disp,
             )
         )
+        if max_disp is not None:
+            gene_subset &= dispersion_norm < max_disp
 
     df['highly_variable'] = gene_subset
     return df
@@ -130,6 +134,7 @@ def highly_variable_genes_seurat_v3(
         batch_info: Optional[np.ndarray] = None,
         check_values: bool = True,
         span: float = 0.3,
+        mean_var: Optional[tuple] = None,
 ) -> Optional[pd.DataFrame]:
     """\
     See `highly_variable_genes`.
@@ -171,7 +176,8 @@ def highly_variable_genes_seurat_v3(
             UserWarning,
         )
 
-    df['means'], df['variances'] = get_mean_var(data)
+    single_batch = batch_info is None
+    df['means'], df['variances'] = get_mean_var(data) if mean_var is None else mean_var
 
     if batch_info is None:
         batch_info = pd.Categorical(np.zeros(data.shape[0], dtype=int))
@@ -180,9 +186,13 @@ def highly_variable_genes_seurat_v3(
 
     norm_gene_vars = []
     for b in np.unique(batch_info):
-        X_batch = data[batch_info == b]
-
-        mean, var = get_mean_var(X_batch)
+        if single_batch:
+            # the only batch is the whole data, whose stats are already in `df`
+            X_batch = data
+            mean, var = df['means'].to_numpy(), df['variances'].to_numpy()
+        else:
+            X_batch = data[batch_info == b]
+            mean, var = get_mean_var(X_batch)
         not_const = var > 0
         estimat_var = np.zeros(data.shape[1], dtype=np.float64)
 
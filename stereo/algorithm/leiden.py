@@ -20,7 +20,6 @@ from typing import (
 import leidenalg
 import numpy as np
 import pandas as pd
-from natsort import natsorted
 from numpy import random
 from scipy import sparse
 
@@ -45,6 +44,7 @@ def leiden(
         random_state: AnyRandom = 0,
         n_iterations: int = -1,
         partition_type: Optional[Type[MutableVertexPartition]] = None,
+        graph=None,
         **partition_kwargs,
 ):
     """
@@ -76,12 +76,16 @@ def leiden(
     :param partition_kwargs:
         Any further arguments to pass to `~leidenalg.find_partition`
         (which in turn passes arguments to the `partition_type`).
+    :param graph:
+        The igraph graph already built from `adjacency` with the same `directed`, built here if `None`.
     :return: cluster: pandas.Categorical
     """
     partition_kwargs = dict(partition_kwargs)
     # convert it to igraph
-    from .neighbors import Neighbors
-    g = Neighbors.get_igraph_from_adjacency(adjacency, directed=directed)
+    g = graph
+    if g is None:
+        from .neighbors import Neighbors
+        g = Neighbors.get_igraph_from_adjacency(adjacency, directed=directed)
     # filp to the default partition type if not overriden by the user
     if partition_type is None:
         partition_type = leidenalg.RBConfigurationVertexPartition
@@ -97,10 +101,9 @@ def leiden(
     groups = np.array(part.membership)
 
     groups = groups + 1
-    cluster = pd.Categorical(
-        values=groups.astype('U'),
-        categories=natsorted(map(str, np.unique(groups))),
-    )
+    # the labels are non-negative integers, so their numeric order is the natural order of their strings
+    labels, codes = np.unique(groups, return_inverse=True)
+    cluster = pd.Categorical.from_codes(codes.reshape(-1), categories=labels.astype('U'))
     return cluster
 
 
@@ -126,8 +129,10 @@ def leiden_rapids(adjacency, resolution=1.0):
         raise ImportError("Your env don't have GPU related RAPIDS packages, if you want to run this option, follow the "
                           "guide at https://stereopy.readthedocs.io/en/latest/Tutorials/clustering_by_gpu.html")
 
-    offsets = cudf.Series(adjacency.indptr)
-    indices = cudf.Series(adjacency.indices)
+    # cugraph works on int32 vertex ids, downcast on the host so only half the bytes cross to the device
+    index_dtype = np.int32 if adjacency.nnz < np.iinfo(np.int32).max else adjacency.indptr.dtype
+    offsets = cudf.Series(adjacency.indptr.astype(index_dtype, copy=False))
+    indices = cudf.Series(adjacency.indices.astype(index_dtype, copy=False))
     g = cugraph.Graph()
     if hasattr(g, 'add_adj_list'):
         g.add_adj_list(offsets, indices, None)
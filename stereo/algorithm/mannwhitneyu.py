@@ -187,7 +187,7 @@ MannwhitneyuResult = namedtuple('MannwhitneyuResult', ('statistic', 'pvalue'))
 
 
 def mannwhitneyu(x, y, use_continuity=True, alternative="two-sided",
-                 axis=0, method="auto", ranks=None, tie_term=None, x_mask=None):
+                 axis=0, method="auto", ranks=None, tie_term=None, x_mask=None, rank_sum=None):
     r'''Perform the Mann-Whitney U rank test on two independent samples.
 
     The Mann-Whitney U test is a nonparametric test of the null hypothesis
@@ -235,6 +235,11 @@ def mannwhitneyu(x, y, use_continuity=True, alternative="two-sided",
           is less than 8 and there are no ties; chooses ``'asymptotic'``
           otherwise.
 
+    rank_sum : array-like, optional
+        Precomputed rank sums of `x` along `axis`, taken from `ranks` of the
+        pooled samples. When both samples are larger than 8 the pooled
+        samples are then neither concatenated nor ranked again.
+
     Returns
     -------
     res : MannwhitneyuResult
@@ -250,18 +255,24 @@ def mannwhitneyu(x, y, use_continuity=True, alternative="two-sided",
     x, y, use_continuity, alternative, axis_int, method = (
         _mwu_input_validation(x, y, use_continuity, alternative, axis, method))
 
-    x, y, xy = _broadcast_concatenate(x, y, axis)
+    n1, n2 = x.shape[axis_int], y.shape[axis_int]
+    if rank_sum is not None and method != "exact" and n1 > 8 and n2 > 8:
+        # the asymptotic method only needs the rank sums, which were taken from the shared ranks
+        method = "asymptotic"
+        R1 = rank_sum
+    else:
+        x, y, xy = _broadcast_concatenate(x, y, axis)
 
-    n1, n2 = x.shape[-1], y.shape[-1]
+        n1, n2 = x.shape[-1], y.shape[-1]
 
-    if method == "auto":
-        method = _mwu_choose_method(n1, n2, xy, method)
+        if method == "auto":
+            method = _mwu_choose_method(n1, n2, xy, method)
 
-    # Follows [2]
-    if ranks is None:
-        ranks = stats.rankdata(xy, axis=-1)  # method 2, step
+        # Follows [2]
+        if ranks is None:
+            ranks = stats.rankdata(xy, axis=-1)  # method 2, step
 
-    R1 = ranks[..., :n1].sum(axis=-1) if x_mask is None else ranks[..., x_mask].sum(axis=-1)  # method 2, step 2
+        R1 = ranks[..., :n1].sum(axis=-1) if x_mask is None else ranks[..., x_mask].sum(axis=-1)  # method 2, step 2
     U1 = R1 - n1 * (n1 + 1) / 2  # method 2, step 3
     U2 = n1 * n2 - U1  # as U1 + U2 = n1 * n2
 
@@ -327,17 +327,16 @@ class Neighbors(object):
     @staticmethod
     def get_igraph_from_adjacency(adjacency, directed=None):
         """Get igraph graph from adjacency matrix."""
-        sources, targets = adjacency.nonzero()
-        weights = adjacency[sources, targets]
-        if isinstance(weights, np.matrix):
-            weights = weights.A1
-        g = ig.Graph(directed=directed)
-        g.add_vertices(adjacency.shape[0])  # this adds adjacency.shape[0] vertices
-        g.add_edges(list(zip(sources, targets)))
-        try:
-            g.es['weight'] = weights
-        except KeyError:
-            pass
+        # the edges and weights are read from the csr arrays, in the same row-major order as `nonzero`
+        adjacency = csr_matrix(adjacency)
+        if (adjacency.data == 0).any():
+            adjacency = adjacency.copy()
+            adjacency.eliminate_zeros()
+        sources = np.repeat(np.arange(adjacency.shape[0]), np.diff(adjacency.indptr))
+        targets = adjacency.indices
+        edges = np.column_stack((sources, targets))
+        g = ig.Graph(n=adjacency.shape[0], edges=edges, directed=directed,
+                     edge_attrs={'weight': adjacency.data})
         if g.vcount() != adjacency.shape[0]:
             logger.error(
                 f'The constructed graph has only {g.vcount()} nodes. '
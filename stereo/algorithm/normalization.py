@@ -6,9 +6,11 @@
 
 from functools import singledispatch
 
+import numba as nb
 import numpy as np
 import scipy.spatial as spatial
 from scipy import stats
+from scipy.sparse import issparse
 from scipy.sparse import spmatrix
 from sklearn.utils import sparsefuncs
 
@@ -43,6 +45,35 @@ def _(x, target_sum):
     return x
 
 
+@nb.njit(cache=True, nogil=True, parallel=True)
+def _scale_rows_log1p(data, indptr, row_scale):
+    for i in nb.prange(indptr.shape[0] - 1):
+        factor = row_scale[i]
+        for k in range(indptr[i], indptr[i + 1]):
+            data[k] = np.log1p(data[k] * factor)
+
+
+def normalize_total_log1p(x, target_sum):
+    """
+    `normalize_total` followed by `log1p`, for sparse input every stored value is scaled and logarithmized in one pass.
+
+    :param x: 2D array, shape (M, N), which row is cells and column is genes.
+    :param target_sum: the number of reads per cell after normalization.
+    :return: the normalized and logarithmized data.
+    """
+    if not issparse(x):
+        nor_x = normalize_total(x, target_sum)
+        return np.log1p(nor_x, out=nor_x)
+    x = x.astype(np.float32).tocsr()
+    counts = np.ravel(x.sum(1))
+    counts_greater_than_zero = counts[counts > 0]
+    target_sum = np.median(counts_greater_than_zero, axis=0) if target_sum is None else target_sum
+    counts += counts == 0
+    row_scale = (target_sum / counts).astype(np.float32)
+    _scale_rows_log1p(x.data, x.indptr, row_scale)
+    return x
+
+
 def quantile_norm(x):
     """
     Normalize the columns of X to each have the same distribution. Given an expression matrix  of M genes by N samples,
@@ -69,6 +100,31 @@ def log1p(x):
     return log_x
 
 
+@nb.njit(cache=True, nogil=True, parallel=True)
+def _disksmooth_mean_std(mean_bin, std_bin, nbr_indptr, nbr_idx):
+    cells_count = mean_bin.shape[0]
+    mean_bins = np.empty_like(mean_bin)
+    std_bins = np.empty_like(std_bin)
+    for i in nb.prange(cells_count):
+        count = 0
+        mean_sum = 0.0
+        std_sum = 0.0
+        for k in range(nbr_indptr[i], nbr_indptr[i + 1]):
+            j = nbr_idx[k]
+            if j == i:
+                continue
+            mean_sum += mean_bin[j]
+            std_sum += std_bin[j]
+            count += 1
+        if count > 0:
+            mean_bins[i] = mean_sum / count
+            std_bins[i] = std_sum / count
+        else:
+            mean_bins[i] = mean_bin[i]
+            std_bins[i] = std_bin[i]
+    return mean_bins, std_bins
+
+
 def zscore_disksmooth(x, position, r):
     """
     for each position, given a radius, calculate the z-score within this circle as final normalized value.
@@ -80,20 +136,13 @@ def zscore_disksmooth(x, position, r):
     """
     position = position.astype(np.int32)
     point_tree = spatial.cKDTree(position)
-    x = x.astype(np.float32)
-    mean_bin = x.mean(1)
-    mean_bin = np.array(mean_bin)
+    x = x.astype(np.float32, copy=False)
+    mean_bin = np.asarray(x.mean(1)).reshape(-1)
     std_bin = np.std(x, axis=1)
-    zscore = []
-    for i in range(len(position)):
-        current_neighbor = point_tree.query_ball_point(position[i], r)
-        current_neighbor.remove(i)
-        if len(current_neighbor) > 0:
-            mean_bins = np.mean(mean_bin[current_neighbor])
-            std_bins = np.mean(std_bin[current_neighbor])
-            zscore.append((x[i] - mean_bins) / std_bins + 1)
-        else:
-            mean_bins = mean_bin[i]
-            std_bins = std_bin[i]
-            zscore.append((x[i] - mean_bins) / std_bins + 1)
-    return np.array(zscore)
+    # neighbors of every cell flattened into csr-like (indptr, indices), the cell itself is skipped in the kernel
+    neighbors = point_tree.query_ball_point(position, r, workers=-1)
+    nbr_indptr = np.zeros(len(neighbors) + 1, dtype=np.int64)
+    np.cumsum([len(n) for n in neighbors], out=nbr_indptr[1:])
+    nbr_idx = np.fromiter((j for n in neighbors for j in n), dtype=np.int64, count=nbr_indptr[-1])
+    mean_bins, std_bins = _disksmooth_mean_std(mean_bin, std_bin, nbr_indptr, nbr_idx)
+    return (x - mean_bins[:, np.newaxis]) / std_bins[:, np.newaxis] + 1
@@ -17,27 +17,28 @@ from ..log_manager import logger
 
 
 @singledispatch
-def scale(x, zero_center, max_value):
+def scale(x, zero_center, max_value, mean_var=None):
     """
         Scale the data to unit variance and zero mean.
 
         :param x: 2D array, shape (M, N), which row is cells and column is genes.
         :param zero_center: Ignore zero variables if `False`
         :param max_value: Truncate to this value after scaling. If `None`, do not truncate.
+        :param mean_var: precomputed means and variances of the genes, computed from `x` if `None`.
         :return: the scaled data.
     """
-    return scale_array(x, zero_center=zero_center, max_value=max_value)
+    return scale_array(x, zero_center=zero_center, max_value=max_value, mean_var=mean_var)
 
 
 @scale.register(np.ndarray)
-def scale_array(x, zero_center, max_value):
+def scale_array(x, zero_center, max_value, mean_var=None):
     if not zero_center and max_value is not None:
         logger.info('Be careful when using `max_value` without `zero_center` is False')
 
     if np.issubdtype(x.dtype, np.integer):
         x = x.astype(float)
 
-    mean, var = _get_mean_var(x)
+    mean, var = _get_mean_var(x) if mean_var is None else mean_var
     std = np.sqrt(var)
     std[std == 0] = 1
     if issparse(x):
@@ -57,10 +58,10 @@ def scale_array(x, zero_center, max_value):
 
 
 @scale.register(spmatrix)
-def scale_sparse(x, zero_center, max_value):
+def scale_sparse(x, zero_center, max_value, mean_var=None):
     if zero_center:
         x = x.toarray()
-    return scale_array(x, zero_center=zero_center, max_value=max_value)
+    return scale_array(x, zero_center=zero_center, max_value=max_value, mean_var=mean_var)
 
 
 def _get_mean_var(x, *, axis=0):
@@ -65,13 +65,22 @@ def make_cell_attr(umi, cells, latent_var, batch_var, latent_var_nonreg) -> pd.D
 def fit_poisson(umi, model_str, data, theta_estimation_fun="theta.ml") -> pd.DataFrame:
     # TODO: ignore `theta_estimation_fun`
     regressor_data = dmatrix("~log_umi", data, return_type='dataframe')
-    results = Parallel(n_jobs=cpu_count(), backend="threading")(
-        delayed(one_row_fit_poission)(regressor_data, y.toarray()[0], theta_estimation_fun)
-        for y in umi
+    # the per gene fits run in object mode and hold the GIL, so the genes are split into one batch per
+    # process instead of being dispatched one by one to threads
+    n_jobs = max(1, min(cpu_count(), umi.shape[0]))
+    bounds = np.linspace(0, umi.shape[0], n_jobs + 1, dtype=int)
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(_fit_poisson_batch)(regressor_data, umi[start:end], theta_estimation_fun)
+        for start, end in zip(bounds[:-1], bounds[1:])
     )
+    results = [r for batch in results for r in batch]
     return pd.DataFrame(results, columns=["theta", "Intercept", "log_umi"])
 
 
+def _fit_poisson_batch(regressor_data, umi, theta_estimation_fun):
+    return [one_row_fit_poission(regressor_data, y.toarray()[0], theta_estimation_fun) for y in umi]
+
+
 @numba.jit(cache=True, forceobj=True, nogil=True)
 def one_row_fit_poission(regressor_data, y, theta_estimation_fun='theta.ml'):
     fit = qpois_reg(regressor_data.to_numpy(), y, 1e-9, 100, 1.0001, True)
@@ -1,3 +1,4 @@
+import copy
 import time
 from collections import defaultdict
 from operator import itemgetter
@@ -10,14 +11,17 @@ from cusingler import cusingler
 from joblib import (
     Parallel,
     delayed,
-    cpu_count
+    cpu_count,
+    effective_n_jobs
 )
 from tqdm import tqdm
 
 from stereo.core.stereo_exp_data import StereoExpData
 from stereo.log_manager import logger
+from stereo.utils.data_helper import _first_index_of
 from .utils import (
     corr_spearman,
+    corr_spearman_percentile,
     apply_along_axis
 )
 from ..algorithm_base import AlgorithmBase
@@ -34,13 +38,6 @@ class _TestData(object):
         return pd.DataFrame(self.exp_matrix.toarray(), index=self.cell_names, columns=self.gene_names)
 
 
-@numba.jit(forceobj=True, nogil=True, parallel=True)
-def _spearman_parallel(label, ranked_mat_ref, y, quantile):
-    ranked_mat_qry = apply_along_axis(y)
-    sim = corr_spearman(ranked_mat_ref, ranked_mat_qry)
-    return label, np.percentile(sim, quantile, axis=1)
-
-
 def _get_label_genes_set(top_labels, trained_data, de_n_len=0):
     de_n = np.round(500 * (2 / 3) ** np.log2(de_n_len if de_n_len else len(top_labels)))
     genes_filtered = []
@@ -48,10 +45,10 @@ def _get_label_genes_set(top_labels, trained_data, de_n_len=0):
         for j in top_labels:
             if i == j:
                 continue
-            s = trained_data[i][j]
-            s = s.loc[s[0] > 0]
-            genes_filtered.append(s.index[:int(de_n)])
-    return genes_filtered
+            genes_filtered.append(trained_data[i][j][:int(de_n)])
+    if not genes_filtered:
+        return np.array([], dtype=object)
+    return np.unique(np.concatenate(genes_filtered))
 
 
 class SingleR(AlgorithmBase):
@@ -64,6 +61,7 @@ class SingleR(AlgorithmBase):
         self.fine_tune_times = None
         self.group_data_frame = None
         self.fine_tune_threshold = None
+        self._ref_mat_by_group = None
 
     def main(
             self,
@@ -157,20 +155,24 @@ class SingleR(AlgorithmBase):
             logger.info(f'training ref finished, cost {time.time() - start_time} seconds')
 
             if cluster_res_key:
-                tmp_exp_matrix = pd.DataFrame(
-                    test_exp_data.exp_matrix.todense() if scipy.sparse.issparse(
-                        test_exp_data.exp_matrix) else test_exp_data.exp_matrix,
-                    index=test_exp_data.cell_names,
-                    columns=test_exp_data.gene_names
-                )
                 test_cluster_result = test_exp_data.tl.result[cluster_res_key]
                 test_group_data_frame = test_cluster_result['group']
                 if 'bins' in test_cluster_result:
                     test_group_data_frame.index = test_cluster_result['bins'].values
-                tmp_exp_matrix = tmp_exp_matrix.groupby(test_group_data_frame).sum()
+                test_groups = pd.Categorical(test_group_data_frame.reindex(test_exp_data.cell_names))
+                # sum up the expression of the cells in each cluster by a sparse indicator matrix
+                cells_flag = test_groups.codes >= 0
+                test_exp_matrix = scipy.sparse.csr_matrix(test_exp_data.exp_matrix)
+                cluster_indicator = scipy.sparse.csr_matrix(
+                    (
+                        np.ones(np.count_nonzero(cells_flag), dtype=test_exp_matrix.dtype),
+                        (test_groups.codes[cells_flag], np.flatnonzero(cells_flag))
+                    ),
+                    shape=(test_groups.categories.size, test_exp_matrix.shape[0])
+                )
                 test_data = _TestData(
-                    scipy.sparse.csr_matrix(tmp_exp_matrix.values),
-                    tmp_exp_matrix.index,
+                    scipy.sparse.csr_matrix(cluster_indicator @ test_exp_matrix),
+                    test_groups.categories,
                     np.array(range(len(test_exp_data.gene_names)))
                 )
             else:
@@ -188,6 +190,8 @@ class SingleR(AlgorithmBase):
             logger.info('start fine-tuning...')
             start_time = time.time()
             ret_labels = self._fine_tune(test_data, output, trained_data)
+            # the dense reference of each label is only needed while scoring and fine-tuning
+            self._ref_mat_by_group = None
             logger.info(f'fine-tuning finished, cost {time.time() - start_time} seconds')
             bins = test_data.cell_names if cluster_res_key else test_exp_data.cell_names
 
@@ -231,51 +235,60 @@ class SingleR(AlgorithmBase):
 
     def _train_ref(self):
         dict_of_median_exp = dict()
+        # the dense expression of each label is kept for fine-tuning
+        self._ref_mat_by_group = dict()
+        cell_names_index = pd.Index(self.ref_exp_data.cell_names)
         for label, y in self.group_data_frame.groupby('group'):
-            cells_bool_list = np.isin(self.ref_exp_data.cell_names, y['bins'].values)
-            dict_of_median_exp[label] = pd.DataFrame(
-                np.median(self.ref_exp_data.exp_matrix[cells_bool_list].toarray(), axis=0))
-        median_exp = pd.concat(dict_of_median_exp, axis=1)
-        median_exp.index = self.ref_gene_names
+            if cell_names_index.is_unique:
+                cells_index = cell_names_index.get_indexer(y['bins'].values)
+                cells_index = cells_index[cells_index >= 0]
+            else:
+                # get_indexer can not handle duplicate names, every cell matching the group's bins is kept
+                cells_index = np.flatnonzero(np.isin(self.ref_exp_data.cell_names, y['bins'].values))
+            self._ref_mat_by_group[label] = self.ref_exp_data.exp_matrix[cells_index].toarray()
+            dict_of_median_exp[label] = np.median(self._ref_mat_by_group[label], axis=0)
 
         ret_all = defaultdict(dict)
         ret_gene = defaultdict(dict)
 
         ct = self.group_data_frame['group'].astype('category').cat.categories
-        de_n = np.round(500 * (2 / 3) ** np.log2(len(ct)))
-        for i in ct:
-            for j in ct:
+        de_n = int(np.round(500 * (2 / 3) ** np.log2(len(ct))))
+        median_exp = np.stack([dict_of_median_exp[i] for i in ct], axis=1)
+        gene_names = self.ref_gene_names.values
+        for ci, i in enumerate(ct):
+            # genes sorted by the descending differences of median expression between `i` and each other label,
+            # the stable sort keeps the genes with the same difference in their original order
+            diff = (median_exp[:, [ci]] - median_exp).round(6)
+            order = np.argsort(-diff, axis=0, kind='stable')
+            sorted_diff = np.take_along_axis(diff, order, axis=0)
+            for cj, j in enumerate(ct):
                 if i == j:
                     continue
-
-                ret_all[i][j] = median_exp[i] - median_exp[j]
-                ret_tmp = pd.DataFrame(ret_all[i][j]).round(6)
-                ret_tmp['arg'] = [x for x in range(ret_tmp.shape[0])][::-1]
-                ret_all[i][j] = ret_tmp.sort_values([0, 'arg'], ascending=False)
-                ret_gene[i][j] = ret_all[i][j].index[:int(de_n)]
+                ret_all[i][j] = gene_names[order[:, cj][sorted_diff[:, cj] > 0]]
+                ret_gene[i][j] = gene_names[order[:de_n, cj]]
 
         return ret_all, np.unique([y for x in ret_gene.values() for y in x.values()])
 
     def _score_test_data(self, test_data, common_gene):
-        original_exp = {}
-        tmp_gene_names = self.ref_gene_names.tolist()
         test_data_length = test_data.exp_matrix.shape[1]
-        common_gene_index = []
-        for com in common_gene:
-            index = tmp_gene_names.index(com)
-            if index < test_data_length:
-                common_gene_index.append(index)
-
-        for x, y in self.group_data_frame.groupby('group'):
-            y_cell_bool_list = np.isin(self.ref_exp_data.cell_names, y['bins'].values)
-            original_exp[x] = self.ref_exp_data.exp_matrix[y_cell_bool_list][:, common_gene_index].toarray()
+        common_gene_index = _first_index_of(self.ref_gene_names, common_gene, 'gene')
+        common_gene_index = common_gene_index[common_gene_index < test_data_length]
+
+        original_exp = {x: ref_mat[:, common_gene_index] for x, ref_mat in self._ref_mat_by_group.items()}
         test_mat = test_data.exp_matrix[:, common_gene_index].toarray()
-        ranked_mat_ref = apply_along_axis(test_mat.T)
 
-        res_dict = dict(Parallel(n_jobs=self.n_jobs, backend="threading")(
-            delayed(_spearman_parallel)(label, ranked_mat_ref, y.T, self.quantile)
-            for label, y in tqdm(original_exp.items())
-        ))
+        # ranking and correlation are numba kernels parallelized inside, so the labels are scored one by one
+        # with `n_jobs` numba threads instead of running the kernels concurrently in a thread pool
+        current_jobs = numba.get_num_threads()
+        numba.set_num_threads(max(1, min(effective_n_jobs(self.n_jobs), numba.config.NUMBA_NUM_THREADS)))
+        try:
+            ranked_mat_ref = apply_along_axis(test_mat.T)
+            res_dict = {}
+            for label, y in tqdm(original_exp.items()):
+                sim = corr_spearman(ranked_mat_ref, apply_along_axis(y.T))
+                res_dict[label] = np.percentile(sim, self.quantile, axis=1)
+        finally:
+            numba.set_num_threads(current_jobs)
 
         ret = pd.DataFrame(res_dict, index=test_data.cell_names)
         return ret, ret.columns[np.argmax(ret.values, axis=1)]
@@ -285,72 +298,92 @@ class SingleR(AlgorithmBase):
         tmp[tmp < np.array(np.max(output.values, axis=1) - self.fine_tune_threshold).reshape([-1, 1])] = 0
         tmp[tmp > 0] = 1
 
-        ref = pd.DataFrame(
-            self.ref_exp_data.exp_matrix.toarray(),
-            index=self.ref_exp_data.cell_names,
-            columns=self.ref_exp_data.gene_names
-        )
+        labels_flag = tmp.astype(bool)
 
         logger.info(f'fine-tuning with test_data(shape={test_data.exp_matrix.shape})')
 
-        ret_labels = Parallel(n_jobs=self.n_jobs, backend="threading")(
-            delayed(self._fine_tune_parallel)(
-                ref,
-                output.columns[tmp[x].astype(bool)].values,
-                y[1].to_frame().T,
-                trained_data
+        # only the attributes used by fine-tuning are sent to the worker processes
+        fine_tuner = copy.copy(self)
+        fine_tuner.stereo_exp_data = fine_tuner.pipeline_res = fine_tuner.ref_exp_data = None
+        n_jobs = effective_n_jobs(self.n_jobs)
+        # the cores are shared out between the worker processes, each runs the numba kernels with its own share
+        numba_threads = max(1, min(numba.config.NUMBA_NUM_THREADS, cpu_count() // n_jobs))
+        chunks = [
+            chunk for chunk in np.array_split(np.arange(test_data.exp_matrix.shape[0]), n_jobs * 4)
+            if chunk.size > 0
+        ]
+        ret_labels = Parallel(n_jobs=n_jobs, backend="loky")(
+            delayed(fine_tuner._fine_tune_chunk)(
+                test_data.exp_matrix[chunk],
+                output.columns.values,
+                labels_flag[chunk],
+                trained_data,
+                numba_threads
             )
-            for x, y in tqdm(enumerate(test_data.to_df().iterrows()))
+            for chunk in tqdm(chunks)
         )
-        return ret_labels
-
-    def _fine_tune_parallel(self, ref, labels, y, trained_data):
+        return [label for chunk_labels in ret_labels for label in chunk_labels]
+
+    def _fine_tune_chunk(self, test_exp_matrix, labels, labels_flag, trained_data, numba_threads):
+        test_mat = test_exp_matrix.toarray()
+        # most test cells share a few candidate label sets, rank the reference only once for each of them
+        ranked_ref_cache = {}
+        current_threads = numba.get_num_threads()
+        numba.set_num_threads(numba_threads)
+        try:
+            return [
+                self._fine_tune_parallel(labels[labels_flag[i]], test_mat[i:i + 1], trained_data, ranked_ref_cache)
+                for i in range(test_mat.shape[0])
+            ]
+        finally:
+            numba.set_num_threads(current_threads)
+
+    def _fine_tune_parallel(self, labels, y, trained_data, ranked_ref_cache):
         if self.fine_tune_times:
             try_num = 0
             while try_num < self.fine_tune_times and len(labels) > 1:
-                labels = self._fine_tune_one_time(labels, ref, y, trained_data, try_num)
+                labels = self._fine_tune_one_time(labels, y, trained_data, ranked_ref_cache, try_num)
                 try_num += 1
         else:
             while len(labels) > 1:
-                labels = self._fine_tune_one_time(labels, ref, y, trained_data)
+                labels = self._fine_tune_one_time(labels, y, trained_data, ranked_ref_cache)
         return labels[0]
 
-    @numba.jit(forceobj=True, nogil=True, parallel=True)
-    def _fine_tune_one_time(self, top_labels, ref, test, trained_data, try_num=None):
+    def _rank_ref_by_labels(self, top_labels, test_data_length, trained_data):
         genes_filtered = _get_label_genes_set(top_labels, trained_data)
-        genes_filtered = np.unique([y for x in genes_filtered for y in x])
         if len(genes_filtered) < 20:
+            return None, None
+
+        genes_filtered_index = np.array([self.test_gene_names.get(gen, -1) for gen in genes_filtered], dtype=np.int64)
+        genes_filtered_index = genes_filtered_index[genes_filtered_index >= 0]
+        test_genes_filtered_index = genes_filtered_index[genes_filtered_index < test_data_length]
+        ref_genes_filtered_index = genes_filtered_index[genes_filtered_index < len(self.ref_gene_names)]
+
+        top_labels = set(top_labels)
+        ranked_ref_by_group = {}
+        for p, ref_mat in self._ref_mat_by_group.items():
+            if p in top_labels:
+                ranked_ref_by_group[p] = apply_along_axis(ref_mat[:, ref_genes_filtered_index].T)
+        return test_genes_filtered_index, ranked_ref_by_group
+
+    def _fine_tune_one_time(self, top_labels, test, trained_data, ranked_ref_cache, try_num=None):
+        labels_key = frozenset(top_labels)
+        if labels_key not in ranked_ref_cache:
+            ranked_ref_cache[labels_key] = self._rank_ref_by_labels(top_labels, test.shape[1], trained_data)
+        test_genes_filtered_index, ranked_ref_by_group = ranked_ref_cache[labels_key]
+        if test_genes_filtered_index is None:
             return [top_labels[0]]
 
-        test_data_length = test.shape[1]
-        ref_data_length = ref.shape[1]
-        test_genes_filtered_index = []
-        ref_genes_filtered_index = []
-        for gen in genes_filtered:
-            index = self.test_gene_names.get(gen, None)
-            if index is None:
-                continue
-            if test_data_length > index:
-                test_genes_filtered_index.append(index)
-            if ref_data_length > index:
-                ref_genes_filtered_index.append(index)
-        test_filtered = test.loc[:, test_genes_filtered_index].values
+        test_filtered = test[:, test_genes_filtered_index]
         if np.std(test_filtered) <= 0:
             return [top_labels[0]]
 
-        bool_list = np.isin(self.group_data_frame['group'].values, top_labels)
-        ref_filtered = ref.loc[bool_list, ref_genes_filtered_index]
-        group_data_frame_filtered = self.group_data_frame.loc[bool_list].reset_index()
-
-        ranked_mat_ref = apply_along_axis(test_filtered.T)
+        test_filtered = test_filtered[0]
         res_labels = {}
-        for p, q in group_data_frame_filtered.groupby('group'):
-            ref_filtered_by_group = ref_filtered.iloc[q.index].values.T
-            ranked_mat_qry = apply_along_axis(ref_filtered_by_group)
-            sim = corr_spearman(ranked_mat_ref, ranked_mat_qry)
-            if not (sim.shape and sim.shape[0] and sim.shape[1]):
+        for p, ranked_mat_qry in ranked_ref_by_group.items():
+            if not ranked_mat_qry.shape[1]:
                 continue
-            res_labels[p] = np.percentile(sim, self.quantile, axis=1)[0]
+            res_labels[p] = corr_spearman_percentile(ranked_mat_qry, test_filtered, self.quantile)
 
         if not res_labels:
             return [top_labels[0]]
@@ -25,6 +25,33 @@ def corr_spearman(ranked_mat_ref: np.ndarray, ranked_mat_qry: np.ndarray):
     return result
 
 
+@numba.njit(cache=True, fastmath=True, nogil=True)
+def corr_spearman_percentile(ranked_mat_ref: np.ndarray, vector_qry: np.ndarray, quantile: float):
+    """
+    Rank `vector_qry` then get the `quantile` percentile of its spearman correlations with each column of
+    `ranked_mat_ref`.
+    """
+    ranked_qry = rankdata1d(vector_qry)
+    n, k = ranked_mat_ref.shape[0], ranked_mat_ref.shape[1]
+    mean = (n + 1) / 2.
+    result = np.empty(k, dtype=np.float32)
+    for yi in range(k):
+        sum_x = sum_xx = sum_yy = 0
+        for i in range(n):
+            vx = ranked_qry[i] - mean
+            vy = ranked_mat_ref[i, yi] - mean
+
+            sum_x += vx * vy
+            sum_xx += vx * vx
+            sum_yy += vy * vy
+        divisor = np.sqrt(sum_xx * sum_yy)
+        if divisor != 0:
+            result[yi] = sum_x / divisor
+        else:
+            result[yi] = np.nan
+    return np.percentile(result, quantile)
+
+
 @numba.njit(cache=True, fastmath=True, nogil=True)
 def rankdata1d(a: np.ndarray) -> np.ndarray:
     arr = np.ravel(a)
@@ -10,10 +10,9 @@
 change log:
     2021/10/14 create file.
 """
-import copy
-
 import hotspot
 import pandas as pd
+from scipy.sparse import issparse
 
 from ..log_manager import logger
 
@@ -42,9 +41,11 @@ def spatial_hotspot(data, model='normal', n_neighbors=30, n_jobs=20, fdr_thresho
 
     """
 
-    hit_data = copy.deepcopy(data)
-    counts = hit_data.to_df().T  # gene x cell
-    pos = pd.DataFrame(hit_data.position, index=counts.columns)  # cell name as index
+    counts = data.to_df().T  # gene x cell
+    if not issparse(data.exp_matrix):
+        # a dense matrix is wrapped without a copy, keep hotspot away from the caller's data
+        counts = counts.copy()
+    pos = pd.DataFrame(data.position, index=counts.columns)  # cell name as index
     num_umi = counts.sum(axis=0)  # total counts per cell
     # Create the Hotspot object and the neighborhood graph
     logger.info(f'create the Hotspot object with {counts.shape[0]} genes and {counts.shape[1]} cells, model={model}.')
@@ -13,22 +13,38 @@ change log:
 
 import statistics
 
+import numba as nb
 import numpy as np
 import pandas as pd
 import scipy.stats as stats
-from tqdm import tqdm
+from scipy.sparse import csc_matrix
+from scipy.sparse import issparse
 
 
-def spatial_pattern_score(exp_df: pd.DataFrame):
+def spatial_pattern_score(exp_matrix, gene_names=None):
     """
     calculate the spatial pattern score.
-    :param exp_df: dataframe of spatial express matrix which columns is genes, and rows is cells.
+    :param exp_matrix: spatial express matrix which columns is genes, and rows is cells, sparse or dense,
+        or a dataframe of it whose columns are the gene names.
+    :param gene_names: the names of the genes, one for each column of `exp_matrix`, taken from the columns
+        if `exp_matrix` is a dataframe.
     :return:
     """
-    tqdm.pandas(desc="calculating enrichment score")
-    report = exp_df.progress_apply(get_enrichment_score, axis=0)
-    report = report.T.reset_index()
-    report.columns = ['gene', 'E10', 'C50', 'total_count']
+    if isinstance(exp_matrix, pd.DataFrame):
+        if gene_names is None:
+            gene_names = exp_matrix.columns
+        exp_matrix = exp_matrix.to_numpy()
+    if gene_names is None:
+        raise ValueError('gene_names must be given unless exp_matrix is a dataframe.')
+    # the scores only look at the positive counts of each gene, which a csc matrix stores contiguously
+    exp_matrix = exp_matrix.tocsc() if issparse(exp_matrix) else csc_matrix(exp_matrix)
+    e10, c50, total_count = _enrichment_scores(exp_matrix.data.astype(np.float64), exp_matrix.indptr)
+    report = pd.DataFrame({
+        'gene': np.asarray(gene_names),
+        'E10': np.around(e10, 2),
+        'C50': np.around(c50, 2),
+        'total_count': total_count
+    })
     tmp = report[report['total_count'] > 300]
     e10_cutoff = find_cutoff(list(tmp['E10']), 0.9)
     c50_cutoff = find_cutoff(list(tmp['C50']), 0.1)
@@ -44,6 +60,30 @@ def spatial_pattern_score(exp_df: pd.DataFrame):
     return report_out
 
 
+@nb.njit(cache=True, nogil=True, parallel=True)
+def _enrichment_scores(data, indptr):
+    genes_count = indptr.shape[0] - 1
+    e10 = np.full(genes_count, np.nan)
+    c50 = np.full(genes_count, np.nan)
+    total_count = np.zeros(genes_count)
+    for j in nb.prange(genes_count):
+        count_list = data[indptr[j]:indptr[j + 1]]
+        count_list = np.sort(count_list[count_list > 0])[::-1]
+        n = count_list.shape[0]
+        if n == 0:
+            continue
+        total = count_list.sum()
+        total_count[j] = total
+        e10[j] = 100 * count_list[:int(n * 0.1)].sum() / total
+        cdf = 0.0
+        for k in range(n):
+            cdf += count_list[k]
+            if cdf / total > 0.5:
+                c50[j] = k / n * 100
+                break
+    return e10, c50, total_count
+
+
 def get_enrichment_score(gene_expression):
     """
     calculate enrichment score E10 and C50.
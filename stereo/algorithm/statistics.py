@@ -54,7 +54,7 @@ def logreg(x, y, **kwds):
     return res
 
 
-def wilcoxon(group, other_group, corr_method=None, ranks=None, tie_term=None, x_mask=None):
+def wilcoxon(group, other_group, corr_method=None, ranks=None, tie_term=None, x_mask=None, rank_sum=None):
     """
     wilcoxon_test
 
@@ -64,9 +64,10 @@ def wilcoxon(group, other_group, corr_method=None, ranks=None, tie_term=None, x_
     :param ranks:
     :param tie_term:
     :param x_mask:
+    :param rank_sum: precomputed rank sums of `group`.
     :return:
     """
-    s, p = mannwhitneyu(group, other_group, ranks=ranks, tie_term=tie_term, x_mask=x_mask)
+    s, p = mannwhitneyu(group, other_group, ranks=ranks, tie_term=tie_term, x_mask=x_mask, rank_sum=rank_sum)
     result = pd.DataFrame({'scores': s, 'pvalues': p})
     n_genes = result.shape[0]
     if corr_method == 'benjamini-hochberg':
@@ -79,22 +80,36 @@ def wilcoxon(group, other_group, corr_method=None, ranks=None, tie_term=None, x_
     return pd.DataFrame(result)
 
 
-def ttest(group, other_group, corr_method=None):
-    mean_group, var_group = get_mean_var(group)
-    mean_rest, var_rest = get_mean_var(other_group)
+def ttest(group, other_group, corr_method=None, group_stats=None, rest_stats=None):
+    """
+    t-test of `group` against `other_group`
+
+    :param group:
+    :param other_group:
+    :param corr_method:
+    :param group_stats: precomputed (mean, var, nobs) of `group`, `group` is not read if given.
+    :param rest_stats: precomputed (mean, var, nobs) of `other_group`, `other_group` is not read if given.
+    :return:
+    """
+    if group_stats is None:
+        group_stats = (*get_mean_var(group), group.shape[0])
+    if rest_stats is None:
+        rest_stats = (*get_mean_var(other_group), other_group.shape[0])
+    mean_group, var_group, nobs_group = group_stats
+    mean_rest, var_rest, nobs_rest = rest_stats
     with np.errstate(invalid="ignore"):
         scores, pvals = stats.ttest_ind_from_stats(
             mean1=mean_group,
             std1=np.sqrt(var_group),
-            nobs1=group.shape[0],
+            nobs1=nobs_group,
             mean2=mean_rest,
             std2=np.sqrt(var_rest),
-            nobs2=other_group.shape[0],
+            nobs2=nobs_rest,
             equal_var=False,  # Welch's
         )
     scores[np.isnan(scores)] = 0
     pvals[np.isnan(pvals)] = 1
-    n_genes = group.shape[1]
+    n_genes = mean_group.shape[0]
     pvals_adj = corr_pvalues(pvals, corr_method, n_genes)
     result = {'scores': scores, 'pvalues': pvals}
     if pvals_adj is not None:
@@ -1,8 +1,8 @@
+import numba as nb
 import numpy as np
 import pandas as pd
 
 from stereo.algorithm.algorithm_base import AlgorithmBase
-from stereo.constant import AlternativeType
 from stereo.constant import FEATURE_P
 from stereo.constant import FUZZY_C_RESULT
 from stereo.constant import FUZZY_C_WEIGHT
@@ -17,6 +17,47 @@ from stereo.constant import SCORES
 from stereo.constant import UseColType
 
 
+@nb.njit(cache=True, nogil=True, parallel=True, fastmath=True)
+def _fuzzy_c_step(data: np.ndarray, C: np.ndarray, U: np.ndarray, m: float):
+    n_obs, n_features = data.shape
+    cluster_number = C.shape[0]
+
+    # squared euclidean distances, membership exponent halved accordingly;
+    # sum_k (d_c / d_k) ** p == d_c ** p * sum_k d_k ** -p, so U is just the normalized d ** -p
+    power = 1.0 / (m - 1)
+    U_new = np.empty((n_obs, cluster_number), dtype=np.float64)
+    row_delta = np.empty(n_obs, dtype=np.float64)
+    for n in nb.prange(n_obs):
+        inv = np.empty(cluster_number, dtype=np.float64)
+        zeros_count = 0
+        for c in range(cluster_number):
+            d = 0.0
+            for f in range(n_features):
+                diff = data[n, f] - C[c, f]
+                d += diff * diff
+            inv[c] = d
+            if d == 0:
+                zeros_count += 1
+        if zeros_count > 0:
+            # observation sits on a center, membership goes entirely to the coincident center(s)
+            for c in range(cluster_number):
+                inv[c] = 1.0 if inv[c] == 0 else 0.0
+            inv_sum = float(zeros_count)
+        else:
+            inv_sum = 0.0
+            for c in range(cluster_number):
+                inv[c] = inv[c] ** -power
+                inv_sum += inv[c]
+        # largest membership change of this row, reduced to the epoch loss afterwards
+        delta = 0.0
+        for c in range(cluster_number):
+            u = inv[c] / inv_sum
+            delta = max(delta, abs(u - U[n, c]))
+            U_new[n, c] = u
+        row_delta[n] = delta
+    return U_new, row_delta.max()
+
+
 class TimeSeriesAnalysis(AlgorithmBase):
 
     def main(
@@ -68,57 +109,70 @@ class TimeSeriesAnalysis(AlgorithmBase):
         :param p_val_combination: p_value combination method to use, choosing from ['fisher', 'mean', 'FDR']
         :return: stereo_exp_data contains Time Variabel Gene marker result
         """
-        from scipy.stats import ttest_ind
+        from joblib import Parallel, cpu_count, delayed
         from scipy import sparse
         from scipy import stats
-        label2exp = {}
-        for x in branch:
-            cell_list = self.stereo_exp_data.cells.to_df().loc[self.stereo_exp_data.cells[use_col] == x,].index
-            test_exp_data = self.stereo_exp_data.sub_by_name(cell_name=cell_list.to_list())
-            if sparse.issparse(test_exp_data.exp_matrix):
-                label2exp[x] = test_exp_data.exp_matrix.todense()
-            else:
-                label2exp[x] = np.mat(test_exp_data.exp_matrix)
+        from stereo.utils.hvg_utils import get_mean_var
+        labels = np.asarray(self.stereo_exp_data.cells[use_col])
+        exp_matrix = self.stereo_exp_data.exp_matrix
+
+        def _label_stats(x):
+            test_exp_matrix = exp_matrix[np.flatnonzero(labels == x)]
+            if not sparse.issparse(test_exp_matrix):
+                test_exp_matrix = np.asarray(test_exp_matrix)
+            mean, var = get_mean_var(test_exp_matrix)
+            return mean, np.maximum(var, 0), test_exp_matrix.shape[0]
 
-        logFC = []
-        less_pvalue = []
-        greater_pvalue = []
-        scores = []
-        for i in range(len(branch) - 1):
-            score, pvalue = ttest_ind(label2exp[branch[i + 1]], label2exp[branch[i]], axis=0,
-                                      alternative=AlternativeType.less.value)
-            less_pvalue.append(np.nan_to_num(pvalue, nan=1, copy=False))
-            score, pvalue = ttest_ind(label2exp[branch[i + 1]], label2exp[branch[i]], axis=0,
-                                      alternative=AlternativeType.greater.value)
-            greater_pvalue.append(np.nan_to_num(pvalue, nan=1, copy=False))
-            logFC.append(np.array(np.log2(
-                (np.mean(label2exp[branch[i + 1]], axis=0) + 1e-9) / (np.mean(label2exp[branch[i]], axis=0) + 1e-9)))[
-                             0])
-            scores.append(score)
-        self.stereo_exp_data.genes_matrix[SCORES] = np.array(scores).T
-        self.stereo_exp_data.genes_matrix[SCORES] = np.nan_to_num(self.stereo_exp_data.genes_matrix[SCORES])
-        self.stereo_exp_data.genes_matrix[GREATER_P] = np.array(greater_pvalue).T
-        self.stereo_exp_data.genes_matrix[LESS_P] = np.array(less_pvalue).T
-        logFC = np.array(logFC).T
+        # branch labels are independent, the per-label slicing and mean/var kernels release the GIL
+        n_jobs = max(1, min(cpu_count(), len(branch)))
+        label2stats = dict(zip(branch, Parallel(n_jobs=n_jobs, backend='threading')(
+            delayed(_label_stats)(x) for x in branch
+        )))
+
+        n_pairs = len(branch) - 1
+        # per-pair results are only thresholded and combined downstream, float32 halves their footprint
+        shape = (exp_matrix.shape[1], n_pairs)
+        logFC = np.empty(shape, dtype=np.float32)
+        less_p = np.empty(shape, dtype=np.float32)
+        greater_p = np.empty(shape, dtype=np.float32)
+        scores = np.empty(shape, dtype=np.float32)
+        for i in range(n_pairs):
+            mean1, var1, nobs1 = label2stats[branch[i + 1]]
+            mean2, var2, nobs2 = label2stats[branch[i]]
+            # Student's t-test, both one-sided p-values derived from the same statistic
+            df = nobs1 + nobs2 - 2
+            with np.errstate(divide='ignore', invalid='ignore'):
+                pooled_var = ((nobs1 - 1) * var1 + (nobs2 - 1) * var2) / df
+                score = (mean1 - mean2) / np.sqrt(pooled_var * (1.0 / nobs1 + 1.0 / nobs2))
+            less_p[:, i] = np.nan_to_num(stats.t.cdf(score, df), nan=1, copy=False)
+            greater_p[:, i] = np.nan_to_num(stats.t.sf(score, df), nan=1, copy=False)
+            logFC[:, i] = np.log2((mean1 + 1e-9) / (mean2 + 1e-9))
+            scores[:, i] = score
+        self.stereo_exp_data.genes_matrix[SCORES] = np.nan_to_num(scores, copy=False)
+        self.stereo_exp_data.genes_matrix[GREATER_P] = greater_p
+        self.stereo_exp_data.genes_matrix[LESS_P] = less_p
 
         self.stereo_exp_data.genes_matrix[LOG_FC] = logFC
         logFC = np.mean(logFC, axis=1)
 
         if p_val_combination == PValCombinationType.mean.value:
-            less_pvalue = np.mean(np.array(less_pvalue), axis=0)
-            greater_pvalue = np.mean(np.array(greater_pvalue), axis=0)
+            less_pvalue = np.mean(less_p, axis=1)
+            greater_pvalue = np.mean(greater_p, axis=1)
         elif p_val_combination == PValCombinationType.fisher.value:
-            tmp = self.stereo_exp_data.genes_matrix[LESS_P].copy()
-            tmp[tmp == 0] = np.min(tmp[tmp != 0])
-            tmp = np.sum(-2 * np.log(tmp), axis=1)
-            less_pvalue = 1 - stats.chi2.cdf(tmp, self.stereo_exp_data.genes_matrix[LESS_P].shape[1])
-            tmp = self.stereo_exp_data.genes_matrix[GREATER_P].copy()
-            tmp[tmp == 0] = np.min(tmp[tmp != 0])
-            tmp = np.sum(-2 * np.log(tmp), axis=1)
-            greater_pvalue = 1 - stats.chi2.cdf(tmp, self.stereo_exp_data.genes_matrix[GREATER_P].shape[1])
+            # zeros are clipped to the smallest non-zero p-value, chi-square with 2k degrees of freedom
+            pvalues = self.stereo_exp_data.genes_matrix[LESS_P]
+            positive = pvalues > 0
+            tmp = -2.0 * np.log(np.where(positive, pvalues, pvalues[positive].min())).sum(axis=1)
+            less_pvalue = stats.chi2.sf(tmp, 2 * pvalues.shape[1])
+            pvalues = self.stereo_exp_data.genes_matrix[GREATER_P]
+            positive = pvalues > 0
+            tmp = -2.0 * np.log(np.where(positive, pvalues, pvalues[positive].min())).sum(axis=1)
+            greater_pvalue = stats.chi2.sf(tmp, 2 * pvalues.shape[1])
         elif p_val_combination == PValCombinationType.fdr.value:
-            less_pvalue = 1 - np.prod(1 - self.stereo_exp_data.genes_matrix[LESS_P], axis=1)
-            greater_pvalue = 1 - np.prod(1 - self.stereo_exp_data.genes_matrix[GREATER_P], axis=1)
+            # 1 - prod(1 - p) evaluated as -expm1(sum(log1p(-p))) so it does not round to 1 for tiny p
+            with np.errstate(divide='ignore'):
+                less_pvalue = -np.expm1(np.log1p(-self.stereo_exp_data.genes_matrix[LESS_P]).sum(axis=1))
+                greater_pvalue = -np.expm1(np.log1p(-self.stereo_exp_data.genes_matrix[GREATER_P]).sum(axis=1))
         self.stereo_exp_data.genes[LESS_PVALUE] = less_pvalue
         self.stereo_exp_data.genes[GREATER_PVALUE] = greater_pvalue
         self.stereo_exp_data.genes[LOG_FC] = logFC
@@ -135,40 +189,25 @@ class TimeSeriesAnalysis(AlgorithmBase):
         """
         assert m > 1
         import time
-        import copy
-        from scipy import spatial
+        data = np.ascontiguousarray(data, dtype=np.float64)
         U = np.random.randint(1, int(MAX), (len(data), cluster_number))
         U = U / np.sum(U, axis=1, keepdims=True)
+        U1 = np.empty_like(U)
         epoch = 0
         tik = time.time()
         while True:
             epoch += 1
-            U_old = copy.deepcopy(U)
-            U1 = U ** m
-            U2 = np.expand_dims(U1, axis=2)
-            U2 = np.repeat(U2, data.shape[1], axis=2)
-            data1 = np.expand_dims(data, axis=1)
-            data1 = np.repeat(data1, cluster_number, axis=1)
-            dummy_sum_num = np.sum(U2 * data1, axis=0)
-            dummy_sum_dum = np.sum(U1, axis=0)
-            C = (dummy_sum_num.T / dummy_sum_dum).T
-
-            # initializing distance matrix
-            distance_matrix = spatial.distance_matrix(data, C)
-
-            # update U
-            distance_matrix_1 = np.expand_dims(distance_matrix, axis=1)
-            distance_matrix_1 = np.repeat(distance_matrix_1, cluster_number, axis=1)
-            distance_matrix_2 = np.expand_dims(distance_matrix, axis=2)
-            distance_matrix_2 = np.repeat(distance_matrix_2, cluster_number, axis=2)
-
-            U = np.sum((distance_matrix_1 / distance_matrix_2) ** (2 / (m - 1)), axis=1)
-            U = 1 / U
+            if m == 2:
+                np.multiply(U, U, out=U1)
+            else:
+                np.power(U, m, out=U1)
+            # cluster centers weighted by U ** m
+            C = (U1.T @ data) / U1.sum(axis=0)[:, None]
+            U, loss = _fuzzy_c_step(data, C, U, float(m))
             if epoch % 100 == 0:
-                print('epoch {} : time cosumed{:.4f}s, loss:{}'.format(epoch, time.time() - tik,
-                                                                       np.max(np.abs(U - U_old))))
+                print('epoch {} : time cosumed{:.4f}s, loss:{}'.format(epoch, time.time() - tik, loss))
                 tik = time.time()
-            if np.max(np.abs(U - U_old)) < Epsilon:
+            if loss < Epsilon:
                 break
         return U
 
@@ -221,13 +260,10 @@ class TimeSeriesAnalysis(AlgorithmBase):
                 print('greater_p and less_p not in stereo_exp_data.genes_matrix, you should run get_gene_pattern first')
             else:
                 self.TVG_marker(use_col=use_col, branch=branch)
-        sig = ((1 - self.stereo_exp_data.genes_matrix[GREATER_P]) >= (
-                1 - self.stereo_exp_data.genes_matrix[LESS_P])).astype(
-            int)
-        sig[sig == 0] = -1
-        self.stereo_exp_data.genes_matrix[FEATURE_P] = np.max(
-            [(1 - self.stereo_exp_data.genes_matrix[GREATER_P]), (1 - self.stereo_exp_data.genes_matrix[LESS_P])],
-            axis=0) * sig
+        greater_feature = 1 - self.stereo_exp_data.genes_matrix[GREATER_P]
+        less_feature = 1 - self.stereo_exp_data.genes_matrix[LESS_P]
+        self.stereo_exp_data.genes_matrix[FEATURE_P] = np.where(
+            greater_feature >= less_feature, greater_feature, -less_feature)
 
         # filtter useless gene
         useful_index_1 = (
@@ -2,6 +2,10 @@ from warnings import warn
 
 import pandas as pd
 from anndata import AnnData
+from scipy.sparse import (
+    csr_matrix,
+    issparse
+)
 
 
 class _BaseResult(object):
@@ -16,6 +20,11 @@ class _BaseResult(object):
 
     RENAME_DICT = {'highly_variable_genes': 'hvg', 'marker_genes': 'rank_genes_groups'}
 
+    # named columns of per-gene or per-group frames, a frame holding any of them is never guessed as a reduce result
+    NOT_REDUCE_COLUMNS = frozenset({
+        'means', 'dispersions', 'dispersions_norm', 'variances', 'variances_norm', 'highly_variable', 'group', 'bins'
+    })
+
     CLUSTER, CONNECTIVITY, REDUCE, HVG, MARKER_GENES = 0, 1, 2, 3, 4
     TYPE_NAMES_DICT = {
         CLUSTER: CLUSTER_NAMES,
@@ -25,6 +34,41 @@ class _BaseResult(object):
         MARKER_GENES: MARKER_GENES_NAMES
     }
 
+    # flat lookups derived from TYPE_NAMES_DICT, kept in sync by `_add_name`
+    NAME_TYPES_DICT = {}
+    LIKE_NAME_TYPES = []
+
+    @staticmethod
+    def _build_name_types():
+        name_types_dict = {}
+        like_name_types = []
+        for name_type, name_dict in _BaseResult.TYPE_NAMES_DICT.items():
+            for name in name_dict:
+                name_types_dict.setdefault(name, []).append(name_type)
+                like_name_types.append((name, name_type))
+        _BaseResult.NAME_TYPES_DICT = name_types_dict
+        _BaseResult.LIKE_NAME_TYPES = like_name_types
+
+    @staticmethod
+    def _add_name(name_type, name):
+        name_dict = _BaseResult.TYPE_NAMES_DICT[name_type]
+        if name not in name_dict:
+            name_dict.add(name)
+            _BaseResult._build_name_types()
+
+    def _set_item_by_name(self, key, value):
+        for name_type in self.NAME_TYPES_DICT.get(key, ()):
+            if self._real_set_item(name_type, key, value):
+                return True
+        if not key.startswith('gene_exp_'):
+            for like_name, name_type in self.LIKE_NAME_TYPES:
+                if like_name in key and self._real_set_item(name_type, key, value):
+                    return True
+        return False
+
+
+_BaseResult._build_name_types()
+
 
 class Result(_BaseResult, dict):
 
@@ -58,17 +102,11 @@ class Result(_BaseResult, dict):
             if self.contain_method(item):
                 return True
             # TODO: when get item in ms_data[some_idx].tl.result, if name match the ms_data rule, it is very confused
-        if item in self.__stereo_exp_data.genes:
-            return True
-        elif item in self.__stereo_exp_data.genes_matrix:
-            return True
-        elif item in self.__stereo_exp_data.genes_pairwise:
-            return True
-        elif item in self.__stereo_exp_data.cells:
-            return True
-        elif item in self.__stereo_exp_data.cells_matrix:
+        genes = self.__stereo_exp_data.genes
+        cells = self.__stereo_exp_data.cells
+        if item in genes or item in genes._matrix or item in genes._pairwise:
             return True
-        elif item in self.__stereo_exp_data.cells_pairwise:
+        elif item in cells or item in cells._matrix or item in cells._pairwise:
             return True
         return dict.__contains__(self, item)
 
@@ -157,13 +195,8 @@ class Result(_BaseResult, dict):
         if self.set_item_callback:
             self.set_item_callback(key, value)
             return
-        for name_type, name_dict in Result.TYPE_NAMES_DICT.items():
-            if key in name_dict and self._real_set_item(name_type, key, value):
-                return
-        for name_type, name_dict in Result.TYPE_NAMES_DICT.items():
-            for like_name in name_dict:
-                if not key.startswith('gene_exp_') and like_name in key and self._real_set_item(name_type, key, value):
-                    return
+        if self._set_item_by_name(key, value):
+            return
         if type(value) is pd.DataFrame:
             if 'bins' in value.columns.values and 'group' in value.columns.values:
                 self._set_cluster_res(key, value)
@@ -171,7 +204,8 @@ class Result(_BaseResult, dict):
             elif not {"means", "dispersions", "dispersions_norm", "highly_variable"} - set(value.columns.values):
                 self._set_hvg_res(key, value)
                 return
-            elif len(value.shape) == 2 and value.shape[0] > 399 and value.shape[1] > 399:
+            elif len(value.shape) == 2 and value.shape[0] > 399 and value.shape[1] > 399 and \
+                    not self.NOT_REDUCE_COLUMNS.intersection(value.columns.values):
                 # TODO this is hard-code method to guess it's a reduce ndarray
                 self._set_reduce_res(key, value)
                 return
@@ -192,7 +226,7 @@ class Result(_BaseResult, dict):
             category=FutureWarning
         )
         self.__stereo_exp_data.cells._obs[key] = value['group'].values
-        self.CLUSTER_NAMES.add(key)
+        self._add_name(Result.CLUSTER, key)
 
     def _set_connectivities_res(self, key, value):
         assert type(value) is dict and not {'connectivities', 'nn_dist'} - set(value.keys()), \
@@ -203,7 +237,7 @@ class Result(_BaseResult, dict):
             category=FutureWarning
         )
         self.__stereo_exp_data.cells._pairwise[key] = value
-        self.CONNECTIVITY_NAMES.add(key)
+        self._add_name(Result.CONNECTIVITY, key)
 
     def _set_reduce_res(self, key, value):
         assert type(value) is pd.DataFrame, 'reduce result must be pandas.DataFrame'
@@ -213,7 +247,7 @@ class Result(_BaseResult, dict):
             category=FutureWarning
         )
         self.__stereo_exp_data.cells._matrix[key] = value
-        self.REDUCE_NAMES.add(key)
+        self._add_name(Result.REDUCE, key)
 
     def _set_hvg_res(self, key, value):
         dict.__setitem__(self, key, value)
@@ -232,68 +266,60 @@ class AnnBasedResult(_BaseResult, object):
         self.__based_ann_data = based_ann_data
 
     def __contains__(self, item):
-        if item in AnnBasedResult.CLUSTER_NAMES:
-            return item in self.__based_ann_data.obs
-        elif item in AnnBasedResult.CONNECTIVITY_NAMES:
-            return item in self.__based_ann_data.uns
-        elif item in AnnBasedResult.REDUCE_NAMES:
-            return f'X_{item}' in self.__based_ann_data.obsm
-        elif item in AnnBasedResult.HVG_NAMES:
-            if item in self.__based_ann_data.uns:
-                return True
-            elif AnnBasedResult.RENAME_DICT.get(item, None) in self.__based_ann_data.uns:
-                return True
-        elif item in AnnBasedResult.MARKER_GENES_NAMES:
-            if item in self.__based_ann_data.uns:
+        adata = self.__based_ann_data
+        name_types = self.NAME_TYPES_DICT.get(item)
+        if name_types:
+            name_type = name_types[0]
+            if name_type == AnnBasedResult.CLUSTER:
+                return item in adata.obs
+            elif name_type == AnnBasedResult.CONNECTIVITY:
+                return item in adata.uns
+            elif name_type == AnnBasedResult.REDUCE:
+                return f'X_{item}' in adata.obsm
+            elif item in adata.uns or AnnBasedResult.RENAME_DICT.get(item, None) in adata.uns:
+                # HVG and MARKER_GENES
                 return True
-            elif AnnBasedResult.RENAME_DICT.get(item, None) in self.__based_ann_data.uns:
-                return True
-        elif item.startswith('gene_exp_'):
-            if item in self.__based_ann_data.uns:
-                return True
-        elif item.startswith('paga'):
-            if item in self.__based_ann_data.uns:
+        elif item.startswith('gene_exp_') or item.startswith('paga'):
+            if item in adata.uns:
                 return True
         elif item.startswith('regulatory_network_inference'):
-            if f'{item}_regulons' in self.__based_ann_data.uns:
+            if f'{item}_regulons' in adata.uns:
                 return True
-            elif f'{item}_auc_matrix' in self.__based_ann_data.uns:
+            elif f'{item}_auc_matrix' in adata.uns:
                 return True
-            elif f'{item}_adjacencies' in self.__based_ann_data.uns:
+            elif f'{item}_adjacencies' in adata.uns:
                 return True
 
-        obsm_obj = self.__based_ann_data.obsm.get(f'X_{item}', None)
-        if obsm_obj is not None:
+        if adata.obsm.get(f'X_{item}', None) is not None:
             return True
-        obsm_obj = self.__based_ann_data.obsm.get(f'{item}', None)
-        if obsm_obj is not None:
+        if adata.obsm.get(f'{item}', None) is not None:
             return True
-        obs_obj = self.__based_ann_data.obs.get(item, None)
-        if obs_obj is not None:
+        if adata.obs.get(item, None) is not None:
             return True
-        uns_obj = self.__based_ann_data.uns.get(item, None)
-        if uns_obj is not None:
+        if adata.uns.get(item, None) is not None:
             return True
         return False
 
     def __getitem__(self, name):
-        if name in AnnBasedResult.CLUSTER_NAMES:
+        name_types = self.NAME_TYPES_DICT.get(name)
+        name_type = name_types[0] if name_types else None
+        if name_type == AnnBasedResult.CLUSTER:
             return pd.DataFrame({
                 'bins': self.__based_ann_data.obs_names,
                 'group': self.__based_ann_data.obs[name].values
             })
-        elif name in AnnBasedResult.CONNECTIVITY_NAMES:
+        elif name_type == AnnBasedResult.CONNECTIVITY:
             return {
                 'neighbor': None,  # TODO really needed?
                 'connectivities': self.__based_ann_data.obsp['connectivities'],
                 'nn_dist': self.__based_ann_data.obsp['distances'],
             }
-        elif name in AnnBasedResult.REDUCE_NAMES:
+        elif name_type == AnnBasedResult.REDUCE:
             return pd.DataFrame(self.__based_ann_data.obsm[f'X_{name}'], copy=False)
-        elif name in AnnBasedResult.HVG_NAMES:
+        elif name_type == AnnBasedResult.HVG:
             # TODO ignore `mean_bin`, really need?
             return self.__based_ann_data.var.loc[:, ["means", "dispersions", "dispersions_norm", "highly_variable"]]
-        elif name in AnnBasedResult.MARKER_GENES_NAMES:
+        elif name_type == AnnBasedResult.MARKER_GENES:
             return self.__based_ann_data.uns[name]
         elif name.startswith('gene_exp_'):
             return self.__based_ann_data.uns[name]
@@ -302,10 +328,10 @@ class AnnBasedResult(_BaseResult, object):
 
         obsm_obj = self.__based_ann_data.obsm.get(f'X_{name}', None)
         if obsm_obj is not None:
-            return pd.DataFrame(obsm_obj)
+            return pd.DataFrame(obsm_obj, copy=False)
         obsm_obj = self.__based_ann_data.obsm.get(f'{name}', None)
         if obsm_obj is not None:
-            return pd.DataFrame(obsm_obj)
+            return pd.DataFrame(obsm_obj, copy=False)
         obs_obj = self.__based_ann_data.obs.get(name, None)
         if obs_obj is not None:
             return pd.DataFrame({
@@ -340,14 +366,8 @@ class AnnBasedResult(_BaseResult, object):
         return True
 
     def __setitem__(self, key, value):
-        for name_type, name_dict in AnnBasedResult.TYPE_NAMES_DICT.items():
-            if key in name_dict and self._real_set_item(name_type, key, value):
-                return
-
-        for name_type, name_dict in AnnBasedResult.TYPE_NAMES_DICT.items():
-            for like_name in name_dict:
-                if not key.startswith('gene_exp_') and like_name in key and self._real_set_item(name_type, key, value):
-                    return
+        if self._set_item_by_name(key, value):
+            return
 
         # if key == "regulatory_network_inference":
         #     self.__based_ann_data.uns[f'{key}_regulons'] = value['regulons']
@@ -363,7 +383,7 @@ class AnnBasedResult(_BaseResult, object):
                 self._set_hvg_res(key, value)
                 return
             elif len(value.shape) == 2 and value.shape[0] == self.__based_ann_data.shape[0] and value.shape[1] <= \
-                    self.__based_ann_data.shape[1]:
+                    self.__based_ann_data.shape[1] and not self.NOT_REDUCE_COLUMNS.intersection(value.columns.values):
                 # TODO this is hard-code method to guess it's a reduce ndarray
                 self._set_reduce_res(key, value)
                 return
@@ -391,16 +411,25 @@ class AnnBasedResult(_BaseResult, object):
             'source': 'stereopy',
             'method': 'neighbors'
         }
+        # knn graphs are stored as csr in obsp, a dense n_obs x n_obs matrix would not fit for large data
+        connectivities = self._to_csr(value['connectivities'])
+        distances = self._to_csr(value['nn_dist'])
         if key == 'neighbors':
             self.__based_ann_data.uns[key]['params']['connectivities_key'] = 'connectivities'
             self.__based_ann_data.uns[key]['params']['distances_key'] = 'distances'
-            self.__based_ann_data.obsp['connectivities'] = value['connectivities']
-            self.__based_ann_data.obsp['distances'] = value['nn_dist']
+            self.__based_ann_data.obsp['connectivities'] = connectivities
+            self.__based_ann_data.obsp['distances'] = distances
         else:
             self.__based_ann_data.uns[key]['params']['connectivities_key'] = f'{key}_connectivities'
             self.__based_ann_data.uns[key]['params']['distances_key'] = f'{key}_distances'
-            self.__based_ann_data.obsp[f'{key}_connectivities'] = value['connectivities']
-            self.__based_ann_data.obsp[f'{key}_distances'] = value['nn_dist']
+            self.__based_ann_data.obsp[f'{key}_connectivities'] = connectivities
+            self.__based_ann_data.obsp[f'{key}_distances'] = distances
+
+    @staticmethod
+    def _to_csr(matrix):
+        if issparse(matrix):
+            return matrix.tocsr()
+        return csr_matrix(matrix)
 
     def _set_reduce_res(self, key, value):
         assert type(value) is pd.DataFrame, 'reduce result must be pandas.DataFrame'
@@ -409,8 +438,9 @@ class AnnBasedResult(_BaseResult, object):
 
     def _set_hvg_res(self, key, value):
         self.__based_ann_data.uns[key] = {'params': {}, 'source': 'stereopy', 'method': key}
-        self.__based_ann_data.var.loc[:, ["means", "dispersions", "dispersions_norm", "highly_variable"]] = \
-            value.loc[:, ["means", "dispersions", "dispersions_norm", "highly_variable"]].values
+        # assign column by column, each keeps its own dtype instead of going through one object array
+        for column in ("means", "dispersions", "dispersions_norm", "highly_variable"):
+            self.__based_ann_data.var[column] = value[column].to_numpy()
 
     def _set_marker_genes_res(self, key, value):
         self.__based_ann_data.uns[key] = value
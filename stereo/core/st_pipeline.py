@@ -12,7 +12,10 @@ change log:
 """
 
 import copy
+import csv
+import weakref
 from functools import wraps
+from itertools import zip_longest
 from multiprocessing import cpu_count
 from typing import (
     Optional,
@@ -30,6 +33,17 @@ from .result import Result, AnnBasedResult
 from .stereo_exp_data import AnnBasedStereoExpData
 from .stereo_exp_data import StereoExpData
 from ..log_manager import logger
+from ..preprocess.filter import (
+    filter_by_clusters,
+    filter_cells,
+    filter_coordinates,
+    filter_genes
+)
+from ..preprocess.qc import (
+    cal_qc,
+    invalidate_cells_indicators
+)
+from ..utils.spmatrix_helper import content_fingerprint
 from ..utils.time_consume import TimeConsume
 
 tc = TimeConsume()
@@ -47,6 +61,119 @@ def logit(func):
     return wrapped
 
 
+def _save_marker_genes_csv(result, output):
+    """
+    Write the marker genes of all groups side by side, row by row, instead of concatenating them into one frame.
+    """
+    import natsort
+    show_cols = ['scores', 'pvalues', 'pvalues_adj', 'log2fc', 'genes', 'pct', 'pct_rest']
+    groups = natsort.natsorted([key for key in result.keys() if '.vs.' in key])
+    header = [''] + [group.split(".vs.")[0] + "_" + key for group in groups for key in show_cols]
+    columns = [result[group][key].to_numpy() for group in groups for key in show_cols]
+    with open(output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for i, row in enumerate(zip_longest(*columns, fillvalue='')):
+            # missing values are written as empty fields, the same as `DataFrame.to_csv`
+            writer.writerow([i] + ['' if v != v or v is None else v for v in row])
+
+
+class _GeneStatsCache(object):
+    """
+    Keeps the per-gene mean and variance of the current expression matrix, keyed by the transform applied before
+    reducing (`None` or `'expm1'`), so hvg and scale on an unchanged matrix do not recompute them.
+    Copies of the pipeline start with an empty cache.
+
+    The matrix is recognized by its identity and a checksum of its stored values, so the statistics are computed
+    again after values were changed in place outside of the pipeline (e.g. scanpy functions run on the `adata.X`
+    of an AnnBasedStereoExpData), matrices of sparse formats other than csr, csc and coo are never cached.
+    """
+
+    def __init__(self):
+        self._source = None
+        self._signature = None
+        self._stats = {}
+
+    def __deepcopy__(self, memo):
+        return _GeneStatsCache()
+
+    def get(self, exp_matrix, transform=None):
+        from ..utils.hvg_utils import get_mean_var
+        signature = content_fingerprint(exp_matrix)
+        if signature is None or self._source is None or self._source() is not exp_matrix \
+                or self._signature != signature:
+            self._stats = {}
+            self._source = weakref.ref(exp_matrix)
+            self._signature = signature
+        if transform not in self._stats:
+            x = np.expm1(exp_matrix) if transform == 'expm1' else exp_matrix
+            self._stats[transform] = get_mean_var(x)
+        mean, var = self._stats[transform]
+        # callers adjust the arrays in place, e.g. replacing zero means
+        return mean.copy(), var.copy()
+
+    def clear(self):
+        self._source = None
+        self._signature = None
+        self._stats = {}
+
+
+class _ExpMatrixOwner(object):
+    """
+    Remembers the last expression matrix created by the pipeline itself, the only one later steps may modify
+    in place, matrices given by the user or shared with other data are never written into.
+    Copies of the pipeline start without an owned matrix.
+    """
+
+    def __init__(self):
+        self._matrix = None
+
+    def __deepcopy__(self, memo):
+        return _ExpMatrixOwner()
+
+    def set(self, exp_matrix):
+        self._matrix = weakref.ref(exp_matrix)
+
+    def owns(self, exp_matrix):
+        return self._matrix is not None and self._matrix() is exp_matrix
+
+
+class _NeighborsGraphCache(object):
+    """
+    Keeps the igraph graph built from the connectivities of each neighbors result, so clustering the same result
+    again, e.g. with other methods or resolutions, does not rebuild it.
+    An entry is dropped as soon as its connectivities matrix is freed, and is rebuilt when the stored edges or
+    weights of the matrix have changed. Copies of the pipeline start with an empty cache.
+    """
+
+    def __init__(self):
+        self._graphs = {}
+
+    def __deepcopy__(self, memo):
+        return _NeighborsGraphCache()
+
+    def get(self, neighbors_res_key, adjacency, directed):
+        from ..algorithm.neighbors import Neighbors
+        if not issparse(adjacency):
+            return Neighbors.get_igraph_from_adjacency(adjacency, directed=directed)
+        key = (neighbors_res_key, directed)
+        cached = self._graphs.get(key)
+        if cached is None or cached[0]() is not adjacency or not np.array_equal(cached[1], adjacency.data):
+            graphs = self._graphs
+
+            def drop(ref):
+                # the entry may have been replaced by the graph of a newer matrix in the meantime
+                if key in graphs and graphs[key][0] is ref:
+                    del graphs[key]
+
+            source = weakref.ref(adjacency, drop)
+            g = Neighbors.get_igraph_from_adjacency(adjacency, directed=directed)
+            cached = (source, adjacency.data.copy(), g)
+            self._graphs[key] = cached
+        # every caller gets its own graph, the cached one is never modified
+        return cached[2].copy()
+
+
 class StPipeline(object):
 
     def __init__(self, data: Union[StereoExpData, AnnBasedStereoExpData]):
@@ -60,6 +187,9 @@ class StPipeline(object):
         self._raw: Union[StereoExpData, AnnBasedStereoExpData] = None
         self.key_record = {'hvg': [], 'pca': [], 'neighbors': [], 'umap': [], 'cluster': [], 'marker_genes': []}
         self.reset_key_record = self._reset_key_record
+        self._stats_cache = _GeneStatsCache()
+        self._exp_matrix_owner = _ExpMatrixOwner()
+        self._neighbors_graph_cache = _NeighborsGraphCache()
 
     def __getattr__(self, item):
         dict_attr = self.__dict__.get(item, None)
@@ -137,6 +267,47 @@ class StPipeline(object):
         else:
             self.key_record[key] = [res_key]
 
+    def _exp_matrix_modified_inplace(self):
+        """
+        Drop everything derived from the expression matrix object after its values were changed in place.
+        """
+        invalidate_cells_indicators(self.data)
+        self._stats_cache.clear()
+
+    def _replace_exp_matrix(self, exp_matrix):
+        """
+        Set an expression matrix newly created by the pipeline, which later steps may then modify in place.
+        """
+        self.data.exp_matrix = exp_matrix
+        self._exp_matrix_owner.set(exp_matrix)
+
+    def _owns_exp_matrix(self):
+        """
+        Whether the current expression matrix was created by the pipeline and is held by the data itself,
+        the matrix of an AnnData (view) is got by slicing or may be shared, so it is always set back instead.
+        """
+        return type(self.data) is StereoExpData and self._exp_matrix_owner.owns(self.data.exp_matrix)
+
+    def _ensure_gene_stats(self, transform=None):
+        """
+        Get the per-gene mean and variance of the current expression matrix, computed once and shared by
+        the highly variable genes flavors and scale.
+
+        :param transform: `'expm1'` to reduce over the exponentiated matrix, as the `seurat` flavor does.
+        :return: means and variances values.
+        """
+        self._ensure_csr()
+        return self._stats_cache.get(self.data.exp_matrix, transform)
+
+    def _ensure_csr(self):
+        """
+        Convert a sparse expression matrix of other formats to csr once, the row-wise preprocessing steps
+        (qc, filtering, normalization) all slice and reduce along cells.
+        """
+        exp_matrix = self.data.exp_matrix
+        if issparse(exp_matrix) and exp_matrix.format != 'csr':
+            self._replace_exp_matrix(exp_matrix.tocsr())
+
     @logit
     def cal_qc(self):
         """
@@ -155,7 +326,7 @@ class StPipeline(object):
         A StereoExpData object storing quality control indicators, including two levels of obs (cell) and var (gene).
 
         """
-        from ..preprocess.qc import cal_qc
+        self._ensure_csr()
         cal_qc(self.data)
 
     @logit
@@ -195,7 +366,7 @@ class StPipeline(object):
         An object of StereoExpData.
         Depending on `inplace`, if `True`, the data will be replaced by those filtered.
         """
-        from ..preprocess.filter import filter_cells
+        self._ensure_csr()
         data = filter_cells(self.data, min_gene, max_gene, min_n_genes_by_counts, max_n_genes_by_counts, pct_counts_mt,
                             cell_list, inplace)
         if data.raw is not None and filter_raw:
@@ -234,7 +405,7 @@ class StPipeline(object):
         An object of StereoExpData.
         Depending on `inplace`, if `True`, the data will be replaced by those filtered.
         """
-        from ..preprocess.filter import filter_genes
+        self._ensure_csr()
         data = filter_genes(self.data, min_cell, max_cell, gene_list, mean_umi_gt, inplace)
         if data.raw is not None and filter_raw:
             filter_genes(data.raw, min_cell, max_cell, gene_list, mean_umi_gt, True)
@@ -265,7 +436,6 @@ class StPipeline(object):
         if hvg_res_key not in self.result:
             raise KeyError(f'Can not find result of highly_variable_genes function by key {hvg_res_key}.')
 
-        from ..preprocess import filter_genes
         hvgs_flag = self.result[hvg_res_key]['highly_variable'].to_numpy()
         hvgs = self.data.gene_names[hvgs_flag]
         data = filter_genes(self.data, gene_list=hvgs, inplace=inplace)
@@ -305,7 +475,6 @@ class StPipeline(object):
         An object of StereoExpData.
         Depending on `inplace`, if `True`, the data will be replaced by those filtered.
         """
-        from ..preprocess.filter import filter_coordinates
         data = filter_coordinates(self.data, min_x, max_x, min_y, max_y, inplace)
         if data.raw is not None and filter_raw:
             filter_coordinates(data.raw, min_x, max_x, min_y, max_y, True)
@@ -341,7 +510,6 @@ class StPipeline(object):
         An object of StereoExpData.
         Depending on `inplace`, if `True`, the data will be replaced by those filtered.
         """
-        from ..preprocess.filter import filter_by_clusters, filter_cells
 
         if cluster_res_key not in self.result:
             raise Exception(f'{cluster_res_key} is not in the result, please check and run the func of cluster.')
@@ -376,10 +544,17 @@ class StPipeline(object):
         An object of StereoExpData.
         Depending on `inplace`, if `True`, the data will be replaced by those normalized.
         """
+        self._ensure_csr()
+        exp_matrix = self.data.exp_matrix
         if inplace:
-            self.data.exp_matrix = np.log1p(self.data.exp_matrix)
+            if issparse(exp_matrix) and np.issubdtype(exp_matrix.dtype, np.floating) and self._owns_exp_matrix():
+                # log1p(0) == 0, so only the stored values need to be transformed
+                np.log1p(exp_matrix.data, out=exp_matrix.data)
+                self._exp_matrix_modified_inplace()
+            else:
+                self._replace_exp_matrix(np.log1p(exp_matrix))
         else:
-            self.result[res_key] = np.log1p(self.data.exp_matrix)
+            self.result[res_key] = np.log1p(exp_matrix)
 
     @logit
     def normalize_total(self,
@@ -405,12 +580,44 @@ class StPipeline(object):
         An object of StereoExpData.
         Depending on `inplace`, if `True`, the data will be replaced by those normalized
         """
+        self._ensure_csr()
         from ..algorithm.normalization import normalize_total
         if inplace:
-            self.data.exp_matrix = normalize_total(self.data.exp_matrix, target_sum=target_sum)
+            self._replace_exp_matrix(normalize_total(self.data.exp_matrix, target_sum=target_sum))
         else:
             self.result[res_key] = normalize_total(self.data.exp_matrix, target_sum=target_sum)
 
+    @logit
+    def normalize_total_log1p(self,
+                              target_sum: int = 10000,
+                              inplace: bool = True,
+                              res_key: str = 'normalize_total_log1p'):
+        """
+        Run `normalize_total` and `log1p` in one step, for sparse data each stored value is scaled and logarithmized
+        in a single pass instead of two.
+
+        Parameters
+        -----------------------
+        target_sum
+            the number of total counts per cell after normalization, if `None`, each cell has a
+            total count equal to the median of total counts for all cells before normalization.
+        inplace
+            whether to inplcae previous data or get a new express matrix after normalization.
+        res_key
+            the key to get targeted result from `self.result`.
+
+        Returns
+        ----------------
+        An object of StereoExpData.
+        Depending on `inplace`, if `True`, the data will be replaced by those normalized.
+        """
+        self._ensure_csr()
+        from ..algorithm.normalization import normalize_total_log1p
+        if inplace:
+            self._replace_exp_matrix(normalize_total_log1p(self.data.exp_matrix, target_sum=target_sum))
+        else:
+            self.result[res_key] = normalize_total_log1p(self.data.exp_matrix, target_sum=target_sum)
+
     @logit
     def scale(self,
               zero_center: bool = True,
@@ -437,10 +644,14 @@ class StPipeline(object):
         Depending on `inplace`, if `True`, the data will be replaced by those scaled.
         """
         from ..algorithm.scale import scale
+        mean_var = self._ensure_gene_stats()
         if inplace:
-            self.data.exp_matrix = scale(self.data.exp_matrix, zero_center, max_value)
+            # scaling may write into the current matrix instead of returning a new one
+            self.data.exp_matrix = scale(self.data.exp_matrix, zero_center, max_value, mean_var=mean_var)
+            self._exp_matrix_modified_inplace()
         else:
-            self.result[res_key] = scale(self.data.exp_matrix, zero_center, max_value)
+            # scale writes into the matrix it is given, keep the current one untouched
+            self.result[res_key] = scale(self.data.exp_matrix.copy(), zero_center, max_value, mean_var=mean_var)
 
     @logit
     def quantile(self, inplace=True, res_key='quantile'):
@@ -453,12 +664,14 @@ class StPipeline(object):
         :return:
         """
         from ..algorithm.normalization import quantile_norm
-        if issparse(self.data.exp_matrix):
-            self.data.exp_matrix = self.data.exp_matrix.toarray()
+        # quantile normalization sorts every column, so it works on a dense copy only
+        exp_matrix = self.data.exp_matrix
+        if issparse(exp_matrix):
+            exp_matrix = exp_matrix.toarray()
         if inplace:
-            self.data.exp_matrix = quantile_norm(self.data.exp_matrix)
+            self._replace_exp_matrix(quantile_norm(exp_matrix))
         else:
-            self.result[res_key] = quantile_norm(self.data.exp_matrix)
+            self.result[res_key] = quantile_norm(exp_matrix)
 
     @logit
     def disksmooth_zscore(self, r=20, inplace=True, res_key='disksmooth_zscore'):
@@ -471,12 +684,14 @@ class StPipeline(object):
         :return:
         """
         from ..algorithm.normalization import zscore_disksmooth
-        if issparse(self.data.exp_matrix):
-            self.data.exp_matrix = self.data.exp_matrix.toarray()
+        exp_matrix = self.data.exp_matrix
+        if issparse(exp_matrix):
+            # densify straight into the float32 the z-score works in, not through a float64 copy
+            exp_matrix = exp_matrix.astype(np.float32).toarray()
         if inplace:
-            self.data.exp_matrix = zscore_disksmooth(self.data.exp_matrix, self.data.position, r)
+            self._replace_exp_matrix(zscore_disksmooth(exp_matrix, self.data.position, r))
         else:
-            self.result[res_key] = zscore_disksmooth(self.data.exp_matrix, self.data.position, r)
+            self.result[res_key] = zscore_disksmooth(exp_matrix, self.data.position, r)
 
     @logit
     def sctransform(
@@ -522,8 +737,8 @@ class StPipeline(object):
         Depending on `inplace`, if `True`, the data will be replaced by those normalized.
         """
         from ..preprocess.sc_transform import sc_transform
-        from ..preprocess.filter import filter_genes
-        data = self.data if inplace else copy.deepcopy(self.data)
+        # sc_transform replaces exp_matrix rather than writing into it
+        data = self.data if inplace else self.data._shallow_clone()
         self.result[res_key] = sc_transform(data, n_cells, n_genes, filter_hvgs, var_features_n,
                                             exp_matrix_key=exp_matrix_key, seed_use=seed_use, **kwargs)
         key = 'sct'
@@ -539,7 +754,7 @@ class StPipeline(object):
             method: Literal['seurat', 'cell_ranger', 'seurat_v3'] = 'seurat',
             n_top_genes: Optional[int] = 2000,
             min_disp: Optional[float] = 0.5,
-            max_disp: Optional[float] = np.inf,
+            max_disp: Optional[float] = None,
             min_mean: Optional[float] = 0.0125,
             max_mean: Optional[float] = 3,
             span: Optional[float] = 0.3,
@@ -592,8 +807,13 @@ class StPipeline(object):
 
         """
         from ..tools.highly_variable_genes import HighlyVariableGenes
+        # the per-gene stats only describe the whole matrix, batches compute their own
+        mean_var = None
+        if groups is None:
+            mean_var = self._ensure_gene_stats('expm1' if method == 'seurat' else None)
         hvg = HighlyVariableGenes(self.data, groups=groups, method=method, n_top_genes=n_top_genes, min_disp=min_disp,
-                                  max_disp=max_disp, min_mean=min_mean, max_mean=max_mean, span=span, n_bins=n_bins)
+                                  max_disp=max_disp, min_mean=min_mean, max_mean=max_mean, span=span, n_bins=n_bins,
+                                  mean_var=mean_var)
         hvg.fit()
         self.result[res_key] = hvg.result
         key = 'hvg'
@@ -608,14 +828,23 @@ class StPipeline(object):
                         data info of highly variable genes.
         :return: a StereoExpData object.
         """
+        # the hvg subset below always builds a new matrix, so a copy does not need its own expression matrix
         if not use_raw:
-            data = self.data if inplace else copy.deepcopy(self.data)
+            data = self.data if inplace else self.data._shallow_clone()
         else:
-            data = self.raw if inplace else copy.deepcopy(self.raw)
+            data = self.raw if inplace else self.raw._shallow_clone()
         if hvg_res_key not in self.result:
             raise Exception(f'{hvg_res_key} is not in the result, please check and run the normalization func.')
         df = self.result[hvg_res_key]
         genes_index = df['highly_variable'].values
+        if genes_index.size == data.shape[1] and genes_index.all():
+            # every gene is kept, the subset would only be a copy of the whole matrix
+            if not inplace:
+                # the shallow clone still shares the expression matrix, it must not be modified through the clone
+                data.exp_matrix = data.exp_matrix.copy()
+            return data
+        # the columns are sliced straight from the matrix, a csr one selects them in one pass over its stored values,
+        # converting it to csc and back would cost two more full passes
         data.sub_by_index(gene_index=genes_index)
         return data
 
@@ -657,10 +886,16 @@ class StPipeline(object):
         """  # noqa
         if use_highly_genes and hvg_res_key not in self.result:
             raise Exception(f'{hvg_res_key} is not in the result, please check and run the highly_var_genes func.')
+        self._ensure_csr()
         data = self.subset_by_hvg(hvg_res_key, inplace=False) if use_highly_genes else self.data
         from ..algorithm.dim_reduce import pca
-        res = pca(data.exp_matrix, n_pcs, svd_solver=svd_solver)
-        self.result[res_key] = pd.DataFrame(res['x_pca'])
+        exp_matrix = data.exp_matrix
+        if exp_matrix.dtype == np.float64 and exp_matrix.shape[0] > 50000:
+            # single precision is enough for the embedding and halves the memory the solver streams through
+            exp_matrix = exp_matrix.astype(np.float32)
+        res = pca(exp_matrix, n_pcs, svd_solver=svd_solver)
+        # wrap the embedding without copying it, reduce results are stored as DataFrames
+        self.result[res_key] = pd.DataFrame(res['x_pca'], copy=False)
         self.result[f'{res_key}_variance_ratio'] = res['variance_ratio']
         key = 'pca'
         self.reset_key_record(key, res_key)
@@ -727,7 +962,7 @@ class StPipeline(object):
             raise Exception(f'{neighbors_res_key} is not in the result, please check and run the neighbors func.')
         _, connectivities, _ = self.get_neighbors_res(neighbors_res_key)
         x_umap = umap(
-            x=self.result[pca_res_key],
+            x=self.result[pca_res_key].to_numpy(),
             neighbors_connectivities=connectivities,
             min_dist=min_dist,
             spread=spread,
@@ -741,7 +976,7 @@ class StPipeline(object):
             random_state=random_state,
             parallel=parallel
         )
-        self.result[res_key] = pd.DataFrame(x_umap)
+        self.result[res_key] = pd.DataFrame(x_umap, copy=False)
         key = 'umap'
         self.reset_key_record(key, res_key)
 
@@ -796,13 +1031,17 @@ class StPipeline(object):
         """
         if pca_res_key not in self.result:
             raise Exception(f'{pca_res_key} is not in the result, please check and run the pca func.')
-        if n_jobs > cpu_count():
-            n_jobs = -1
+        if n_jobs > cpu_count() or n_jobs <= 0:
+            n_jobs = cpu_count()
         if n_pcs is None:
             n_pcs = self.result[pca_res_key].shape[1]
+        from threadpoolctl import threadpool_limits
         from ..algorithm.neighbors import find_neighbors
-        neighbor, dists, connectivities = find_neighbors(x=self.result[pca_res_key].values, method=method, n_pcs=n_pcs,
-                                                         n_neighbors=n_neighbors, metric=metric, knn=knn, n_jobs=n_jobs)
+        # each of the n_jobs workers may start its own blas threads, keep the total around cpu_count
+        with threadpool_limits(limits=max(1, cpu_count() // n_jobs), user_api='blas'):
+            neighbor, dists, connectivities = find_neighbors(x=self.result[pca_res_key].values, method=method,
+                                                             n_pcs=n_pcs, n_neighbors=n_neighbors, metric=metric,
+                                                             knn=knn, n_jobs=n_jobs)
         res = {'neighbor': neighbor, 'connectivities': connectivities, 'nn_dist': dists}
         self.result[res_key] = res
         key = 'neighbors'
@@ -838,12 +1077,12 @@ class StPipeline(object):
         """
         from ..io.reader import stereo_to_anndata
         import squidpy as sq
-        neighbor, connectivities, dists = copy.deepcopy(self.get_neighbors_res(neighbors_res_key))
+        neighbor, connectivities, dists = self.get_neighbors_res(neighbors_res_key)
+        neighbor, dists = copy.deepcopy((neighbor, dists))
         adata = stereo_to_anndata(self.data, split_batches=False)
         sq.gr.spatial_neighbors(adata, n_neighs=n_neighbors)
-        connectivities.data[connectivities.data > 0] = 1
-        adj = connectivities + adata.obsp['spatial_connectivities']
-        adj.data[adj.data > 0] = 1
+        # union of both sparsity patterns, every edge weighted 1, without touching the source connectivities
+        adj = ((connectivities > 0) + (adata.obsp['spatial_connectivities'] > 0)).astype(connectivities.dtype)
         res = {'neighbor': neighbor, 'connectivities': adj, 'nn_dist': dists}
         self.result[res_key] = res
         key = 'neighbors'
@@ -884,8 +1123,9 @@ class StPipeline(object):
             clusters = leiden_rapids(adjacency=connectivities, resolution=resolution)
         else:
             from ..algorithm.leiden import leiden as le
+            graph = self._neighbors_graph_cache.get(neighbors_res_key, connectivities, directed)
             clusters = le(neighbor=neighbor, adjacency=connectivities, directed=directed, resolution=resolution,
-                          use_weights=use_weights, random_state=random_state, n_iterations=n_iterations)
+                          use_weights=use_weights, random_state=random_state, n_iterations=n_iterations, graph=graph)
         df = pd.DataFrame({'bins': self.data.cell_names, 'group': clusters})
         self.result[res_key] = df
         key = 'cluster'
@@ -927,8 +1167,11 @@ class StPipeline(object):
         neighbor, connectivities, _ = self.get_neighbors_res(neighbors_res_key)
         from ..algorithm._louvain import louvain as lo
         from ..utils.pipeline_utils import cell_cluster_to_gene_exp_cluster
+        graph = None
+        if flavor in {'vtraag', 'igraph'}:
+            graph = self._neighbors_graph_cache.get(neighbors_res_key, connectivities, directed and flavor != 'igraph')
         clusters = lo(neighbor=neighbor, resolution=resolution, random_state=random_state,
-                      adjacency=connectivities, flavor=flavor, directed=directed, use_weights=use_weights)
+                      adjacency=connectivities, flavor=flavor, directed=directed, use_weights=use_weights, graph=graph)
         df = pd.DataFrame({'bins': self.data.cell_names, 'group': clusters})
         self.result[res_key] = df
         key = 'cluster'
@@ -960,15 +1203,14 @@ class StPipeline(object):
         if pca_res_key not in self.result:
             raise Exception(f'{pca_res_key} is not in the result, please check and run the pca func.')
         import phenograph as phe
-        from natsort import natsorted
         from ..utils.pipeline_utils import cell_cluster_to_gene_exp_cluster
-        communities, _, _ = phe.cluster(self.result[pca_res_key], k=phenograph_k, clustering_algo='leiden',
-                                        n_jobs=n_jobs, seed=seed)
+        # the knn search is bound by memory traffic, single precision is plenty for distances in pca space
+        x = np.ascontiguousarray(self.result[pca_res_key].to_numpy(dtype=np.float32))
+        communities, _, _ = phe.cluster(x, k=phenograph_k, clustering_algo='leiden', n_jobs=n_jobs, seed=seed)
         communities = communities + 1
-        clusters = pd.Categorical(
-            values=communities.astype('U'),
-            categories=natsorted(map(str, np.unique(communities))),
-        )
+        # the labels are non-negative integers, so their numeric order is the natural order of their strings
+        labels, codes = np.unique(communities, return_inverse=True)
+        clusters = pd.Categorical.from_codes(codes.reshape(-1), categories=labels.astype('U'))
         df = pd.DataFrame({'bins': self.data.cell_names, 'group': clusters})
         self.result[res_key] = df
         key = 'cluster'
@@ -1041,19 +1283,7 @@ class StPipeline(object):
         self.result[res_key]['parameters']['cluster_res_key'] = cluster_res_key
         self.result[res_key]['parameters']['method'] = method
         if output is not None:
-            import natsort
-            result = self.result[res_key]
-            show_cols = ['scores', 'pvalues', 'pvalues_adj', 'log2fc', 'genes', 'pct', 'pct_rest']
-            groups = natsort.natsorted([key for key in result.keys() if '.vs.' in key])
-            dat = pd.concat(
-                [
-                    pd.DataFrame(
-                        {group.split(".vs.")[0] + "_" + key: result[group][key].values}
-                    ) for group in groups for key in show_cols
-                ],
-                axis=1
-            )
-            dat.to_csv(output)
+            _save_marker_genes_csv(self.result[res_key], output)
         key = 'marker_genes'
         self.reset_key_record(key, res_key)
 
@@ -1099,9 +1329,7 @@ class StPipeline(object):
         if use_raw and not self.raw:
             raise Exception('self.raw must be set if use_raw is True.')
         data = self.raw if use_raw else self.data
-        x = data.exp_matrix.toarray() if issparse(data.exp_matrix) else data.exp_matrix
-        df = pd.DataFrame(x, columns=data.gene_names, index=data.cell_names)
-        res = spatial_pattern_score(df)
+        res = spatial_pattern_score(data.exp_matrix, data.gene_names)
         self.result[res_key] = res
 
     @logit
@@ -1143,7 +1371,8 @@ class StPipeline(object):
             raise Exception(f'{hvg_res_key} is not in the result, please check and run the highly_var_genes func.')
         if use_raw and not self.raw:
             raise Exception('self.raw must be set if use_raw is True.')
-        data = copy.deepcopy(self.raw) if use_raw else copy.deepcopy(self.data)
+        # spatial_hotspot only reads the data, and sub_by_name already returns its own copy
+        data = self.raw if use_raw else self.data
         if use_highly_genes:
             df = self.result[hvg_res_key]
             highly_genes_name = df.index[df['highly_variable']]
@@ -1286,7 +1515,9 @@ class StPipeline(object):
         assert pca_res_key in self.result, f'{pca_res_key} is not in the result, please check and run the pca method.'
         assert self.data.cells.batch is not None, 'this is not a data were merged from different experiments'
 
-        out = hm.run_harmony(self.result[pca_res_key], self.data.cells.to_df(), 'batch', **kwargs)
+        # harmony only reads the batch column of the meta data
+        batch_df = pd.DataFrame({'batch': pd.Categorical(self.data.cells.batch)}, index=self.data.cell_names)
+        out = hm.run_harmony(self.result[pca_res_key].to_numpy(), batch_df, 'batch', **kwargs)
         self.result[res_key] = pd.DataFrame(out.Z_corr.T)
         key = 'pca'
         self.reset_key_record(key, res_key)
@@ -1343,11 +1574,14 @@ class StPipeline(object):
         else:
             raise TypeError("The type of 'annotation_information' only supports list, ndarray or dict.")
 
-        new_categories_values = new_categories[cluster_res['group'].cat.codes]
+        # map the codes instead of the per-cell labels, several clusters may share one annotation
+        annotations, new_codes = np.unique(new_categories, return_inverse=True)
+        codes = cluster_res['group'].cat.codes.to_numpy()
+        codes = np.where(codes >= 0, new_codes.reshape(-1)[codes], -1)
 
         self.result[res_key] = pd.DataFrame(data={
             'bins': cluster_res['bins'],
-            'group': pd.Series(new_categories_values, dtype='category')
+            'group': pd.Categorical.from_codes(codes, categories=annotations)
         })
 
         key = 'cluster'
@@ -1397,40 +1631,32 @@ class StPipeline(object):
         self.result[res_key]['parameters']['method'] = self.result[marker_genes_res_key]['parameters']['method']
         pct = self.result[marker_genes_res_key]['pct']
         pct_rest = self.result[marker_genes_res_key]['pct_rest']
+        # hash the genes once, every group then looks its genes up instead of building and merging gene sets
+        pct_genes = pd.Index(pct['genes'])
+        pct_rest_genes = pd.Index(pct_rest['genes'])
         for key, res in self.result[marker_genes_res_key].items():
             if '.vs.' not in key:
                 continue
             new_res = res.copy()
             group_name = key.split('.vs.')[0]
-            if not compare_abs:
-                gene_set_1 = res[res['log2fc'] < min_fold_change]['genes'].values if min_fold_change is not None else []
-            else:
-                gene_set_1 = res[res['log2fc'].abs() < min_fold_change][
-                    'genes'].values if min_fold_change is not None else []
-            gene_set_2 = pct[pct[group_name] < min_in_group_fraction][
-                'genes'].values if min_in_group_fraction is not None else []
-            gene_set_3 = pct_rest[pct_rest[group_name] > max_out_group_fraction][
-                'genes'].values if max_out_group_fraction is not None else []
-            flag = res['genes'].isin(np.union1d(gene_set_1, np.union1d(gene_set_2, gene_set_3)))
+            genes = res['genes'].to_numpy()
+            flag = np.zeros(genes.size, dtype=bool)
+            if min_fold_change is not None:
+                log2fc = res['log2fc'].to_numpy()
+                flag |= (np.abs(log2fc) if compare_abs else log2fc) < min_fold_change
+            if min_in_group_fraction is not None:
+                idx = pct_genes.get_indexer(genes)
+                flag |= (idx >= 0) & (pct[group_name].to_numpy()[idx] < min_in_group_fraction)
+            if max_out_group_fraction is not None:
+                idx = pct_rest_genes.get_indexer(genes)
+                flag |= (idx >= 0) & (pct_rest[group_name].to_numpy()[idx] > max_out_group_fraction)
             if remove_mismatch:
-                new_res = new_res[flag == False]  # noqa
+                new_res = new_res[~flag]
             else:
-                new_res[flag == True] = np.nan  # noqa
+                new_res[flag] = np.nan
             self.result[res_key][key] = new_res
         if output is not None:
-            import natsort
-            result = self.result[res_key]
-            show_cols = ['scores', 'pvalues', 'pvalues_adj', 'log2fc', 'genes', 'pct', 'pct_rest']
-            groups = natsort.natsorted([key for key in result.keys() if '.vs.' in key])
-            dat = pd.concat(
-                [
-                    pd.DataFrame(
-                        {group.split(".vs.")[0] + "_" + key: result[group][key].values}
-                    ) for group in groups for key in show_cols
-                ],
-                axis=1
-            )
-            dat.to_csv(output)
+            _save_marker_genes_csv(self.result[res_key], output)
 
         key = 'marker_genes'
         self.reset_key_record(key, res_key)
@@ -1470,7 +1696,9 @@ class AnnBasedStPipeline(StPipeline):
         if hvg_res_key not in self.result:
             raise Exception(f'{hvg_res_key} is not in the result, please check and run the normalization func.')
         df = self.result[hvg_res_key]
-        data._ann_data._inplace_subset_var(df['highly_variable'].values)
+        genes_index = df['highly_variable'].values
+        if genes_index.size != data.shape[1] or not genes_index.all():
+            data._ann_data._inplace_subset_var(genes_index)
         return data
 
     # def raw_checkpoint(self):
@@ -154,6 +154,16 @@ class StereoExpData(Data):
             self.genes = self.genes.sub_set(gene_index)
         return self
 
+    def _shallow_clone(self):
+        """
+        Deep copy the data except for the expression matrix, which is shared with the clone.
+
+        Only for callers that replace the clone's `exp_matrix` (e.g. by `sub_by_index`) instead of
+        modifying it in place.
+        """
+        exp_matrix = self.exp_matrix
+        return copy.deepcopy(self, {id(exp_matrix): exp_matrix})
+
     @numba.jit(cache=True, forceobj=True, nogil=True)
     def get_index(self, data, names):
         index_list = []
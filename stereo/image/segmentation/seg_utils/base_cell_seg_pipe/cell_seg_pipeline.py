@@ -10,6 +10,7 @@ from os.path import (
 )
 
 import cv2
+import numba as nb
 import numpy as np
 import tifffile
 
@@ -21,6 +22,16 @@ from stereo.image.tissue_cut import (
 from stereo.log_manager import logger
 
 
+@nb.njit(cache=True, nogil=True, parallel=True)
+def _rescale_to_8bit(image, min_value, max_value):
+    # same arithmetic as `rint(255 * ((image - min) / (max - min)))`, without the full-size float64 temporaries
+    image_8bit = np.empty(image.size, dtype=np.uint8)
+    value_range = np.float64(max_value - min_value)
+    for i in nb.prange(image.size):
+        image_8bit[i] = np.uint8(np.rint(255 * ((image[i] - min_value) / value_range)))
+    return image_8bit
+
+
 class CellSegPipe(object):
 
     def __init__(
@@ -118,7 +129,10 @@ class CellSegPipe(object):
     def transfer_16bit_to_8bit(image_16bit):
         min_16bit = np.min(image_16bit)
         max_16bit = np.max(image_16bit)
-        return np.array(np.rint(255 * ((image_16bit - min_16bit) / (max_16bit - min_16bit))), dtype=np.uint8)
+        if min_16bit == max_16bit:
+            return np.zeros(image_16bit.shape, dtype=np.uint8)
+        image_8bit = _rescale_to_8bit(np.ascontiguousarray(image_16bit).reshape(-1), min_16bit, max_16bit)
+        return image_8bit.reshape(image_16bit.shape)
 
     def trans16to8(self):
         from stereo.log_manager import logger
@@ -170,11 +184,14 @@ class CellSegPipe(object):
             label_filter_list = []
             for i in range(self.tissue_num[idx]):
                 tissue_bbox_temp = tissue_bbox[i]
+                # multiply straight into uint8, the mask is {0, 1} so this equals multiplying then casting
                 label_filter = np.multiply(
                     label[i],
                     self.tissue_mask[idx][tissue_bbox_temp[0]: tissue_bbox_temp[2],
-                    tissue_bbox_temp[1]: tissue_bbox_temp[3]]  # noqa
-                ).astype(np.uint8)
+                    tissue_bbox_temp[1]: tissue_bbox_temp[3]],  # noqa
+                    dtype=np.uint8,
+                    casting='unsafe'
+                )
                 label_filter_list.append(label_filter)
             tissue_cell_label_filter.append(label_filter_list)
         return tissue_cell_label_filter
@@ -369,15 +369,17 @@ def cellInfer(model_path, file, size, overlap=100):
 
         label_list = []
         dataset = data_batch(img_list)
-        test_dataloader = torch.utils.data.DataLoader(dataset, batch_size=32)
+        # copy the uint8 batch from pinned memory and cast on the device, a quarter of the bytes of a float copy
+        test_dataloader = torch.utils.data.DataLoader(dataset, batch_size=32, pin_memory=device.type == 'cuda')
         for batch in tqdm(test_dataloader, ncols=80):
             img = batch
-            img = img.to(device, dtype=torch.float)
-            pred_mask = model(img)
-            pred_mask = torch.sigmoid(pred_mask).detach().cpu().numpy()
-            pred = pred_mask[:, 0, :, :]
-            pred[:] = (pred[:] < 0.55) * 255
-            for i in range(len(pred_mask)):
+            img = img.to(device, non_blocking=True).float()
+            img = torch.cat((img, img), 1)
+            with torch.no_grad():
+                pred_mask = model(img)
+            # threshold on the device and bring back only the first channel as uint8
+            pred = ((torch.sigmoid(pred_mask[:, 0, :, :]) < 0.55).to(torch.uint8) * 255).cpu().numpy()
+            for i in range(len(pred)):
                 label_list.append(pred[i])
 
         merge_label = merge(label_list, x_list, y_list, image[:, :, 0].shape, width_add=width_add,
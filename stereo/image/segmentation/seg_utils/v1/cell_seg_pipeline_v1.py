@@ -1,5 +1,6 @@
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from os.path import join
 
 import numpy as np
@@ -33,23 +34,26 @@ class CellSegPipeV1(CellSegPipe):
         if not self.is_list:
             self.mkdir_subpkg()
             mask_list, x_list, y_list, _, _ = utils.split(self.post_mask_list[0], self.deep_crop_size)
-            mask_list_outline = map(utils.outline, mask_list)
-            mask_list_outline = [mask for mask in mask_list_outline]
             score_list, _, _, _, _ = utils.split(self.score_mask_list[0], self.deep_crop_size)
-            for idx, img in enumerate(mask_list):
-                shapes = self.img_list[0].shape
-                tifffile.imsave(
-                    os.path.join(self.subpkg_mask,
-                                 self.file_name[0] + '_' + str(shapes[0]) + '_' + str(shapes[1]) + '_' +
-                                 str(x_list[idx]) + '_' + str(y_list[idx]) + '.tif'), img)
-                tifffile.imsave(
-                    os.path.join(self.subpkg_mask_outline,
-                                 self.file_name[0] + '_' + str(shapes[0]) + '_' + str(shapes[1]) + '_' +
-                                 str(x_list[idx]) + '_' + str(y_list[idx]) + '.tif'), mask_list_outline[idx])
-                tifffile.imsave(
-                    os.path.join(self.subpkg_score,
-                                 self.file_name[0] + '_' + str(shapes[0]) + '_' + str(shapes[1]) + '_' +
-                                 str(x_list[idx]) + '_' + str(y_list[idx]) + '.tif'), score_list[idx])
+            shapes = self.img_list[0].shape
+            name_prefix = f'{self.file_name[0]}_{shapes[0]}_{shapes[1]}'
+            # the tiles are independent files, write them from a thread pool so the disk writes overlap
+            with ThreadPoolExecutor() as executor:
+                futures = []
+                for idx, img in enumerate(mask_list):
+                    tile_name = f'{name_prefix}_{x_list[idx]}_{y_list[idx]}.tif'
+                    futures.append(executor.submit(tifffile.imsave, os.path.join(self.subpkg_mask, tile_name), img))
+                    futures.append(executor.submit(self._save_outline,
+                                                   os.path.join(self.subpkg_mask_outline, tile_name), img))
+                    futures.append(executor.submit(tifffile.imsave, os.path.join(self.subpkg_score, tile_name),
+                                                   score_list[idx]))
+                for future in futures:
+                    future.result()
+
+    @staticmethod
+    def _save_outline(path, mask):
+        # cv2 releases the GIL, so the outlines of different tiles are traced concurrently as well
+        tifffile.imsave(path, utils.outline(mask))
 
     def get_roi(self):
         for idx, tissue_mask in enumerate(self.tissue_mask):
@@ -59,11 +63,9 @@ class CellSegPipeV1(CellSegPipe):
             # remove noise tissue mask
             filtered_props = self.filter_roi(props)
             if len(props) != len(filtered_props):
-                tissue_mask_filter = np.zeros((tissue_mask.shape), dtype=np.uint8)
-                for tissue_tile in filtered_props:
-                    bbox = tissue_tile['bbox']
-                    tissue_mask_filter[bbox[0]: bbox[2], bbox[1]: bbox[3]] += tissue_tile['image']
-                self.tissue_mask[idx] = np.uint8(tissue_mask_filter > 0)
+                # each region's image is exactly its own label inside the bbox, so keep those labels in one pass
+                kept_labels = [p['label'] for p in filtered_props]
+                self.tissue_mask[idx] = np.isin(label_image, kept_labels).astype(np.uint8)
             self.tissue_num.append(len(filtered_props))
             self.tissue_bbox.append([p['bbox'] for p in filtered_props])
 
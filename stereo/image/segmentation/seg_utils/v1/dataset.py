@@ -1,4 +1,3 @@
-import torch
 from albumentations import Compose
 from albumentations.pytorch import ToTensorV2
 from torch.utils.data import Dataset
@@ -26,6 +25,5 @@ class data_batch(Dataset):
         augmented = self.transforms(image=img)
         img = augmented['image']
 
-        image = torch.cat((img, img), 0)
-
-        return image
+        # the model takes the image twice along the channels, that duplication is done on the device by the caller
+        return img
@@ -453,7 +453,8 @@ def view_bar(message, id, total, end=''):
 
 
 def split(image, cut_size, overlap=100):
-    image = np.array(image)
+    # full tiles are views of `image`, only the tiles on the bottom and right edges are copied for padding
+    image = np.asarray(image)
     shapes = image.shape
     x_nums = (shapes[0] - overlap) // (cut_size - overlap)
     y_nums = (shapes[1] - overlap) // (cut_size - overlap)
@@ -472,16 +473,14 @@ def split(image, cut_size, overlap=100):
             x_end = min(x_begin + cut_size, shapes[0])
             y_end = min(y_begin + cut_size, shapes[1])
             i = image[x_begin: x_end, y_begin: y_end]
-            if i.shape[0] < cut_size:
-                height_add = cut_size - i.shape[0]
-                patch_shape = (height_add, i.shape[1], i.shape[2]) if len(i.shape) == 3 else (height_add, i.shape[1])
-                patch = np.zeros(shape=patch_shape, dtype=i.dtype)
-                i = np.concatenate([i, patch], axis=0)
-            if i.shape[1] < cut_size:
-                width_add = cut_size - i.shape[1]
-                patch_shape = (i.shape[0], width_add, i.shape[2]) if len(i.shape) == 3 else (i.shape[0], width_add)
-                patch = np.zeros(shape=patch_shape, dtype=i.dtype)
-                i = np.concatenate([i, patch], axis=1)
+            if i.shape[0] < cut_size or i.shape[1] < cut_size:
+                if i.shape[0] < cut_size:
+                    height_add = cut_size - i.shape[0]
+                if i.shape[1] < cut_size:
+                    width_add = cut_size - i.shape[1]
+                padded = np.zeros((cut_size, cut_size) + i.shape[2:], dtype=i.dtype)
+                padded[:i.shape[0], :i.shape[1]] = i
+                i = padded
             x_list.append(x_begin)
             y_list.append(y_begin)
             img_list.append(i)
@@ -550,7 +549,7 @@ def czi2tif(path):
 
 
 def outline(image):
-    image = np.where(image != 0, 1, 0).astype(np.uint8)
+    image = (image != 0).astype(np.uint8)
     edge = np.zeros((image.shape), dtype=np.uint8)
     contours, hierachy = cv2.findContours(image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     r = cv2.drawContours(edge, contours, -1, (255, 255, 255), 1)
@@ -73,19 +73,19 @@ def cellInfer(file, size, model_path, overlap=100):
         merge_label = image
         merge_label.fill(0)
         x_list, y_list, ori_size = dataset.get_list()
-        test_dataloader = torch.utils.data.DataLoader(dataset, batch_size=20)
+        # copy the uint8 batch from pinned memory and cast on the device, a quarter of the bytes of a float copy
+        test_dataloader = torch.utils.data.DataLoader(dataset, batch_size=20, pin_memory=device.type == 'cuda')
         img_idx = 0
         for batch in tqdm(test_dataloader, ncols=80):
             img = batch
-            img = img.type(torch.FloatTensor)
-            img = img.to(device)
+            img = img.to(device, non_blocking=True).float()
+            img = torch.cat((img, img), 1)
 
-            pred_mask = model(img)
+            with torch.no_grad():
+                pred_mask = model(img)
             bacth_size = len(pred_mask)
-            pred_mask = torch.sigmoid(pred_mask).detach().cpu().numpy()
-            pred = pred_mask[:, 0, :, :]
-            pred[:] = (pred[:] < 0.55) * 255
-            pred1 = pred.astype(np.uint8)
+            # threshold on the device and bring back only the first channel as uint8
+            pred1 = ((torch.sigmoid(pred_mask[:, 0, :, :]) < 0.55).to(torch.uint8) * 255).cpu().numpy()
             for i in range(bacth_size):
                 temp_img = pred1[i][:ori_size[i + img_idx][0], :ori_size[i + img_idx][1]]
                 info = [x_list[i + img_idx], y_list[i + img_idx]]
@@ -38,8 +38,10 @@ class CellSegPipeV1Pro(CellSegPipe):
                     tiss_bbox_tep = tissue_bbox[i]
                     label_filter = np.multiply(
                         label[i],
-                        self.tissue_mask[idx][tiss_bbox_tep[0]: tiss_bbox_tep[2], tiss_bbox_tep[1]: tiss_bbox_tep[3]]
-                    ).astype(np.uint8)
+                        self.tissue_mask[idx][tiss_bbox_tep[0]: tiss_bbox_tep[2], tiss_bbox_tep[1]: tiss_bbox_tep[3]],
+                        dtype=np.uint8,
+                        casting='unsafe'
+                    )
                     label_filter_list.append(label_filter)
                 else:
                     label_filter_list.append(label[i])
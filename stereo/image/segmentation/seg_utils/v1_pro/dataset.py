@@ -78,9 +78,8 @@ class data_batch2(Dataset):
         augmented = self.transforms(image=pad_img)
         pad_img = augmented['image']
 
-        image = torch.cat((pad_img, pad_img), 0)
-
-        return image
+        # the model takes the image twice along the channels, that duplication is done on the device by the caller
+        return pad_img
 
     def get_list(self):
         return (self.x_list, self.y_list, self.ori_size)
@@ -22,7 +22,7 @@ def get_reduce_x(data, data_key='reduce_dim'):
 
 
 def get_position_array(data, obs_key='spatial'):
-    return np.array(data.obsm[obs_key])[:, 0: 2]
+    return np.asarray(data.obsm[obs_key])[:, 0: 2]
 
 
 def get_degs_res(data, group_key, data_key='find_marker', top_k=None):
@@ -1,21 +1,29 @@
 import os
 from collections import OrderedDict
 
+import datashader as ds
 import holoviews as hv
 import hvplot.pandas  # noqa
 import hvplot.xarray  # noqa
 import numpy as np
 import panel as pn
+import pyarrow as pa
 import spatialpandas as spd
 import tifffile as tif
 import xarray as xr
-from bokeh.models import HoverTool
+from bokeh.models import (
+    CustomJSHover,
+    HoverTool
+)
 from natsort import natsorted
 
 from stereo.stereo_config import stereo_conf
 
 
 class PlotCells:
+    # above this many cells the polygons are rasterized by datashader rather than sent to the browser as glyphs
+    DATASHADE_CELLS_THRESHOLD = 200000
+
     def __init__(
             self,
             data,
@@ -34,6 +42,13 @@ class PlotCells:
             n = len(self.cluster_id)
             cmap = stereo_conf.get_colors('stereo_30', n)
             self.cluster_color_map = OrderedDict({k: v for k, v in zip(self.cluster_id, cmap)})
+            # the tooltip column ships small integer codes, the names are looked up on the browser side
+            uniq_cluster, cluster_inverse = np.unique(self.cluster_res, return_inverse=True)
+            cluster_id_idx = {c: i for i, c in enumerate(self.cluster_id)}
+            remap = np.array(
+                [cluster_id_idx[c] for c in uniq_cluster.tolist()], dtype=np.min_scalar_type(max(n - 1, 0))
+            )
+            self.cluster_codes = remap[cluster_inverse]
         else:
             self.cluster_res = None
             self.cluster_id = []
@@ -54,6 +69,8 @@ class PlotCells:
         self.hover_fg_alpha = self.fg_alpha / 2
         self.figure_polygons = None
         self.figure_points = None
+        self._base_image_xarray = None
+        self._polygons_columns = None
 
     def _set_width_and_height(self, width, height):
         if width is None or height is None:
@@ -65,60 +82,65 @@ class PlotCells:
             return width, height
         return width, height
 
-    def _get_base_image_boundary(self, image_data: np.ndarray):
+    def _get_base_image_boundary(self, image_data: np.ndarray, block_rows: int = 4096):
+        # scan a block of rows at a time, so a memory-mapped image is never loaded as a whole
         min_x, max_x, min_y, max_y = -1, -1, -1, -1
-        col_sum = image_data.sum(axis=0)
-        nonzero_idx = np.nonzero(col_sum)[0]
+        row_any = np.zeros(image_data.shape[0], dtype=bool)
+        for start in range(0, image_data.shape[0], block_rows):
+            row_any[start:start + block_rows] = np.any(image_data[start:start + block_rows], axis=1)
+        nonzero_idx = np.flatnonzero(row_any)
         if nonzero_idx.size > 0:
-            min_x, max_x = np.min(nonzero_idx), np.max(nonzero_idx)
-
-        row_sum = image_data.sum(axis=1)
-        nonzero_idx = np.nonzero(row_sum)[0]
-        if nonzero_idx.size > 0:
-            min_y, max_y = np.min(nonzero_idx), np.max(nonzero_idx)
+            min_y, max_y = nonzero_idx[0], nonzero_idx[-1]
+            # the columns only have to be scanned within the rows holding any signal
+            col_any = np.zeros(image_data.shape[1], dtype=bool)
+            for start in range(min_y, max_y + 1, block_rows):
+                col_any |= np.any(image_data[start:min(start + block_rows, max_y + 1)], axis=0)
+            nonzero_idx = np.flatnonzero(col_any)
+            min_x, max_x = nonzero_idx[0], nonzero_idx[-1]
 
         return min_x, max_x, min_y, max_y
 
     def _create_base_image_xarray(self):
+        # the base image does not depend on any widget, read and crop it once for all the re-renders
+        if self._base_image_xarray is not None:
+            return self._base_image_xarray
         assert os.path.exists(self.base_image), f'{self.base_image} is not exists!'
 
-        image_data = tif.imread(self.base_image)
+        try:
+            image_data = tif.memmap(self.base_image, mode='r')
+        except ValueError:
+            # compressed or tiled images can not be memory-mapped
+            image_data = tif.imread(self.base_image)
         min_x, max_x, min_y, max_y = self._get_base_image_boundary(image_data)
         if min_x == -1 or max_x == -1 or min_y == -1 or max_y == -1:
             raise Exception("the base image is empty.")
         max_x += 1
         max_y += 1
-        image_data = image_data[min_y:max_y, min_x:max_x]
+        image_data = np.ascontiguousarray(image_data[min_y:max_y, min_x:max_x])
         image_xarray = xr.DataArray(data=image_data, coords=[range(min_y, max_y), range(min_x, max_x)], dims=['y', 'x'])
+        self._base_image_xarray = image_xarray
         return image_xarray
 
     def _create_polygons(self, color_by):
-        polygons = []
-        color = []
-        position = []
-        for i, cell_border in enumerate(self.data.cells.cell_border):
-            cell_border = cell_border[cell_border[:, 0] < 32767] + self.data.position[i]
-            cell_border = cell_border.reshape((-1,)).tolist()
-            polygons.append([cell_border])
-            if color_by == 'total_count':
-                color.append(self.data.cells.total_counts[i])
-            elif color_by == 'n_genes_by_counts':
-                color.append(self.data.cells.n_genes_by_counts[i])
-            elif color_by == 'cluster':
-                color.append(self.cluster_res[i] if self.cluster_res is not None else self.data.cells.total_counts[i])
-            else:
-                color.append(self.data.cells.total_counts[i])
-            position.append(str(tuple(self.data.position[i].astype(np.uint32))))
+        if color_by == 'n_genes_by_counts':
+            color = self.data.cells.n_genes_by_counts
+        elif color_by == 'cluster' and self.cluster_res is not None:
+            color = self.cluster_res
+        else:
+            color = self.data.cells.total_counts
 
-        polygons = spd.geometry.PolygonArray(polygons)
+        # only the color depends on the widgets, the geometry and the other columns are built once
+        if self._polygons_columns is None:
+            self._polygons_columns = self._create_polygons_columns()
+        columns = self._polygons_columns
         polygons_detail = spd.GeoDataFrame({
-            'polygons': polygons,
+            'polygons': columns['polygons'],
             'color': color,
-            'position': position,
-            'total_counts': self.data.cells.total_counts.astype(np.uint32),
-            'pct_counts_mt': self.data.cells.pct_counts_mt,
-            'n_genes_by_counts': self.data.cells.n_genes_by_counts.astype(np.uint32),
-            'cluster_id': np.zeros_like(self.data.cell_names) if self.cluster_res is None else self.cluster_res
+            'position': columns['position'],
+            'total_counts': columns['total_counts'],
+            'pct_counts_mt': columns['pct_counts_mt'],
+            'n_genes_by_counts': columns['n_genes_by_counts'],
+            'cluster_id': columns['cluster_id']
         })
 
         tooltips = [
@@ -127,13 +149,44 @@ class PlotCells:
             ('Pct Counts Mt', '@pct_counts_mt'),
             ('nGenes By Counts', '@n_genes_by_counts'),
             ('Cluster Id', '@cluster_id')]
-        hover_tool = HoverTool(tooltips=tooltips)
+        if self.cluster_res is None:
+            hover_tool = HoverTool(tooltips=tooltips)
+        else:
+            tooltips[-1] = ('Cluster Id', '@cluster_id{custom}')
+            hover_tool = HoverTool(
+                tooltips=tooltips,
+                formatters={'@cluster_id': CustomJSHover(args={'levels': self.cluster_id}, code='return levels[value]')}
+            )
 
         vdims = polygons_detail.columns.tolist()
         vdims.remove('polygons')
 
         return polygons_detail, hover_tool, vdims
 
+    def _create_polygons_columns(self):
+        # the borders are padded with 32767 to a common length, keep the valid points of all cells in one pass
+        cell_borders = self.data.cells.cell_border
+        valid = cell_borders[:, :, 0] < 32767
+        points_count = valid.sum(axis=1)
+        # offset only the valid points, by their cell's position repeated once per point
+        coordinates = cell_borders[valid] + np.repeat(self.data.position, points_count, axis=0)
+        coordinates = coordinates.reshape((-1,)).astype(np.float64)
+        # each polygon is a single ring, build the nested arrow lists from offsets instead of python lists
+        ring_offsets = np.zeros(valid.shape[0] + 1, dtype=np.int32)
+        np.cumsum(points_count * 2, out=ring_offsets[1:])
+        rings = pa.ListArray.from_arrays(pa.array(ring_offsets), pa.array(coordinates))
+        polygons = pa.ListArray.from_arrays(pa.array(np.arange(valid.shape[0] + 1, dtype=np.int32)), rings)
+
+        position = [f'({x}, {y})' for x, y in self.data.position.astype(np.uint32).tolist()]
+        return {
+            'polygons': spd.geometry.PolygonArray(polygons),
+            'position': np.array(position, dtype=object),
+            'total_counts': self.data.cells.total_counts.astype(np.uint32),
+            'pct_counts_mt': self.data.cells.pct_counts_mt,
+            'n_genes_by_counts': self.data.cells.n_genes_by_counts.astype(np.uint32),
+            'cluster_id': np.zeros_like(self.data.cell_names) if self.cluster_res is None else self.cluster_codes
+        }
+
     def _create_widgets(self):
         self.color_map_key_continuous = pn.widgets.Select(
             value='stereo', options=list(stereo_conf.linear_colormaps.keys()), name='color theme', width=200
@@ -239,28 +292,56 @@ class PlotCells:
                 self.cluster_color_map[self.cluster.value] = cluster_colorpicker_value
                 cmap = list(self.cluster_color_map.values())
 
-            self.figure_polygons = polygons_detail.hvplot.polygons(
-                'polygons', hover_cols=vdims
-            ).opts(
-                bgcolor=self.bgcolor,
-                color='color' if self.cluster_res is None or color_by_value != 'cluster' else hv.dim(
-                    'color').categorize(self.cluster_color_map),
-                cnorm='eq_hist',
-                cmap=cmap,
-                colorbar=False,
-                width=self.width,
-                height=self.height,
-                xaxis='bare',
-                yaxis='bare',
-                invert_yaxis=True,
-                line_width=1,
-                line_alpha=0,
-                hover_line_alpha=1,
-                fill_alpha=self.fg_alpha,
-                hover_fill_alpha=self.hover_fg_alpha,
-                active_tools=['wheel_zoom'],
-                tools=[hover_tool]
-            )
+            if len(self.data.cell_names) > self.DATASHADE_CELLS_THRESHOLD:
+                # too many glyphs for the browser, rasterize the polygons on the server side instead
+                if self.cluster_res is None or color_by_value != 'cluster':
+                    aggregator = ds.mean('color')
+                else:
+                    polygons_detail['color'] = polygons_detail['color'].astype('category')
+                    aggregator = ds.count_cat('color')
+                    cmap = self.cluster_color_map
+                self.figure_polygons = polygons_detail.hvplot.polygons(
+                    'polygons', c='color', cmap=cmap, cnorm='eq_hist', aggregator=aggregator,
+                    datashade=True, dynspread=True
+                ).opts(
+                    bgcolor=self.bgcolor,
+                    width=self.width,
+                    height=self.height,
+                    xaxis='bare',
+                    yaxis='bare',
+                    invert_yaxis=True,
+                    active_tools=['wheel_zoom']
+                )
+            else:
+                if self.cluster_res is None or color_by_value != 'cluster':
+                    color = 'color'
+                else:
+                    # map the cluster codes to their colors with one take instead of categorizing the names
+                    palette = np.array(list(self.cluster_color_map.values()), dtype=object)
+                    polygons_detail['cell_color'] = palette[self.cluster_codes]
+                    color = 'cell_color'
+                    vdims = vdims + [color]
+                self.figure_polygons = polygons_detail.hvplot.polygons(
+                    'polygons', hover_cols=vdims
+                ).opts(
+                    bgcolor=self.bgcolor,
+                    color=color,
+                    cnorm='eq_hist',
+                    cmap=cmap,
+                    colorbar=False,
+                    width=self.width,
+                    height=self.height,
+                    xaxis='bare',
+                    yaxis='bare',
+                    invert_yaxis=True,
+                    line_width=1,
+                    line_alpha=0,
+                    hover_line_alpha=1,
+                    fill_alpha=self.fg_alpha,
+                    hover_fill_alpha=self.hover_fg_alpha,
+                    active_tools=['wheel_zoom'],
+                    tools=[hover_tool]
+                )
 
             if self.base_image is not None:
                 base_image_points_detail = self._create_base_image_xarray()
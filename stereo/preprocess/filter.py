@@ -23,7 +23,8 @@ import pandas as pd
 from stereo.core.stereo_exp_data import StereoExpData
 from .qc import (
     cal_cells_indicators,
-    cal_genes_indicators
+    cal_genes_indicators,
+    mark_cells_indicators
 )
 
 
@@ -54,25 +55,24 @@ def filter_cells(
     if min_gene is None and max_gene is None and cell_list is None and min_n_genes_by_counts is None \
             and max_n_genes_by_counts is None and pct_counts_mt is None:
         raise ValueError('At least one filter must be set.')
-    cal_cells_indicators(data)
+    cal_cells_indicators(data, use_cache=True)
+    # every threshold reads a per-cell indicator, so AND them into one mask and subset the matrix once
+    cell_subset = np.ones(data.shape[0], dtype=bool)
     if min_gene:
-        cell_subset = data.cells.total_counts >= min_gene
-        data.sub_by_index(cell_index=cell_subset)
+        cell_subset &= data.cells.total_counts >= min_gene
     if max_gene:
-        cell_subset = data.cells.total_counts <= max_gene
-        data.sub_by_index(cell_index=cell_subset)
+        cell_subset &= data.cells.total_counts <= max_gene
     if min_n_genes_by_counts:
-        cell_subset = data.cells.n_genes_by_counts >= min_n_genes_by_counts
-        data.sub_by_index(cell_index=cell_subset)
+        cell_subset &= data.cells.n_genes_by_counts >= min_n_genes_by_counts
     if max_n_genes_by_counts:
-        cell_subset = data.cells.n_genes_by_counts <= max_n_genes_by_counts
-        data.sub_by_index(cell_index=cell_subset)
+        cell_subset &= data.cells.n_genes_by_counts <= max_n_genes_by_counts
     if pct_counts_mt:
-        cell_subset = data.cells.pct_counts_mt <= pct_counts_mt
-        data.sub_by_index(cell_index=cell_subset)
+        cell_subset &= data.cells.pct_counts_mt <= pct_counts_mt
     if cell_list is not None:
-        cell_subset = np.isin(data.cells.cell_name, cell_list)
-        data.sub_by_index(cell_index=cell_subset)
+        cell_subset &= np.isin(data.cells.cell_name, cell_list)
+    data.sub_by_index(cell_index=cell_subset)
+    # per-cell indicators are sliced along with the rows, so they still describe the new matrix
+    mark_cells_indicators(data)
     return data
 
 
@@ -100,18 +100,16 @@ def filter_genes(
     if min_cell is None and max_cell is None and gene_list is None and mean_umi_gt is None:
         raise ValueError('please set any of `min_cell` or `max_cell` or `gene_list` or `mean_umi_gt`')
     cal_genes_indicators(data)
+    gene_subset = np.ones(data.shape[1], dtype=bool)
     if min_cell:
-        gene_subset = data.genes.n_cells >= min_cell
-        data.sub_by_index(gene_index=gene_subset)
+        gene_subset &= data.genes.n_cells >= min_cell
     if max_cell:
-        gene_subset = data.genes.n_cells <= max_cell
-        data.sub_by_index(gene_index=gene_subset)
+        gene_subset &= data.genes.n_cells <= max_cell
     if gene_list is not None:
-        gene_subset = np.isin(data.gene_names, gene_list)
-        data.sub_by_index(gene_index=gene_subset)
+        gene_subset &= np.isin(data.gene_names, gene_list)
     if mean_umi_gt is not None:
-        gene_subset = data.genes.mean_umi > mean_umi_gt
-        data.sub_by_index(gene_index=gene_subset)
+        gene_subset &= data.genes.mean_umi > mean_umi_gt
+    data.sub_by_index(gene_index=gene_subset)
     return data
 
 
@@ -139,16 +137,18 @@ def filter_coordinates(
     none_param = [i for i in [min_x, min_y, max_x, max_y] if i is None]
     if len(none_param) == 4:
         raise ValueError('Only provide one of the optional parameters `min_x`, `min_y`, `max_x`, `max_y` per call.')
-    pos = data.position
-    obs_subset = np.full(pos.shape[0], True)
+    # contiguous copies of the coordinate columns, the comparisons below then run on stride-1 data
+    pos_x = np.ascontiguousarray(data.position[:, 0])
+    pos_y = np.ascontiguousarray(data.position[:, 1])
+    obs_subset = np.full(pos_x.shape[0], True)
     if min_x:
-        obs_subset &= pos[:, 0] >= min_x
+        obs_subset &= pos_x >= min_x
     if min_y:
-        obs_subset &= pos[:, 1] >= min_y
+        obs_subset &= pos_y >= min_y
     if max_x:
-        obs_subset &= pos[:, 0] <= max_x
+        obs_subset &= pos_x <= max_x
     if max_y:
-        obs_subset &= pos[:, 1] <= max_y
+        obs_subset &= pos_y <= max_y
     data.sub_by_index(cell_index=obs_subset)
     cal_genes_indicators(data)
     return data
@@ -6,9 +6,13 @@
 @file:qc.py
 @time:2021/03/26
 """
+import weakref
+
 import numpy as np
 from scipy.sparse import issparse
 
+from ..utils.spmatrix_helper import content_fingerprint
+
 
 def cal_qc(data):
     """
@@ -23,14 +27,47 @@ def cal_qc(data):
     return data
 
 
-def cal_cells_indicators(data):
+def cal_cells_indicators(data, use_cache=False):
+    """
+    calculate the per-cell indicators `total_counts`, `n_genes_by_counts` and `pct_counts_mt`.
+
+    :param data: the StereoExpData object.
+    :param use_cache: skip the calculation if the indicators were calculated on the current expression matrix
+        and its values have not changed since.
+    :return: StereoExpData object storing the per-cell indicators.
+    """
+    if use_cache and cells_indicators_valid(data):
+        return data
     exp_matrix = data.exp_matrix
     data.cells.total_counts = cal_total_counts(exp_matrix)
     data.cells.n_genes_by_counts = cal_n_genes_by_counts(exp_matrix)
     data.cells.pct_counts_mt = cal_pct_counts_mt(data)
+    mark_cells_indicators(data)
     return data
 
 
+def mark_cells_indicators(data):
+    """
+    record that the per-cell indicators match the current expression matrix, call it again after a pure row subset.
+    """
+    data._cells_indicators_ref = (weakref.ref(data.exp_matrix), content_fingerprint(data.exp_matrix))
+
+
+def invalidate_cells_indicators(data):
+    """
+    drop the record of `mark_cells_indicators`, needed when the expression matrix is modified in place.
+    """
+    data._cells_indicators_ref = None
+
+
+def cells_indicators_valid(data):
+    # the matrix may have been modified in place outside of the pipeline, so its values are checked as well
+    ref = getattr(data, '_cells_indicators_ref', None)
+    if ref is None or ref[0]() is not data.exp_matrix or ref[1] is None:
+        return False
+    return ref[1] == content_fingerprint(data.exp_matrix)
+
+
 def cal_genes_indicators(data):
     exp_matrix = data.exp_matrix
     data.genes.n_cells = cal_n_cells(exp_matrix)
@@ -7,7 +7,6 @@ import time
 from multiprocessing import cpu_count
 from typing import Literal
 
-import numba
 import numpy as np
 import pandas as pd
 from gefpy import (
@@ -27,36 +26,66 @@ from ..utils.time_consume import TimeConsume
 from ..utils.time_consume import log_consumed_time
 
 
+def is_up_to_date(output_path, *input_paths):
+    """
+    Check whether `output_path` exists and is not older than any of `input_paths`.
+    """
+    if not os.path.exists(output_path):
+        return False
+    output_mtime = os.path.getmtime(output_path)
+    return all(output_mtime >= os.path.getmtime(input_path) for input_path in input_paths)
+
+
+def write_atomically(output_path, write):
+    """
+    Call `write` with a temporary path next to `output_path` and move the finished file into place,
+    so an interrupted run never leaves a truncated file at `output_path`.
+    """
+    dir_name, file_name = os.path.split(output_path)
+    tmp_path = os.path.join(dir_name, f"tmp.{file_name}")
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 @log_consumed_time
-@numba.njit(cache=True, parallel=True, nogil=True)
-def generate_cell_and_dnb(adjusted_data: np.ndarray):
-    cells_list = adjusted_data[:, 3]
-    cells_idx_sorted = np.argsort(cells_list)
-    adjusted_data = adjusted_data[cells_idx_sorted]
-    cell_data = []
-    dnb_data = []
-    last_cell = -1
-    cellid = -1
-    offset = -1
-    count = -1
-    for i, row in enumerate(adjusted_data):
-        current_cell = row[3]
-        if current_cell != last_cell:
-            if last_cell >= 0:
-                cell_data.append((cellid, offset, count))
-            cellid, offset, count = current_cell, i, 1
-            last_cell = current_cell
-        else:
-            count += 1
-        dnb_data.append((row[0], row[1], row[2], row[4]))
-    cell_data.append((cellid, offset, count))
-    return cell_data, dnb_data
+def generate_cell_and_dnb(adjusted_data: pd.DataFrame):
+    # group the dnbs by cell label, each cell points to its contiguous run of dnbs in the sorted order
+    labels = adjusted_data['label'].to_numpy().astype(np.uint32, copy=False)
+    order = np.argsort(labels, kind='stable')
+    cellid, offset, count = np.unique(labels[order], return_index=True, return_counts=True)
+    cell_type = np.dtype({
+        'names': ['cellid', 'offset', 'count'],
+        'formats': [np.uint32, np.uint32, np.uint32]
+    }, align=True)
+    dnb_type = np.dtype({
+        'names': ['x', 'y', 'count', 'gene_id'],
+        'formats': [np.int32, np.int32, np.uint16, np.uint32]
+    }, align=True)
+    cell = np.empty(cellid.size, dtype=cell_type)
+    cell['cellid'] = cellid
+    cell['offset'] = offset
+    cell['count'] = count
+    # gather every column straight into its field instead of packing all the columns into one array first
+    dnb = np.empty(adjusted_data.shape[0], dtype=dnb_type)
+    dnb['x'] = adjusted_data['x'].to_numpy()[order]
+    dnb['y'] = adjusted_data['y'].to_numpy()[order]
+    dnb['count'] = adjusted_data['UMICount'].to_numpy()[order]
+    dnb['gene_id'] = adjusted_data['geneid'].to_numpy()[order]
+    return cell, dnb
 
 
 class CellCorrect(object):
 
-    def __init__(self, gem_path=None, bgef_path=None, raw_cgef_path=None, mask_path=None, out_dir=None):
+    def __init__(self, gem_path=None, bgef_path=None, raw_cgef_path=None, mask_path=None, out_dir=None,
+                 reuse_existing=False):
         self.tc = TimeConsume()
+        self.reuse_existing = reuse_existing
         self.gem_path = gem_path
         self.bgef_path = bgef_path
         self.raw_cgef_path = raw_cgef_path
@@ -104,19 +133,32 @@ class CellCorrect(object):
     def generate_bgef(self, threads=10):
         file_name = self.get_file_name('bgef')
         bgef_path = os.path.join(self.out_dir, file_name)
-        if os.path.exists(bgef_path):
-            os.remove(bgef_path)
-        bgef_writer_cy.generate_bgef(self.gem_path, bgef_path, n_thread=threads, bin_sizes=[1])
+        if self.reuse_existing and is_up_to_date(bgef_path, self.gem_path):
+            logger.info(f"{bgef_path} is newer than {self.gem_path}, skip generating it")
+            return bgef_path
+        write_atomically(
+            bgef_path,
+            lambda path: bgef_writer_cy.generate_bgef(self.gem_path, path, n_thread=threads, bin_sizes=[1])
+        )
         return bgef_path
 
     def generate_cgef_with_mask(self, mask_path, ext_in_ext):
-        file_name = self.get_file_name(f'{ext_in_ext}.cellbin.gef')
+        if self.reuse_existing:
+            # the name of a reusable file must tell which mask it was generated from
+            mask_name = os.path.basename(mask_path).split('.')[0]
+            file_name = self.get_file_name(f'{mask_name}.{ext_in_ext}.cellbin.gef')
+        else:
+            file_name = self.get_file_name(f'{ext_in_ext}.cellbin.gef')
         cgef_path = os.path.join(self.out_dir, file_name)
+        if self.reuse_existing and is_up_to_date(cgef_path, self.bgef_path, mask_path):
+            logger.info(f"{cgef_path} is newer than {self.bgef_path} and {mask_path}, skip generating it")
+            return cgef_path
         logger.info(f"start to generate cellbin gef ({cgef_path})")
-        if os.path.exists(cgef_path):
-            os.remove(cgef_path)
         tk = self.tc.start()
-        cgef_writer_cy.generate_cgef(cgef_path, self.bgef_path, mask_path, [256, 256])
+        write_atomically(
+            cgef_path,
+            lambda path: cgef_writer_cy.generate_cgef(path, self.bgef_path, mask_path, [256, 256])
+        )
         logger.info(
             f"generate cellbin gef finished, time consumed : {self.tc.get_time_consumed(key=tk, restart=False)}")
         return cgef_path
@@ -153,18 +195,7 @@ class CellCorrect(object):
 
     @log_consumed_time
     def generate_adjusted_cgef(self, adjusted_data: pd.DataFrame, outline_path):
-        adjusted_data_np = adjusted_data[['x', 'y', 'UMICount', 'label', 'geneid']].to_numpy(dtype=np.uint32)
-        cell_data, dnb_data = generate_cell_and_dnb(adjusted_data_np)
-        cell_type = np.dtype({
-            'names': ['cellid', 'offset', 'count'],
-            'formats': [np.uint32, np.uint32, np.uint32]
-        }, align=True)
-        dnb_type = np.dtype({
-            'names': ['x', 'y', 'count', 'gene_id'],
-            'formats': [np.int32, np.int32, np.uint16, np.uint32]
-        }, align=True)
-        cell = np.array(cell_data, dtype=cell_type)
-        dnb = np.array(dnb_data, dtype=dnb_type)
+        cell, dnb = generate_cell_and_dnb(adjusted_data)
         file_name = self.get_file_name('adjusted.cellbin.gef')
         cgef_file_adjusted = os.path.join(self.out_dir, file_name)
         if os.path.exists(cgef_file_adjusted):
@@ -280,6 +311,7 @@ def cell_correct(out_dir: str,
                  only_save_result: bool = False,
                  method: Literal['GMM', 'FAST', 'EDM'] = 'EDM',
                  distance: int = 10,
+                 reuse_existing: bool = False,
                  **kwargs
                  ):
     """
@@ -302,12 +334,14 @@ def cell_correct(out_dir: str,
 	:param only_save_result: if `True`, only save result to disk; if `False`, return an StereoExpData object.
     :param method: correct in different method if `method` is set, otherwise `EDM`.
     :param distance: outspread distance based on cellular contour of cell segmentation image, in pixels, only available for 'EDM' method.
+    :param reuse_existing: if `True`, reuse the BGEF and cellbin GEF files in `out_dir` which are newer than their input files instead of generating them again,
+                the cellbin GEF files are named after the mask they are generated from in this case, defaults to False.
 
     :return: An StereoExpData object if `only_save_result` is set to `False`, 
                 otherwise the path of corrected CGEF file.
     """  # noqa
 
     cc = CellCorrect(gem_path=gem_path, bgef_path=bgef_path, raw_cgef_path=raw_cgef_path, mask_path=mask_path,
-                     out_dir=out_dir)
+                     out_dir=out_dir, reuse_existing=reuse_existing)
     return cc.correcting(threshold=threshold, process_count=process_count, only_save_result=only_save_result,
                          method=method, distance=distance, **kwargs)
@@ -212,7 +212,7 @@ class CellTypeAnno(ToolBase):
         run
         """
         exp_matrix = self.data.exp_matrix().T
-        df = pd.DataFrame(exp_matrix, index=list(self.data.gene_names), columns=list(self.data.cell_names))
+        df = pd.DataFrame(exp_matrix, index=self.data.gene_names, columns=self.data.cell_names)
         datas = self.split_dataframe(df) if self.split_num > 1 else [df]
         tmp_output = os.path.join(self.output, 'tmp')
         logger.info('start to run annotation.')
@@ -18,12 +18,14 @@ import pandas as pd
 from joblib import cpu_count
 from natsort import natsorted
 from scipy import stats
+from scipy.sparse import isspmatrix_csr
 
 from ..algorithm import mannwhitneyu
 from ..algorithm import statistics
 from ..core.tool_base import ToolBase
 from ..log_manager import logger
 from ..utils.data_helper import select_group
+from ..utils.hvg_utils import get_group_mean_var
 from ..utils.time_consume import log_consumed_time
 
 
@@ -125,7 +127,7 @@ class FindMarker(ToolBase):
         else:
             raise TypeError("The type of case_groups must be one of str, int, numpy.ndarray, list or tuple")
 
-    def handle_result(self, g, group_info, all_groups, ranks=None, tie_term=None, control_str='rest'):
+    def handle_result(self, g, group_info, all_groups, ranks=None, tie_term=None, control_str='rest', rank_sums=None):
         if self.control_groups == 'rest':
             other_g = all_groups.copy()
             other_g.remove(g)
@@ -136,8 +138,13 @@ class FindMarker(ToolBase):
         if len(other_g) <= 0:
             return
 
-        g_index = select_group(groups=g, cluster=group_info, all_groups=all_groups)
-        if self.method == 't_test':
+        # a boolean ndarray lets the (sparse) matrix take its row-mask fast path
+        g_index = select_group(groups=g, cluster=group_info, all_groups=all_groups).to_numpy()
+        if self.method == 't_test' and isspmatrix_csr(self.data.exp_matrix):
+            # the mean and variance of both sides are reduced straight from the csr, no sub-matrix is sliced
+            group_stats, rest_stats = get_group_mean_var(self.data.exp_matrix, g_index)
+            result = statistics.ttest(None, None, self.corr_method, group_stats, rest_stats)
+        elif self.method == 't_test':
             result = statistics.ttest(self.data.exp_matrix[g_index], self.data.exp_matrix[~g_index], self.corr_method)
         elif self.method == 'logreg':
             if self.temp_logres_score is None:
@@ -149,17 +156,20 @@ class FindMarker(ToolBase):
                 g
             )
         else:
+            group_exp = self.data.exp_matrix[g_index]
+            other_exp = self.data.exp_matrix[~g_index]
             if self.control_groups != 'rest' and self.tie_term:
-                xy = np.vstack((self.data.exp_matrix[g_index].values, self.data.exp_matrix[~g_index].values))
+                xy = np.vstack((group_exp.values, other_exp.values))
                 ranks = stats.rankdata(xy, axis=-1)
                 tie_term = mannwhitneyu.cal_tie_term(ranks)
             result = statistics.wilcoxon(
-                self.data.exp_matrix[g_index],
-                self.data.exp_matrix[~g_index],
+                group_exp,
+                other_exp,
                 self.corr_method,
                 ranks,
                 tie_term,
-                g_index
+                g_index,
+                rank_sums[g] if rank_sums is not None else None
             )
         result['genes'] = self.data.gene_names
         result.sort_values(by=self.sort_by, ascending=self.ascending, inplace=True)
@@ -203,6 +213,7 @@ class FindMarker(ToolBase):
         # only used when method is wilcoxon
         ranks = None
         tie_term = None
+        rank_sums = None
         if self.method == 'wilcoxon_test' and self.control_groups == 'rest':
             self.logger.info('cal rankdata')
             ranks = stats.rankdata(self.data.exp_matrix.T, axis=-1)
@@ -210,6 +221,11 @@ class FindMarker(ToolBase):
             if self.tie_term:
                 tie_term = mannwhitneyu.cal_tie_term(ranks)
             self.logger.info('cal tie_term end')
+            # the rank sums of all case groups come from one product of the shared ranks with the group masks
+            case_masks = np.vstack([
+                select_group(groups=g, cluster=group_info, all_groups=all_groups).to_numpy() for g in case_groups
+            ])
+            rank_sums = dict(zip(case_groups, (ranks @ case_masks.T.astype(ranks.dtype)).T))
         self.temp_logres_score = None
         if self.case_groups == 'all' and self.control_groups == 'rest' and self.method == 'logreg':
             self.temp_logres_score = self.logres_score()
@@ -218,7 +234,7 @@ class FindMarker(ToolBase):
         self.len_case_groups = len(case_groups)
         n_jobs = min(cpu_count(), self.n_jobs)
         Parallel(n_jobs=n_jobs, backend='threading')(
-            delayed(self.handle_result)(g, group_info, all_groups, ranks, tie_term, control_str)
+            delayed(self.handle_result)(g, group_info, all_groups, ranks, tie_term, control_str, rank_sums)
             for g in case_groups
         )
         del self.temp_logres_score
@@ -53,6 +53,9 @@ class HighlyVariableGenes(ToolBase):
         Choose the flavor for identifying highly variable genes. For the dispersion
         based methods in their default workflows, Seurat passes the cutoffs whereas
         Cell Ranger passes `n_top_genes`.
+    :param mean_var
+        Precomputed per-gene means and variances of the whole data, for `flavor='seurat'`
+        over the exponentiated data. Ignored if `groups` is set.
 
     :return:
     """
@@ -64,11 +67,12 @@ class HighlyVariableGenes(ToolBase):
             method: Optional[str] = 'seurat',
             n_top_genes: Optional[int] = 2000,
             min_disp: Optional[float] = 0.5,
-            max_disp: Optional[float] = np.inf,
+            max_disp: Optional[float] = None,
             min_mean: Optional[float] = 0.0125,
             max_mean: Optional[float] = 3,
             span: Optional[float] = 0.3,
             n_bins: int = 20,
+            mean_var: Optional[tuple] = None,
     ):
         self.n_top_genes = n_top_genes
         self.min_disp = min_disp
@@ -77,6 +81,7 @@ class HighlyVariableGenes(ToolBase):
         self.max_mean = max_mean
         self.span = span
         self.n_bins = n_bins
+        self.mean_var = mean_var
         super(HighlyVariableGenes, self).__init__(data=data, groups=groups, method=method)
 
     @ToolBase.method.setter
@@ -91,7 +96,8 @@ class HighlyVariableGenes(ToolBase):
                 self.data.exp_matrix,
                 n_top_genes=self.n_top_genes,
                 span=self.span,
-                batch_info=group_info
+                batch_info=group_info,
+                mean_var=self.mean_var if group_info is None else None
             )
             df.index = self.data.gene_names
         else:
@@ -104,7 +110,8 @@ class HighlyVariableGenes(ToolBase):
                     max_mean=self.max_mean,
                     n_top_genes=self.n_top_genes,
                     n_bins=self.n_bins,
-                    method=self.method
+                    method=self.method,
+                    mean_var=self.mean_var
                 )
                 df.index = self.data.gene_names
             else:
@@ -183,9 +190,10 @@ class HighlyVariableGenes(ToolBase):
                             df.means > self.min_mean,
                             df.means < self.max_mean,
                             df.dispersions_norm > self.min_disp,
-                            df.dispersions_norm < self.max_disp,
                         )
                     )
+                    if self.max_disp is not None:
+                        gene_subset &= (df.dispersions_norm < self.max_disp).to_numpy()
                     df['highly_variable'] = gene_subset
         self.result = df
         self.data.genes.hvgs = np.array(df['highly_variable'])
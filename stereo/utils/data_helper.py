@@ -10,6 +10,7 @@ from math import ceil
 from typing import Optional
 from typing import Union
 
+import numba as nb
 import numpy as np
 import pandas as pd
 import scipy.sparse as sp
@@ -36,30 +37,128 @@ def get_cluster_res(adata, data_key='clustering'):
 
 
 def get_position_array(data, obs_key='spatial'):
-    return np.array(data.obsm[obs_key])[:, 0: 2]
+    return np.asarray(data.obsm[obs_key])[:, 0: 2]
 
 
-def exp_matrix2df(data: StereoExpData, cell_name: Optional[np.ndarray] = None, gene_name: Optional[np.ndarray] = None):
+def _first_index_of(names: pd.Index, query: np.ndarray, kind: str):
+    # position of the first occurrence of each queried name, looked up through a hash index in one pass,
+    # the hash table of `names` is built by pandas once and kept on the index for the following calls
+    if names.is_unique:
+        position = names.get_indexer(query)
+        first_index = None
+    else:
+        uniq_names, first_index = np.unique(names.to_numpy(), return_index=True)
+        position = pd.Index(uniq_names).get_indexer(query)
+    if (position < 0).any():
+        raise ValueError(f"{kind} {np.asarray(query)[position < 0][0]} is not in the data.")
+    return position if first_index is None else first_index[position]
+
+
+@nb.njit(cache=True, nogil=True, parallel=True)
+def _csr_to_dense(indptr, indices, data, rows, col_map, n_cols, dtype_holder):
+    out = np.zeros((rows.size, n_cols), dtype=dtype_holder.dtype)
+    for i in nb.prange(rows.size):
+        r = rows[i]
+        for j in range(indptr[r], indptr[r + 1]):
+            c = col_map[indices[j]]
+            if c >= 0:
+                out[i, c] += data[j]
+    return out
+
+
+def _select_exp(exp_matrix, cell_index, gene_index, dtype, sparse):
+    if isinstance(exp_matrix, np.ndarray) and cell_index is not None and gene_index is not None:
+        x = exp_matrix[np.ix_(cell_index, gene_index)]
+    elif not sparse and sp.isspmatrix_csr(exp_matrix) and (cell_index is not None or gene_index is not None) \
+            and (gene_index is None or np.unique(gene_index).size == len(gene_index)):
+        # gather the selected rows and columns straight into the dense output, without intermediate csr
+        rows = np.arange(exp_matrix.shape[0]) if cell_index is None else np.asarray(cell_index)
+        col_map = np.full(exp_matrix.shape[1], -1, dtype=np.int64)
+        if gene_index is None:
+            col_map[:] = np.arange(exp_matrix.shape[1])
+        else:
+            col_map[gene_index] = np.arange(len(gene_index))
+        x = _csr_to_dense(
+            exp_matrix.indptr, exp_matrix.indices, exp_matrix.data, rows.astype(np.int64), col_map,
+            exp_matrix.shape[1] if gene_index is None else len(gene_index),
+            np.zeros(0, dtype=exp_matrix.dtype if dtype is None else dtype)
+        )
+    else:
+        x = exp_matrix[cell_index, :] if cell_index is not None else exp_matrix
+        x = x[:, gene_index] if gene_index is not None else x
+    if dtype is not None:
+        x = x.astype(dtype, copy=False)
+    return x
+
+
+def exp_matrix2df(
+        data: StereoExpData,
+        cell_name: Optional[np.ndarray] = None,
+        gene_name: Optional[np.ndarray] = None,
+        dtype: Optional[np.dtype] = None,
+        sparse: bool = False,
+        out_path: Optional[str] = None,
+        chunk_rows: int = 10000
+):
+    """
+    Get the expression matrix of the selected cells and genes as a DataFrame.
+
+    :param data: StereoExpData object, the raw expression matrix is used if exists.
+    :param cell_name: the cells to select, defaults to all cells.
+    :param gene_name: the genes to select, defaults to all genes.
+    :param dtype: cast the selected values to this dtype before they are densified, like `np.float32`,
+                    defaults to keep the dtype of the expression matrix.
+    :param sparse: return a DataFrame of sparse columns without densifying when the expression matrix is sparse.
+    :param out_path: write the DataFrame to this parquet file `chunk_rows` cells at a time instead of returning it,
+                    only one chunk is dense in memory at once.
+    :param chunk_rows: the number of cells densified and written at a time when `out_path` is set.
+
+    :return: the DataFrame, or None if `out_path` is set.
+    """
+    cell_index = _first_index_of(data.cells._obs.index, cell_name, 'cell') if cell_name is not None else None
+    gene_index = _first_index_of(data.genes._var.index, gene_name, 'gene') if gene_name is not None else None
     if data.tl.raw:
-        cell_isin = np.isin(data.tl.raw.cell_names, data.cell_names)
-        gene_isin = np.isin(data.tl.raw.gene_names, data.gene_names)
-        exp_matrix = data.tl.raw.exp_matrix[cell_isin, :][:, gene_isin]
+        # compose the raw-to-data masks with the selection, so the raw matrix is sliced only once per axis
+        exp_matrix = data.tl.raw.exp_matrix
+        raw_cell_index = np.flatnonzero(np.isin(data.tl.raw.cell_names, data.cell_names))
+        raw_gene_index = np.flatnonzero(np.isin(data.tl.raw.gene_names, data.gene_names))
+        cell_index = raw_cell_index if cell_index is None else raw_cell_index[cell_index]
+        gene_index = raw_gene_index if gene_index is None else raw_gene_index[gene_index]
     else:
         exp_matrix = data.exp_matrix
-    cell_index = [np.argwhere(data.cells.cell_name == i)[0][0] for i in cell_name] if cell_name is not None else None
-    gene_index = [np.argwhere(data.genes.gene_name == i)[0][0] for i in gene_name] if gene_name is not None else None
-    x = exp_matrix[cell_index, :] if cell_index is not None else exp_matrix
-    x = x[:, gene_index] if gene_index is not None else x
+    # reuse the existing name indexes instead of converting the names to new arrays
+    index = cell_name if cell_name is not None else data.cells._obs.index
+    columns = gene_name if gene_name is not None else data.genes._var.index
+    if out_path is not None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        rows = np.arange(exp_matrix.shape[0]) if cell_index is None else cell_index
+        writer = None
+        try:
+            for start in range(0, len(rows), chunk_rows):
+                x = _select_exp(exp_matrix, rows[start:start + chunk_rows], gene_index, dtype, False)
+                x = x if isinstance(x, np.ndarray) else x.toarray()
+                df = pd.DataFrame(data=x, index=index[start:start + chunk_rows], columns=columns, copy=False)
+                table = pa.Table.from_pandas(df)
+                if writer is None:
+                    writer = pq.ParquetWriter(out_path, table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+        return None
+    x = _select_exp(exp_matrix, cell_index, gene_index, dtype, sparse)
+    if sparse and sp.issparse(x):
+        return pd.DataFrame.sparse.from_spmatrix(x.tocsc(), index=index, columns=columns)
     x = x if isinstance(x, np.ndarray) else x.toarray()
-    index = cell_name if cell_name is not None else data.cell_names
-    columns = gene_name if gene_name is not None else data.gene_names
-    df = pd.DataFrame(data=x, index=index, columns=columns)
+    df = pd.DataFrame(data=x, index=index, columns=columns, copy=False)
     return df
 
 
 def get_top_marker(g_name: str, marker_res: dict, sort_key: str, ascend: bool = False, top_n: int = 10):
     result: pd.DataFrame = marker_res[g_name]
-    top_res = result.sort_values(by=sort_key, ascending=ascend).head(top_n).dropna(axis=0, subset=[sort_key])
+    # partial selection instead of sorting all the genes, nan are left out as the dropna did
+    top_res = result.nsmallest(top_n, sort_key) if ascend else result.nlargest(top_n, sort_key)
     return top_res
 
 
@@ -34,8 +34,8 @@ def _(x, *, axis=0):
     mean = np.mean(x, axis=axis, dtype=np.float64)
     mean_sq = np.multiply(x, x).mean(axis=axis, dtype=np.float64)
     var = mean_sq - mean ** 2
-    # enforce R convention (unbiased estimator) for variance
-    var *= x.shape[axis] / (x.shape[axis] - 1)
+    # enforce R convention (unbiased estimator) for variance, which is undefined for a single observation
+    var *= x.shape[axis] / (x.shape[axis] - 1) if x.shape[axis] > 1 else np.nan
     return mean, var
 
 
@@ -47,8 +47,8 @@ def _(X, *, axis=0):
         mean = np.mean(X, axis=axis, dtype=np.float64)
         mean_sq = np.multiply(X, X).mean(axis=axis, dtype=np.float64)
         var = mean_sq - mean ** 2
-    # enforce R convention (unbiased estimator) for variance
-    var *= X.shape[axis] / (X.shape[axis] - 1)
+    # enforce R convention (unbiased estimator) for variance, which is undefined for a single observation
+    var *= X.shape[axis] / (X.shape[axis] - 1) if X.shape[axis] > 1 else np.nan
     return mean, var
 
 
@@ -79,7 +79,7 @@ def sparse_mean_variance_axis(mtx: spmatrix, axis: int):
         return sparse_mean_var_minor_axis(mtx.data, mtx.indices, *shape, np.float64)
 
 
-@numba.njit(cache=True)
+@numba.njit(cache=True, nogil=True)
 def sparse_mean_var_major_axis(data, indices, indptr, major_len, minor_len, dtype):
     """
     Computes mean and variance for a sparse array for the major axis.
@@ -109,7 +109,7 @@ def sparse_mean_var_major_axis(data, indices, indptr, major_len, minor_len, dtyp
     return means, variances
 
 
-@numba.njit(cache=True)
+@numba.njit(cache=True, nogil=True)
 def sparse_mean_var_minor_axis(data, indices, major_len, minor_len, dtype):
     """
     Computes mean and variance for a sparse matrix for the minor axis.
@@ -144,6 +144,63 @@ def sparse_mean_var_minor_axis(data, indices, major_len, minor_len, dtype):
     return means, variances
 
 
+def get_group_mean_var(X: csr_matrix, mask: np.ndarray):
+    """
+    Computes the column means and variances of the rows selected by `mask` and of the rest rows,
+    straight from the csr arrays, without slicing out the two sub-matrices.
+
+    :return: (mean, var, nobs) of the selected rows and (mean, var, nobs) of the rest rows.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    means, variances = sparse_group_mean_var(X.data, X.indices, X.indptr, mask, X.shape[1], np.float64)
+    nobs = np.array([mask.sum(), mask.size - mask.sum()])
+    # enforce R convention (unbiased estimator) for variance, a group of a single row gets nan as in `get_mean_var`
+    variances *= np.where(nobs > 1, nobs / np.maximum(nobs - 1, 1), np.nan)[:, np.newaxis]
+    return (means[0], variances[0], nobs[0]), (means[1], variances[1], nobs[1])
+
+
+@numba.njit(cache=True, nogil=True)
+def sparse_group_mean_var(data, indices, indptr, mask, minor_len, dtype):
+    """
+    Computes the column means and variances of a csr matrix for two row groups at once,
+    row 0 of the outputs for the rows where `mask` is True, row 1 for the others.
+    """
+    major_len = mask.shape[0]
+    means = np.zeros((2, minor_len), dtype=dtype)
+    variances = np.zeros_like(means, dtype=dtype)
+    counts = np.zeros((2, minor_len), dtype=np.int64)
+    nobs = np.zeros(2, dtype=np.int64)
+
+    for i in range(major_len):
+        g = 0 if mask[i] else 1
+        nobs[g] += 1
+        for j in range(indptr[i], indptr[i + 1]):
+            means[g, indices[j]] += data[j]
+
+    for g in range(2):
+        if nobs[g] == 0:
+            continue
+        for c in range(minor_len):
+            means[g, c] /= nobs[g]
+
+    for i in range(major_len):
+        g = 0 if mask[i] else 1
+        for j in range(indptr[i], indptr[i + 1]):
+            col_ind = indices[j]
+            diff = data[j] - means[g, col_ind]
+            variances[g, col_ind] += diff * diff
+            counts[g, col_ind] += 1
+
+    for g in range(2):
+        if nobs[g] == 0:
+            continue
+        for c in range(minor_len):
+            variances[g, c] += (nobs[g] - counts[g, c]) * means[g, c] ** 2
+            variances[g, c] /= nobs[g]
+
+    return means, variances
+
+
 def materialize_as_ndarray(a):
     try:
         import dask.array as da
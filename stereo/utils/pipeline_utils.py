@@ -7,6 +7,7 @@ from typing import (
 import numba as nb
 import numpy as np
 import pandas as pd
+from scipy.sparse import csr_matrix
 
 from stereo.core.stereo_exp_data import StereoExpData
 from stereo.log_manager import logger
@@ -42,7 +43,6 @@ def cell_cluster_to_gene_exp_cluster(
         if isinstance(groups, str):
             groups = [groups]
         group_index = group_index.loc[groups]
-    tmp = []
     if use_raw:
         data.raw.array2sparse()
         if filter_raw:
@@ -67,14 +67,21 @@ def cell_cluster_to_gene_exp_cluster(
 
     if kind != 'mean':
         kind = 'sum'
-    for _, cell_index in group_index.iterrows():
-        cell_index = cell_index.to_numpy()[0]
-        if kind == 'sum':
-            exp_tmp = exp_matrix[cell_index].sum(axis=0).A[0]
-        else:
-            exp_tmp = exp_matrix[cell_index].mean(axis=0).A[0]
-        tmp.append(exp_tmp)
-    cluster_exp_matrix = np.vstack(tmp)
+    # aggregate all groups at once as a (groups x cells) membership matrix times the expression matrix
+    cells_count = group_index['cell_index'].map(len).to_numpy()
+    cell_index = np.fromiter(
+        (i for cells in group_index['cell_index'] for i in cells), dtype=np.int64, count=cells_count.sum()
+    )
+    group_idx = np.repeat(np.arange(group_index.shape[0]), cells_count)
+    weight_dtype = np.int64 if np.issubdtype(exp_matrix.dtype, np.integer) else exp_matrix.dtype
+    membership = csr_matrix(
+        (np.ones(cell_index.size, dtype=weight_dtype), (group_idx, cell_index)),
+        shape=(group_index.shape[0], exp_matrix.shape[0])
+    )
+    cluster_exp_matrix = (membership @ exp_matrix).toarray()
+    if kind == 'mean':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cluster_exp_matrix = cluster_exp_matrix / cells_count[:, np.newaxis]
     return pd.DataFrame(cluster_exp_matrix, columns=gene_names, index=group_index.index).T
 
 
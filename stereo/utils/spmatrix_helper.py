@@ -10,6 +10,10 @@
 change log:
     2021/06/24  create file.
 """
+import zlib
+
+import numpy as np
+from scipy.sparse import issparse
 
 
 def idx_chunks_along_axis(shape: tuple, axis: int, chunk_size: int):
@@ -30,3 +34,28 @@ def idx_chunks_along_axis(shape: tuple, axis: int, chunk_size: int):
         cur += chunk_size
     mutable_idx[axis] = slice(cur, None)
     yield tuple(mutable_idx)
+
+
+def content_fingerprint(matrix):
+    """
+    Gives a cheap fingerprint of the values of a dense or sparse matrix, an adler32 checksum over its stored arrays,
+    to tell whether results cached for the matrix still describe it after it may have been modified in place.
+
+    :param matrix: a numpy array or a csr/csc/coo sparse matrix.
+    :return: a hashable fingerprint, or `None` if the matrix format is not supported.
+    """
+    if issparse(matrix):
+        if matrix.format in ('csr', 'csc'):
+            arrays = (matrix.data, matrix.indices, matrix.indptr)
+        elif matrix.format == 'coo':
+            arrays = (matrix.data, matrix.row, matrix.col)
+        else:
+            return None
+    else:
+        matrix = np.asarray(matrix)
+        # the checksum reads a contiguous buffer, a fortran ordered array is read through its transpose
+        arrays = (matrix.T if matrix.flags.f_contiguous else np.ascontiguousarray(matrix),)
+    checksum = 1
+    for array in arrays:
+        checksum = zlib.adler32(np.ascontiguousarray(array), checksum)
+    return matrix.shape, matrix.dtype.str, tuple(array.size for array in arrays), checksum
@@ -1,6 +1,9 @@
 import pytest
 import unittest
 
+import numpy as np
+from scipy.sparse import issparse
+
 import stereo as st
 from stereo.utils._download import _download
 
@@ -37,7 +40,35 @@ class TestClustering(unittest.TestCase):
         data.tl.leiden(neighbors_res_key='neighbors', res_key='leiden')
         data.plt.umap(res_key='umap', cluster_key='leiden', out_path=TEST_IMAGE_PATH + "umap.png")
         data.plt.cluster_scatter(res_key='leiden', out_path=TEST_IMAGE_PATH + "leiden.png")
-    
+
+    def test_normalize_total_log1p(self):
+        def read_data(dense):
+            data = st.io.read_gef(self.gef_file)
+            if dense:
+                data.exp_matrix = data.exp_matrix.toarray()
+            return data
+
+        def to_array(exp_matrix):
+            return exp_matrix.toarray() if issparse(exp_matrix) else np.asarray(exp_matrix)
+
+        for dense in (False, True):
+            with self.subTest(dense=dense):
+                expected = read_data(dense)
+                expected.tl.normalize_total(target_sum=1e4)
+                expected.tl.log1p()
+                expected = to_array(expected.exp_matrix)
+
+                data = read_data(dense)
+                source = data.exp_matrix
+                source_copy = source.copy()
+                data.tl.normalize_total_log1p(target_sum=1e4, inplace=False)
+                np.testing.assert_allclose(to_array(data.tl.result['normalize_total_log1p']), expected, rtol=1e-5)
+                np.testing.assert_array_equal(to_array(source), to_array(source_copy))
+
+                data.tl.normalize_total_log1p(target_sum=1e4)
+                np.testing.assert_allclose(to_array(data.exp_matrix), expected, rtol=1e-5)
+                np.testing.assert_array_equal(to_array(source), to_array(source_copy))
+
     def test_cellbins_main(self):
         data = st.io.read_gef(self.gef_file)
         data.tl.cal_qc()
@@ -1,11 +1,32 @@
 import unittest
 
+import numpy as np
+import pandas as pd
+from scipy import stats
+from scipy.sparse import csr_matrix
+
 import stereo as st
+from stereo.algorithm import statistics
+from stereo.core.stereo_exp_data import StereoExpData
+from stereo.tools.find_markers import FindMarker
 from stereo.utils._download import _download
 
 from settings import TEST_DATA_PATH, TEST_IMAGE_PATH, DEMO_DATA_URL
 
 
+def _small_data(group_sizes, sparse, seed=0):
+    rng = np.random.default_rng(seed)
+    n_cells = sum(group_sizes)
+    # log-normalized like counts, with many zeros and ties as in real data
+    exp_matrix = np.log1p(rng.poisson(0.8, size=(n_cells, 40)).astype(np.float64))
+    cells = np.array([f'cell_{i}' for i in range(n_cells)])
+    genes = np.array([f'gene_{i}' for i in range(exp_matrix.shape[1])])
+    labels = np.repeat([str(i + 1) for i in range(len(group_sizes))], group_sizes)
+    data = StereoExpData(exp_matrix=csr_matrix(exp_matrix) if sparse else exp_matrix, cells=cells, genes=genes)
+    groups = pd.DataFrame({'bins': cells, 'group': labels})
+    return data, groups
+
+
 class TestMarkerGenes(unittest.TestCase):
     data = None
     gef_file = None
@@ -54,6 +75,41 @@ class TestMarkerGenes(unittest.TestCase):
     def test_find_marker_genes_method_wilcoxon_test(self):
         self.data.tl.find_marker_genes(cluster_res_key='leiden', method="wilcoxon_test")
 
+    def test_t_test_sparse_matches_dense(self):
+        # group '3' has a single cell, its variance is undefined
+        results = []
+        for sparse in (True, False):
+            data, groups = _small_data((30, 29, 1), sparse)
+            results.append(FindMarker(data=data, groups=groups, method='t_test', raw_data=data, n_jobs=1).result)
+        sparse_result, dense_result = results
+        for g in ('1', '2', '3'):
+            key = f'{g}.vs.rest'
+            for column in ('scores', 'pvalues', 'pvalues_adj', 'log2fc'):
+                np.testing.assert_allclose(
+                    sparse_result[key].sort_index()[column].to_numpy(),
+                    dense_result[key].sort_index()[column].to_numpy(),
+                    rtol=1e-7, atol=1e-12
+                )
+        single = sparse_result['3.vs.rest']
+        self.assertTrue(np.all(single['scores'] == 0))
+        self.assertTrue(np.all(single['pvalues'] == 1))
+        self.assertTrue(np.all(np.isfinite(single['log2fc'])))
+
+    def test_wilcoxon_test_rank_sums(self):
+        data, groups = _small_data((30, 20, 10), False)
+        exp_matrix = data.exp_matrix.copy()
+        result = FindMarker(data=data, groups=groups, method='wilcoxon_test', raw_data=data, n_jobs=1).result
+        # the per group test on the pooled ranks, as it ran before the rank sums were shared
+        ranks = stats.rankdata(exp_matrix.T, axis=-1)
+        for g in ('1', '2', '3'):
+            mask = groups['group'].to_numpy() == g
+            expected = statistics.wilcoxon(
+                exp_matrix[mask], exp_matrix[~mask], 'benjamini-hochberg', ranks, None, mask
+            )
+            actual = result[f'{g}.vs.rest'].sort_index()
+            for column in ('scores', 'pvalues', 'pvalues_adj', 'log2fc'):
+                np.testing.assert_allclose(actual[column].to_numpy(), expected[column].to_numpy(), rtol=1e-7)
+
     def test_find_marker_genes_not_use_raw(self):
         self.data.tl.find_marker_genes(cluster_res_key='leiden', use_raw=False)
 
@@ -0,0 +1,62 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+from stereo.algorithm.spatial_pattern_score import (
+    find_cutoff,
+    get_enrichment_score,
+    spatial_pattern_score
+)
+
+
+def _per_gene_spatial_pattern_score(exp_df):
+    # the per-gene implementation over a dense dataframe, which the sparse kernel replaced
+    report = exp_df.apply(get_enrichment_score, axis=0)
+    report = report.T.reset_index()
+    report.columns = ['gene', 'E10', 'C50', 'total_count']
+    tmp = report[report['total_count'] > 300]
+    e10_cutoff = find_cutoff(list(tmp['E10']), 0.9)
+    c50_cutoff = find_cutoff(list(tmp['C50']), 0.1)
+    pattern = tmp[(tmp['E10'] > e10_cutoff) & (tmp.C50 < c50_cutoff)]
+    no_pattern = tmp.drop(pattern.index, inplace=False)
+    low_exp = report.drop(tmp.index, inplace=False)
+    report_out = pd.concat([pattern, no_pattern, low_exp])[["gene", "E10"]]
+    report_out["attribute"] = \
+        pattern.shape[0] * ["pattern"] \
+        + no_pattern.shape[0] * ["no_pattern"] \
+        + low_exp.shape[0] * ["low_exp"]
+    report_out.index = report_out['gene']
+    return report_out
+
+
+class TestSpatialPatternScore(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        n_cells, n_genes = 600, 40
+        rates = rng.uniform(0.05, 3, n_genes)
+        counts = rng.poisson(rates, size=(n_cells, n_genes)).astype(np.float64)
+        # a few genes expressed strongly in a small region only
+        counts[:60, :4] += rng.poisson(20, size=(60, 4))
+        # every gene needs a count, the per-gene implementation can not score an empty gene
+        counts[0] += 1
+        self.gene_names = np.array([f'gene_{i}' for i in range(n_genes)])
+        self.exp_df = pd.DataFrame(counts, columns=self.gene_names)
+        self.expected = _per_gene_spatial_pattern_score(self.exp_df)
+
+    def _check(self, result):
+        self.assertListEqual(result['gene'].tolist(), self.expected['gene'].tolist())
+        self.assertListEqual(result['attribute'].tolist(), self.expected['attribute'].tolist())
+        np.testing.assert_allclose(result['E10'].to_numpy(dtype=np.float64),
+                                   self.expected['E10'].to_numpy(dtype=np.float64), atol=0.01)
+
+    def test_sparse_matrix(self):
+        self._check(spatial_pattern_score(csr_matrix(self.exp_df.to_numpy()), self.gene_names))
+
+    def test_dense_matrix(self):
+        self._check(spatial_pattern_score(self.exp_df.to_numpy(), self.gene_names))
+
+    def test_dataframe(self):
+        self._check(spatial_pattern_score(self.exp_df))